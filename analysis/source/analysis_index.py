@@ -1,38 +1,82 @@
 """Classes representing the analysis index file. Run this script to download all data"""
+import contextlib
 import json
 import os
+import random
+import time
 
-from storage.S3_bucket import S3Bucket
-from storage.dgg_file_structure import data_path
+from botocore.exceptions import ClientError
+
+from dgg_log import root_logger
+from storage.S3_bucket import shared_bucket
 from storage.dgg_file_structure import project_path
 
+logger = root_logger.getChild(__name__)
+
 
 class ModelIndexFile:
-	"""Represents the analysis index file, synchronising a local copy to the bucket"""
+	"""
+	Represents the analysis index file, synchronising a local copy to the bucket.
+	Changes are made in transactions of one fetch and one put, the put is conditional on the index being unchanged in
+	the bucket since the fetch, so a concurrent job's entries are never overwritten. On a conflict the index is fetched
+	again and the transaction's changes are applied to it again, up to attempts times.
+	Each of add_entry, update_latest, add_latest and sort is a transaction of its own unless it is made within
+	transaction(), which applies every change made in it together.
+	"""
 	# TODO needs local version or non-automatic that does not sync to the bucket
-	def __init__(self, bucket, path):
+	def __init__(self, bucket, path, attempts=5):
 		self.bucket = bucket
 		self.path = path
+		self.attempts = attempts
 		self.models = {}
+		self.etag = None
+		self.changes = None
+
+	@contextlib.contextmanager
+	def transaction(self):
+		"""Apply every change made within the block with one fetch and one conditional put"""
+		if self.changes is not None:
+			# already within a transaction, the outer one stores the changes
+			yield self
+			return
+		self.fetch()
+		self.changes = []
+		try:
+			yield self
+			changes = self.changes
+		finally:
+			self.changes = None
+		if not changes:
+			return
+		for attempt in range(1, self.attempts + 1):
+			if self.store():
+				return
+			logger.warning(f'Index {self.path} changed in the bucket during the transaction, applying {len(changes)} changes again, attempt {attempt}')
+			time.sleep(random.uniform(0, attempt))
+			self.fetch()
+			for change in changes:
+				change()
+		raise RuntimeError(f'Could not store index {self.path}, it kept changing in the bucket')
+
+	def change(self, change):
+		"""Apply a change to the local copy as part of a transaction, a transaction of its own if none is open"""
+		with self.transaction():
+			change()
+			self.changes.append(change)
 
 	def add_entry(self, entry_date, entry_path):
 		"""Add a new analysis to the index"""
-		self.fetch()
-		self.add_local_entry(entry_date, entry_path)
-		self.store()
+		self.change(lambda: self.add_local_entry(entry_date, entry_path))
 
 	def update_latest(self, latest_path):
 		"""Update the pointer to the latest analysis"""
-		self.fetch()
-		self.update_local_latest(latest_path)
-		self.store()
+		self.change(lambda: self.update_local_latest(latest_path))
 
 	def add_latest(self, latest_date, latest_path):
 		"""Add a new analysis and set the latest pointer to it"""
-		self.fetch()
-		self.add_local_entry(latest_date, latest_path)
-		self.update_local_latest(latest_path)
-		self.store()
+		with self.transaction():
+			self.add_entry(latest_date, latest_path)
+			self.update_latest(latest_path)
 
 	def add_local_entry(self, entry_date, entry_path):
 		"""Add an analysis to the local copy of the index without synchronising to the bucket"""
@@ -42,31 +86,43 @@ class ModelIndexFile:
 		"""Update the local pointer to the latest analysis without synchronising to the bucket"""
 		self.models['latest'] = latest_path
 
+	def sort_local(self):
+		"""Sort the entries in the local copy of the index by date"""
+		self.models = dict(sorted(self.models.items()))
+
 	def fetch(self):
-		"""Get the latest copy of the index from the bucket"""
-		# TODO exception handling
-		response = self.bucket.get(self.path)
-		self.models = json.loads(response['Body'].read())
+		"""Get the latest copy of the index from the bucket, an index not yet in the bucket is empty"""
+		try:
+			response = self.bucket.get(self.path)
+		except self.bucket.client.exceptions.NoSuchKey:
+			self.models = {}
+			self.etag = None
+			return
+		with contextlib.closing(response['Body']) as body:
+			self.models = json.loads(body.read())
+		self.etag = response['ETag']
 
 	def sort(self):
 		"""Sort the entries in the index by date"""
-		self.fetch()
-		self.models = dict(sorted(self.models.items()))
-		self.store()
+		self.change(self.sort_local)
 
 	def store(self):
-		"""Store the local index in the bucket"""
-		# TODO exception handling
-		# TODO just use dumps instead of dump?
-		# would probably have to do binary encoding
-		local_filepath = os.path.join(data_path, 'models.json')
-
-		with open(local_filepath, 'w') as file:
-			json.dump(self.models, file)
-
-		with open(local_filepath, 'rb') as file:
-			# TODO warn if an existing index is being overwritten with an empty one?
-			self.bucket.put(self.path, file)
+		"""
+		Store the local index in the bucket straight from memory, only if the index in the bucket is still the one
+		fetched. Returns False if it has changed since
+		"""
+		body = json.dumps(self.models).encode('utf-8')
+		if self.etag:
+			conditions = {'IfMatch': self.etag}
+		else:
+			conditions = {'IfNoneMatch': '*'}
+		try:
+			self.etag = self.bucket.put(self.path, body, **conditions)
+		except ClientError as e:
+			if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+				return False
+			raise
+		return True
 
 	def download_model(self, date, outputpath):
 		if date in self.models:
@@ -76,8 +132,9 @@ class ModelIndexFile:
 			with open(filepath, 'wb') as outputfile:
 				#TODO response checks
 				response = self.bucket.get(self.models[date])
-				while outputfile.write(response['Body'].read(amt=512)):
-					pass
+				with contextlib.closing(response['Body']) as body:
+					while outputfile.write(body.read(amt=512)):
+						pass
 
 	def download_all_models(self, outputpath):
 		for date in self.models:
@@ -87,15 +144,16 @@ class ModelIndexFile:
 			with open(filepath, 'wb') as outputfile:
 				#TODO response checks
 				response = self.bucket.get(self.models[date])
-				while outputfile.write(response['Body'].read(amt=512)):
-					pass
+				with contextlib.closing(response['Body']) as body:
+					while outputfile.write(body.read(amt=512)):
+						pass
 
 
 def add_todays_model_example():
 	"""Example for adding latest analysis into the index, lacks checks and key format is old"""
 	import datetime
 
-	s3_bucket = S3Bucket()
+	s3_bucket = shared_bucket()
 	index = ModelIndexFile(s3_bucket, 'data/monthly_models.json')
 	batch_string = str(datetime.date.today().isoformat())
 	batch_s3_folder = 'data/{timestamp}'.format(timestamp=batch_string)
@@ -104,7 +162,7 @@ def add_todays_model_example():
 
 
 if __name__ == "__main__":
-	s3_bucket = S3Bucket()
+	s3_bucket = shared_bucket()
 	index = ModelIndexFile(s3_bucket, 'data/models2.json')
 	data_test_path = os.path.join(project_path, 'data_download')
 	if not os.path.exists(data_test_path):
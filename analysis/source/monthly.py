@@ -12,7 +12,11 @@ from analysis_index import ModelIndexFile
 
 from dgg_log import logging_setup, root_logger
 from paths import count_path, r_path, output_path, log_path, auth_path
-from storage.S3_bucket import S3Bucket
+from storage.S3_bucket import shared_bucket
+from storage.estimate_archive import EstimateArchive
+from storage.estimate_archive import ingest
+from storage.estimate_store import FacebookEstimateSQLiteStore
+from storage.estimate_store import estimates_database_path
 
 
 logger = root_logger.getChild(__name__)
@@ -130,27 +134,23 @@ class MonthlyAnalysis:
 		# monthly_check(year, month, estimate)
 
 	def get_bucket_counts(self):
-		s3_bucket = S3Bucket(key_filepath=s3_auth)
+		s3_bucket = shared_bucket(key_filepath=s3_auth)
 		logger.info(f"Getting count files for '{self.month_datestamp}' from '{self.s3_counts_root_folder}'")
 
+		if not os.path.exists(self.counts_folder):
+			os.makedirs(self.counts_folder)
+		items = []
 		for date in self.days_dates:
-			try:
-				date_filename = f'{self.estimate}_counts_{date.isoformat()}.csv'
-				date_filepath = os.path.join(self.counts_folder, date_filename)
-				date_key = f'{self.s3_counts_root_folder}/{date.isoformat()}/{date_filename}'
-				response = s3_bucket.get(date_key)
-				if not os.path.exists(self.counts_folder):
-					os.makedirs(self.counts_folder)
-				with open(date_filepath, 'wb') as file:
-					logger.debug(response)
-					logger.info(f"Saving '{date_key}' to '{date_filepath}'")
-					file.write(response['Body'].read())
-					logger.info(f"Saved '{date_key}' to '{date_filepath}'")
-			except s3_bucket.client.exceptions.NoSuchKey:
-				pass
-
-	def generate_monthly_averages(self):
-		logger.info(f"Generating monthly averages for '{self.month_datestamp}'")
+			date_filename = f'{self.estimate}_counts_{date.isoformat()}.csv'
+			date_filepath = os.path.join(self.counts_folder, date_filename)
+			date_key = f'{self.s3_counts_root_folder}/{date.isoformat()}/{date_filename}'
+			items.append((date_key, date_filepath))
+		# days without a count file are skipped
+		saved = s3_bucket.get_many(items)
+		logger.info(f"Saved {len(saved)} count files to '{self.counts_folder}'")
+
+	def monthly_data(self):
+		"""Gather the daily counts of the month from the count files, nested by country, gender and age group"""
 		ages = ["18+",
 		 "13-14",
 		 "14-15",
@@ -210,6 +210,11 @@ class MonthlyAnalysis:
 									monthly_data[country][csv_columns[column]['gender']][csv_columns[column]['age_group']]['estimate_mau'].append(row[column])
 							else:
 								logger.warning(f'Blank data for {date}/{country}/{column}')
+		return monthly_data
+
+	def generate_monthly_averages(self):
+		logger.info(f"Generating monthly averages for '{self.month_datestamp}'")
+		monthly_data = self.monthly_data()
 		print(monthly_data)
 
 		monthly_averages = {}
@@ -259,6 +264,47 @@ class MonthlyAnalysis:
 		preprocess_counts(self.start_date.isoformat(), self.count_filepath, monthly_averages, self.estimate)
 
 
+class MonthlyAnalysisDatabase(MonthlyAnalysis):
+	"""Monthly analysis reading the daily estimates of the month from the estimates database rather than count files"""
+	def __init__(self, year, month, estimate='mau', database_filepath=estimates_database_path):
+		super().__init__(year, month, estimate)
+		self.database_filepath = database_filepath
+
+	def get_bucket_counts(self):
+		"""The daily estimates are already in the database, there are no count files to get"""
+		pass
+
+	def monthly_data(self):
+		"""Gather the daily estimates of the month from the database, nested by country, gender and age group"""
+		store = FacebookEstimateSQLiteStore(self.start_date.isoformat(), self.database_filepath)
+		try:
+			return store.daily_values(self.start_date, self.end_date, self.estimate)
+		finally:
+			store.close()
+
+
+class MonthlyAnalysisArchive(MonthlyAnalysis):
+	"""
+	Monthly analysis reading the daily estimates of the month from the estimate archive rather than count files.
+	Days of the month not yet archived are ingested from the bucket first, after that only the month's partitions
+	and the columns averaged are read
+	"""
+	def __init__(self, year, month, estimate='mau', archive=None):
+		super().__init__(year, month, estimate)
+		self.archive = archive or EstimateArchive()
+
+	def get_bucket_counts(self):
+		"""Archive any days of the month that are not archived yet, days with no store are warned about and skipped"""
+		dates = [date.isoformat() for date in self.days_dates if date <= datetime.date.today()]
+		failed = ingest(self.archive, dates)
+		if failed:
+			raise RuntimeError(f'Could not archive {failed}')
+
+	def monthly_data(self):
+		"""Gather the daily estimates of the month from the archive, nested by country, gender and age group"""
+		return self.archive.daily_values(self.start_date, self.end_date, self.estimate)
+
+
 class MonthlyAnalysisBucket(MonthlyAnalysis):
 	def __init__(self, year, month, estimate='mau',
 					s3_root_folder='database_analyses', model_index='data/monthly_models.json'):
@@ -275,22 +321,28 @@ class MonthlyAnalysisBucket(MonthlyAnalysis):
 		self.upload_outputs()
 
 	def upload_outputs(self):
-		s3_bucket = S3Bucket(key_filepath=s3_auth)
-
-		with open(self.prediction_filepath, 'rb') as file:
-			s3_bucket.put(self.s3_model_predictions_key, file)
-			index = ModelIndexFile(s3_bucket, self.s3_model_index)
+		s3_bucket = shared_bucket(key_filepath=s3_auth)
+
+		failed = s3_bucket.put_many([
+			(self.s3_model_predictions_key, self.prediction_filepath),
+			(self.s3_fits_key, self.fit_filepath),
+		])
+		if failed:
+			raise RuntimeError(f'Could not upload {failed}')
+		index = ModelIndexFile(s3_bucket, self.s3_model_index)
+		with index.transaction():
 			index.add_latest(self.month_datestamp, self.s3_model_predictions_key)
 			index.sort()
 
-		with open(self.fit_filepath, 'rb') as file:
-			s3_bucket.put(self.s3_fits_key, file)
-
 
-def monthly_analysis_task(year, month, estimate):
+def monthly_analysis_task(year, month, estimate, archive=False):
+	"""Run the monthly analysis from the count files, or from the estimate archive if archive is True"""
 	logging_setup(log_path)
 
-	MonthlyAnalysis(year, month, estimate).analyse()
+	if archive:
+		MonthlyAnalysisArchive(year, month, estimate).analyse()
+	else:
+		MonthlyAnalysis(year, month, estimate).analyse()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,14 @@
 """Methods for preprocessing the facebook count data into a format usable by the R analysis"""
+import contextlib
 import csv
 import json
 import os
 
-from storage.S3_bucket import S3Bucket
+from storage.S3_bucket import shared_bucket
 from storage.dgg_file_structure import data_path
+from storage.estimate_archive import EstimateArchive
+from storage.estimate_store import FacebookEstimateSQLiteStore
+from storage.estimate_store import estimates_database_path
 from dgg_log import root_logger
 
 logger = root_logger.getChild(__name__)
@@ -12,7 +16,7 @@ logger = root_logger.getChild(__name__)
 
 def get_bucket_estimates(batch_string):
 	"""Retrieve a dataset from the bucket and create a csv file of the collected facebook counts"""
-	s3_bucket = S3Bucket()
+	s3_bucket = shared_bucket()
 	batch_s3_folder = f'data/{batch_string}'
 	try:
 		response = s3_bucket.get('{folder}/store_{timestamp}.json'.format(folder=batch_s3_folder, timestamp=batch_string))
@@ -27,7 +31,8 @@ def get_bucket_estimates(batch_string):
 				logger.warning('Cannot find data store for {date}'.format(date=batch_string))
 				return
 
-	estimates1 = json.loads(response['Body'].read())
+	with contextlib.closing(response['Body']) as body:
+		estimates1 = json.loads(body.read())
 	return estimates1
 
 
@@ -40,7 +45,7 @@ def preprocess_counts_from_bucket(batch_string, estimate='mau'):
 
 	preprocess_counts(batch_string, counts_csv_filepath, estimates1, estimate)
 
-	s3_bucket = S3Bucket()
+	s3_bucket = shared_bucket()
 	with open(counts_csv_filepath, 'rb') as countfile:
 		key = f'data/{batch_string}/{counts_csv_filename}'
 		s3_bucket.put(key, countfile)
@@ -58,6 +63,39 @@ def preprocess_counts_from_local(batch_string, estimate='mau'):
 		preprocess_counts(batch_string, counts_csv_filepath, estimates, estimate)
 
 
+def preprocess_counts_from_database(batch_string, estimate='mau', database_filepath=estimates_database_path):
+	"""Create the facebook counts csv for a collection day from the estimates database"""
+	counts_csv_filename = f'{estimate}_counts_{batch_string}.csv'
+	counts_csv_filepath = os.path.join(data_path, counts_csv_filename)
+
+	store = FacebookEstimateSQLiteStore(batch_string, database_filepath)
+	try:
+		preprocess_counts(batch_string, counts_csv_filepath, store.dictionary, estimate)
+	finally:
+		store.close()
+
+
+def preprocess_counts_from_archive(batch_string, estimate='mau', archive=None):
+	"""
+	Create the facebook counts csv for a collection day from the estimate archive and upload it to the bucket.
+	The day is ingested from the bucket again first, replacing any archived copy, so a day collected again or resumed
+	since it was archived is not analysed from a stale copy
+	"""
+	s3_bucket = shared_bucket()
+	archive = archive or EstimateArchive()
+	if not archive.ingest_bucket(s3_bucket, batch_string):
+		raise FileNotFoundError(f'Cannot find data store for {batch_string}')
+
+	counts_csv_filename = f'{estimate}_counts_{batch_string}.csv'
+	counts_csv_filepath = os.path.join(data_path, counts_csv_filename)
+
+	preprocess_counts(batch_string, counts_csv_filepath, archive.estimates(batch_string, estimate), estimate)
+
+	with open(counts_csv_filepath, 'rb') as countfile:
+		key = f'data/{batch_string}/{counts_csv_filename}'
+		s3_bucket.put(key, countfile)
+
+
 def preprocess_counts(batch_string, counts_csv_filepath, estimates, estimate='mau'):
 	"""Blank any missing data or ratios and write the facebook counts csv"""
 	ratios = {
@@ -204,7 +242,7 @@ def preprocess_counts(batch_string, counts_csv_filepath, estimates, estimate='ma
 
 def merge_counts_with_offline_dataset(batch_string, estimate='mau', offline_file=os.path.join(data_path, 'Digital_gender_gap_dataset_updated_ITU_data.csv')):
 	"""Merge the facebook counts csv with the offline dataset csv"""
-	s3_bucket = S3Bucket()
+	s3_bucket = shared_bucket()
 	batch_s3_folder = 'data/{timestamp}'.format(timestamp=batch_string)
 	counts_csv_filename = '{estimate}_counts_{timestamp}.csv'.format(estimate=estimate, timestamp=batch_string)
 	counts_csv_filepath = os.path.join(data_path, counts_csv_filename)
@@ -259,7 +297,13 @@ def merge_counts_with_offline_dataset(batch_string, estimate='mau', offline_file
 		s3_bucket.put(key, countfile)
 
 
-def preprocess_analysis_data(batch_string, estimate='mau'):
-	"""Create the facebook counts csv from a bucket dataset and then merge with the offline dataset csv"""
-	preprocess_counts_from_bucket(batch_string, estimate)
+def preprocess_analysis_data(batch_string, estimate='mau', archive=False):
+	"""
+	Create the facebook counts csv from a bucket dataset and then merge with the offline dataset csv.
+	archive True creates the counts csv through the estimate archive instead
+	"""
+	if archive:
+		preprocess_counts_from_archive(batch_string, estimate)
+	else:
+		preprocess_counts_from_bucket(batch_string, estimate)
 	merge_counts_with_offline_dataset(batch_string, estimate)
@@ -3,7 +3,7 @@ import datetime
 import os
 
 import r_language
-from storage.S3_bucket import S3Bucket
+from storage.S3_bucket import shared_bucket
 from preprocessing import preprocess_analysis_data
 from dgg_log import logging_setup
 from dgg_log import root_logger
@@ -59,23 +59,17 @@ def predict(batch_string, estimate='mau'):
 	"""Run an analysis for the given day. Inputs are expected to be retrievable from S3"""
 	preprocess_analysis_data(batch_string, estimate)
 
-	s3_bucket = S3Bucket()
+	s3_bucket = shared_bucket()
 
 	files = predict_from_file(r_path, f'{estimate}_counts_{batch_string}.csv', data_path)
 
 	batch_s3_folder = f'data/{batch_string}'
-	key = ''
-	with open(files['predictions'], 'rb') as file:
-		filename = f'{estimate}_monthly_model_2_{batch_string}.csv'
-		key = f'{batch_s3_folder}/{filename}'
-		s3_bucket.put(key, file)
-		logger.info(f'Uploaded {filename}')
-
-	with open(files['fits'], 'rb') as file:
-		filename = f'{estimate}_monthly_model_2_{batch_string}_fits.csv'
-		fit_key = f'{batch_s3_folder}/{filename}'
-		s3_bucket.put(fit_key, file)
-		logger.info(f'Uploaded {filename}')
+	key = f'{batch_s3_folder}/{estimate}_monthly_model_2_{batch_string}.csv'
+	fit_key = f'{batch_s3_folder}/{estimate}_monthly_model_2_{batch_string}_fits.csv'
+	failed = s3_bucket.put_many([(key, files['predictions']), (fit_key, files['fits'])])
+	if failed:
+		raise RuntimeError(f'Could not upload {failed}')
+	logger.info(f'Uploaded {key} and {fit_key}')
 	return key
 
 
@@ -1,9 +1,9 @@
-import json
 import os
 
 from r_analysis_wrapper import predict
 from dgg_log import root_logger
-from storage.S3_bucket import S3Bucket
+from storage.S3_bucket import shared_bucket
+from storage.S3_bucket import shared_client
 from storage.dgg_file_structure import auth_path
 
 logger = root_logger.getChild(__name__)
@@ -13,11 +13,7 @@ s3_auth = os.path.join(auth_path, 'S3_keys.json')
 
 def catchup_analysis():
 	"""Run an analysis for any collections that haven't been analysed yet"""
-	import boto3
-
-	with open(s3_auth) as key_file:
-		s3_keys = json.load(key_file)
-		client = boto3.client('s3', **s3_keys)
+	client = shared_client(s3_auth)
 
 	paginator = client.get_paginator('list_objects')
 	result = paginator.paginate(Bucket='www.digitalgendergaps.org', Prefix='data/', Delimiter='/')
@@ -35,18 +31,16 @@ def catchup_analysis():
 
 def redo_analysis():
 	"""Run a new analysis for all datasets in the bucket"""
-	import boto3
-
-	with open(s3_auth) as key_file:
-		s3_keys = json.load(key_file)
-		client = boto3.client('s3', **s3_keys)
+	client = shared_client(s3_auth)
 
 	from analysis.analysis_index import ModelIndexFile
-	s3_bucket = S3Bucket()
+	s3_bucket = shared_bucket()
 	index = ModelIndexFile(s3_bucket, 'data/models2.json')
 
 	paginator = client.get_paginator('list_objects')
 	result = paginator.paginate(Bucket='www.digitalgendergaps.org', Prefix='data/', Delimiter='/')
+	# each entry is stored in an update of the index of its own once its prediction is done, so no update is held
+	# open across the predictions
 	for prefix in result.search('CommonPrefixes'):
 		batch_string = prefix['Prefix'].split('/')[1]
 		try:
@@ -61,8 +55,9 @@ def redo_analysis():
 def redo_dates(dates):
 	from analysis.analysis_index import ModelIndexFile
 
-	s3_bucket = S3Bucket()
+	s3_bucket = shared_bucket()
 	index = ModelIndexFile(s3_bucket, 'data/models2.json')
+	# as in redo_analysis each entry is stored once its prediction is done
 	for date in dates:
 		try:
 			mau_key = predict(date)
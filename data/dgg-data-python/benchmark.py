@@ -0,0 +1,139 @@
+"""
+Benchmark a full collection against the local Marketing API stand-in.
+Reports requests per second, the share of the queue completed by the deadline and the time spent sleeping.
+Run with --check to exit with an error if the collection regresses, the check collects a few countries at low usage
+in a short window and fails if any request is left incomplete or the accounts are held back.
+"""
+import argparse
+import datetime
+import logging
+import tempfile
+import time
+
+from dgg_log import root_logger
+from collection.facebook_collector import FacebookCollection
+from collection.facebook_requests import country_target_queue_size
+from collection.fake_marketing_api import FakeMarketingApi
+from collection.fake_marketing_api import fake_account_pool
+from collection.fake_marketing_api import injected_errors
+from collection.fake_marketing_api import latency_distributions
+from collection.targeting_cache import TargetingCache
+from collection.throttle import UsageThrottle
+from collection.throttle import parse_usage_headers
+from collection.zero_policy import ZeroPopulationPolicy
+
+logger = root_logger.getChild(__name__)
+
+
+def parse_args(args=None):
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--countries', type=int, default=246, help='number of countries in the queue')
+	parser.add_argument('--accounts', type=int, default=3, help='number of ad accounts in the pool')
+	parser.add_argument('--requests-per-account', type=int, default=1)
+	parser.add_argument('--batch-size', type=int, default=1)
+	parser.add_argument('--latency', nargs=3, default=['lognormal', '0.3', '0.5'], metavar=('DISTRIBUTION', 'A', 'B'), help='one of {d}'.format(d=', '.join(latency_distributions)))
+	parser.add_argument('--error-rate', nargs=2, action='append', default=[], type=float, metavar=('CODE', 'RATE'), help='inject an error code, one of {c}, into this fraction of calls'.format(c=', '.join(map(str, injected_errors))))
+	parser.add_argument('--account-limit', type=int, help='calls each account may make in the window')
+	parser.add_argument('--app-limit', type=int, help='calls the app may make in the window')
+	parser.add_argument('--window', type=float, default=60, help='seconds in the call limit window')
+	parser.add_argument('--not-ready-rate', type=float, default=0)
+	parser.add_argument('--zero-rate', type=float, default=0)
+	parser.add_argument('--deadline', help='HH:MM to stop retrying, 23:00 by default')
+	parser.add_argument('--check', action='store_true', help='check the pacing and a short collection, exiting with an error on a regression')
+	parser.add_argument('--verbose', action='store_true')
+	return parser.parse_args(args)
+
+
+def check_pacing():
+	"""
+	Check the throttle against usage headers as the Marketing API sends them, reset_time_duration included at any usage.
+	Returns a list of the problems found
+	"""
+	throttle = UsageThrottle()
+	problems = []
+	low = parse_usage_headers({'x-ad-account-usage': '{"acc_id_util_pct": 10, "reset_time_duration": 300}'})
+	if throttle.account_delay(low):
+		problems += ['{d} s delay at low usage {report}'.format(d=throttle.account_delay(low), report=low)]
+	high = parse_usage_headers({'x-ad-account-usage': '{"acc_id_util_pct": 95, "reset_time_duration": 300}'})
+	if throttle.account_delay(high) < 300:
+		problems += ['{d} s delay over the target usage {report}'.format(d=throttle.account_delay(high), report=high)]
+	return problems
+
+
+def check_collection():
+	"""
+	Collect two countries at low usage with the usage window reset every 2 s.
+	Returns a list of the problems found, every request should complete and, with usage well under the limits, no
+	account should be held back
+	"""
+	args = parse_args([
+		'--countries', '2', '--latency', 'constant', '0.01', '0', '--account-limit', '1000', '--window', '2'
+	])
+	report = run(args)
+	problems = []
+	if report['completed'] < report['total']:
+		problems += ['{completed}/{total} requests completed'.format(**report)]
+	account_wait = report['sleep'].get('account wait', 0)
+	if account_wait > 1:
+		problems += ['accounts held back for {x:.1f} s at low usage'.format(x=account_wait)]
+	return problems, report
+
+
+def run(args):
+	"""Run one collection against a fresh stand-in and return the report"""
+	if args.deadline:
+		deadline = datetime.datetime.combine(datetime.date.today(), datetime.time.fromisoformat(args.deadline))
+	else:
+		deadline = None
+	error_rates = {int(code): rate for code, rate in args.error_rate}
+	fake = FakeMarketingApi(
+		latency=(args.latency[0], float(args.latency[1]), float(args.latency[2])), error_rates=error_rates,
+		account_limit=args.account_limit, app_limit=args.app_limit, window=args.window,
+		not_ready_rate=args.not_ready_rate, zero_rate=args.zero_rate
+	)
+	with tempfile.TemporaryDirectory() as folder, fake:
+		collection = FacebookCollection(
+			'benchmark', account_pool=fake_account_pool(args.accounts), requests_per_account=args.requests_per_account,
+			batch_size=args.batch_size, zero_policy=ZeroPopulationPolicy(), targeting_cache=TargetingCache(path=folder),
+			deadline=deadline, path=folder, upload=False
+		)
+		collection.create_target_queue()
+		collection.queues = collection.queues[:args.countries]
+		start = time.time()
+		collection.collect()
+		elapsed = time.time() - start
+		total = len(collection.queues) * country_target_queue_size(collection.behaviors)
+		completed = sum(1 for entry in collection.journal.entries() if not entry.get('failed'))
+	calls = sum(count for name, count in fake.stats.items() if name not in ('batch', 'search'))
+	return {
+		'elapsed': elapsed,
+		'calls': calls,
+		'calls_per_second': calls / elapsed,
+		'estimates_per_second': completed / elapsed,
+		'completed': completed,
+		'total': total,
+		'completion_rate': completed / total,
+		'sleep_time': collection.metrics.sleep_time(),
+		'sleep': dict(collection.metrics.sleep),
+		'server': dict(fake.stats),
+	}
+
+
+if __name__ == "__main__":
+	arguments = parse_args()
+	logging.basicConfig(level=logging.INFO if arguments.verbose else logging.WARNING)
+	if arguments.check:
+		problems = check_pacing()
+		collection_problems, report = check_collection()
+		problems += collection_problems
+		for problem in problems:
+			print('Check failed: {problem}'.format(problem=problem))
+		if problems:
+			raise SystemExit(1)
+		print('Check passed, {completed}/{total} requests in {elapsed:.1f} s'.format(**report))
+		raise SystemExit(0)
+	report = run(arguments)
+	print('{calls} calls in {elapsed:.1f} s, {calls_per_second:.2f} requests/s, {estimates_per_second:.2f} estimates/s'.format(**report))
+	print('{completed}/{total} requests completed by the deadline, {completion_rate:.1%}'.format(**report))
+	print('{sleep_time:.1f} s sleeping across workers, {sleep}'.format(**report))
+	print('Server calls {server}'.format(**report))
@@ -1,4 +1,5 @@
 """Main script for the dgg-data-python package. Run to perform a collection and analysis for today."""
+import argparse
 import datetime
 import os
 
@@ -11,20 +12,25 @@ from dgg_email import send_error_log
 from analysis import r_analysis_wrapper
 from analysis.analysis_index import ModelIndexFile
 from collection.facebook_collector import FacebookCollection
-from storage.S3_bucket import S3Bucket
+from storage.S3_bucket import shared_bucket
 from storage.dgg_file_structure import log_path
+from storage.estimate_store import open_store
+from storage.estimate_store import store_kinds
 
 logger = root_logger.getChild(__name__)
 
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--store', choices=store_kinds, default='json', help='kind of estimate store to collect into')
+	arguments = parser.parse_args()
 	date_stamp = str(datetime.date.today().isoformat())
 	batch_s3_folder = 'data/{date_stamp}'.format(date_stamp=date_stamp)
 	log_filepath = ''
 	try:
 		log_filepath = logging_setup(log_path)
 
-		session = FacebookCollection(date_stamp)
+		session = FacebookCollection(date_stamp, resume=True, store=open_store(arguments.store, date_stamp))
 		session.create_target_queue()
 		session.collect()
 
@@ -32,7 +38,7 @@ if __name__ == "__main__":
 		r_analysis_wrapper.predict(date_stamp, 'dau')
 
 		# model index
-		s3_bucket = S3Bucket()
+		s3_bucket = shared_bucket()
 		index = ModelIndexFile(s3_bucket, 'data/models.json')
 		index.add_latest(date_stamp, mau_key)
 
@@ -44,5 +50,5 @@ if __name__ == "__main__":
 	finally:
 		with open(log_filepath, 'rb') as file:
 			key = '{folder}/{filename}'.format(folder=batch_s3_folder, filename=os.path.basename(log_filepath))
-			s3_bucket = S3Bucket()
+			s3_bucket = shared_bucket()
 			s3_bucket.put(key, file)
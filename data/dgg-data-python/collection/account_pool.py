@@ -0,0 +1,133 @@
+"""Classes for scheduling requests across a pool of Facebook ad accounts, each with its own access token"""
+import glob
+import json
+import os
+import time
+
+from facebook_business.adobjects.adaccount import AdAccount
+from facebook_business.api import FacebookAdsApi
+from facebook_business.api import FacebookSession
+
+from storage.dgg_file_structure import auth_path
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+facebook_app_auth = os.path.join(auth_path, 'app.json')
+facebook_token_pattern = os.path.join(auth_path, '*_token.json')
+
+# How long an ad account is rested after reaching its call limit when the API gives no better estimate
+account_cooldown = (5*60) + 1
+
+
+def token_files(token_pattern=facebook_token_pattern):
+	"""List the token files matching the pattern, main and backup first if present"""
+	def token_order(filepath):
+		name = os.path.basename(filepath)
+		return ['main_token.json', 'backup_token.json', name].index(name), name
+
+	return sorted(glob.glob(token_pattern), key=token_order)
+
+
+class PooledAdAccount:
+	"""Represents an ad account in the pool, tracking when it is next available and how many requests it has in flight"""
+	def __init__(self, name, account, api):
+		self.name = name
+		self.account = account
+		self.api = api
+		self.available_time = 0
+		self.in_flight = 0
+		self.expired = False
+		self.usage = None
+
+	def __getitem__(self, key):
+		return self.account[key]
+
+	def __repr__(self):
+		return '<PooledAdAccount {name} {id}>'.format(name=self.name, id=self.account['id'])
+
+	def get_delivery_estimate(self, params):
+		"""Request a delivery estimate using this ad account"""
+		return self.account.get_delivery_estimate(params=params)
+
+
+class AdAccountPool:
+	"""
+	Represents the ad accounts available to a collection.
+	Requests are always given the account that is soonest available, accounts that reach their call limit are rested
+	until their cooldown expires.
+	"""
+	def __init__(self, accounts):
+		self.accounts = list(accounts)
+		if not self.accounts:
+			raise ValueError('No ad accounts in pool')
+
+	@classmethod
+	def from_auth_folder(cls, app_filepath=facebook_app_auth, token_pattern=facebook_token_pattern):
+		"""
+		Load every token file matching the pattern in the auth folder into a pool.
+		Adding another '<name>_token.json' file adds another account, main and backup are used first if present.
+		"""
+		return cls.from_token_files(token_files(token_pattern), app_filepath)
+
+	@classmethod
+	def from_token_files(cls, token_filepaths, app_filepath=facebook_app_auth):
+		"""Load the given token files into a pool, in order"""
+		with open(app_filepath, 'r') as app_file:
+			app_dict = json.load(app_file)
+
+		accounts = []
+		for token_filepath in token_filepaths:
+			with open(token_filepath, 'r') as token_file:
+				token_dict = json.load(token_file)
+			name = os.path.basename(token_filepath)[:-len('_token.json')]
+			session = FacebookSession(**app_dict, access_token=token_dict['token'])
+			api = FacebookAdsApi(session)
+			accounts += [PooledAdAccount(name, AdAccount(token_dict['account'], api=api), api)]
+			logger.info('Loaded ad account {name} from {file}'.format(name=name, file=token_filepath))
+		return cls(accounts)
+
+	def __len__(self):
+		return len(self.accounts)
+
+	def active_accounts(self):
+		"""List the accounts whose credentials have not expired"""
+		return [account for account in self.accounts if not account.expired]
+
+	def api(self):
+		"""Get an API session for requests that are not tied to an ad account, e.g. targeting searches"""
+		return self.next_account().api
+
+	def next_account(self, capacity=None):
+		"""
+		Get the account that is soonest available, preferring the account with the fewest requests in flight.
+		When capacity is given, accounts with that many requests already in flight are skipped and None is returned
+		if every account is busy.
+		"""
+		accounts = self.active_accounts()
+		if not accounts:
+			raise RuntimeError('Credentials for every ad account in the pool have expired')
+		if capacity is not None:
+			accounts = [account for account in accounts if account.in_flight < capacity]
+			if not accounts:
+				return None
+		now = time.time()
+		return min(accounts, key=lambda account: (max(account.available_time, now), account.in_flight))
+
+	def wait_time(self):
+		"""Number of seconds until the soonest available account frees up"""
+		return max(0, min(account.available_time for account in self.active_accounts()) - time.time())
+
+	def pace(self, account, seconds):
+		"""Hold back the next request on an account for the given number of seconds to keep it under its call limit"""
+		account.available_time = max(account.available_time, time.time() + seconds)
+
+	def cooldown(self, account, seconds=account_cooldown):
+		"""Rest an account that has reached its call limit for the given number of seconds"""
+		account.available_time = max(account.available_time, time.time() + seconds)
+		logger.info('Resting ad account {name} for {x} s'.format(name=account.name, x=round(seconds)))
+
+	def expire(self, account):
+		"""Remove an account with expired credentials from use"""
+		account.expired = True
+		logger.warning('Ad account {name} credentials expired, {n} accounts remaining'.format(name=account.name, n=len(self.active_accounts())))
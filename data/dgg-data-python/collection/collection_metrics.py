@@ -0,0 +1,148 @@
+"""Classes for measuring where the time goes in a collection, written to a JSON metrics file as the collection runs"""
+import bisect
+import collections
+import json
+import os
+import threading
+import time
+
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket holds everything slower
+latency_buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class LatencyHistogram:
+	"""Represents the distribution of call latencies as counts in fixed buckets"""
+	def __init__(self, buckets=latency_buckets):
+		self.buckets = list(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def observe(self, seconds):
+		"""Add a call latency to the histogram"""
+		self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+
+	def to_dict(self):
+		labels = ['<={b}'.format(b=bucket) for bucket in self.buckets] + ['>{b}'.format(b=self.buckets[-1])]
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count else 0,
+			'max': self.max,
+			'buckets': dict(zip(labels, self.counts)),
+		}
+
+
+class CollectionMetrics:
+	"""
+	Represents the metrics of a collection: call latencies, failures by API error code or failure kind, calls and
+	errors per ad account, seconds slept by cause and throughput per country.
+	Updated from the executor threads as well as the event loop so every update holds the lock. The metrics file is
+	rewritten at most every interval seconds while the collection runs, and once more at the end.
+	"""
+	def __init__(self, filepath, interval=60):
+		self.filepath = filepath
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.start_time = time.time()
+		self.write_time = 0
+		self.latency = LatencyHistogram()
+		self.calls = 0
+		self.requests_sent = 0
+		self.estimates = 0
+		self.duplicates = 0
+		self.failures = collections.Counter()
+		self.accounts = collections.defaultdict(collections.Counter)
+		self.sleep = collections.Counter()
+		self.countries = {}
+
+	def record_call(self, account, requests, seconds):
+		"""Record one delivery estimate call, or batch call, of the given number of requests and its latency"""
+		with self.lock:
+			self.latency.observe(seconds)
+			self.calls += 1
+			self.requests_sent += len(requests)
+			self.accounts[account.name]['calls'] += 1
+			self.accounts[account.name]['requests'] += len(requests)
+			now = time.time()
+			for request in requests:
+				country = self.country(request.country, now)
+				country['requests'] += 1
+				country['last'] = now
+
+	def record_estimate(self, request):
+		"""Record a completed request"""
+		with self.lock:
+			self.estimates += 1
+			now = time.time()
+			country = self.country(request.country, now)
+			country['completed'] += 1
+			country['last'] = now
+
+	def record_duplicate(self):
+		"""Record a request answered from the spec index without being sent"""
+		with self.lock:
+			self.duplicates += 1
+
+	def record_failure(self, error, account=None):
+		"""Record a failed request by its API error code or kind of failure"""
+		with self.lock:
+			self.failures[str(error)] += 1
+			if account:
+				self.accounts[account.name]['error {e}'.format(e=error)] += 1
+
+	def record_sleep(self, cause, seconds):
+		"""Record time spent, or scheduled to be spent, waiting rather than sending requests"""
+		if seconds > 0:
+			with self.lock:
+				self.sleep[cause] += seconds
+
+	def country(self, alpha2, now):
+		"""Get the counters for a country, the lock must be held"""
+		if alpha2 not in self.countries:
+			self.countries[alpha2] = {'requests': 0, 'completed': 0, 'first': now, 'last': now}
+		return self.countries[alpha2]
+
+	def sleep_time(self):
+		"""Total seconds the workers spent asleep"""
+		return sum(seconds for cause, seconds in self.sleep.items() if not cause.startswith('scheduled'))
+
+	def to_dict(self):
+		with self.lock:
+			elapsed = time.time() - self.start_time
+			return {
+				'elapsed': elapsed,
+				'calls': self.calls,
+				'requests_sent': self.requests_sent,
+				'estimates': self.estimates,
+				'duplicates': self.duplicates,
+				'estimates_per_second': self.estimates / elapsed if elapsed else 0,
+				'latency': self.latency.to_dict(),
+				'failures': dict(self.failures),
+				'accounts': {name: dict(counts) for name, counts in self.accounts.items()},
+				'sleep': dict(self.sleep),
+				'countries': {alpha2: dict(country, estimates_per_second=country['completed'] / max(country['last'] - country['first'], 1)) for alpha2, country in self.countries.items()},
+			}
+
+	def write(self):
+		"""Write the metrics file, replacing it in one step so it is never read half written"""
+		temp_filepath = self.filepath + '.tmp'
+		with open(temp_filepath, 'w') as file:
+			json.dump(self.to_dict(), file, indent=1)
+		os.replace(temp_filepath, self.filepath)
+		self.write_time = time.time()
+
+	def update(self):
+		"""Write the metrics file if it has not been written in the last interval seconds"""
+		if time.time() - self.write_time >= self.interval:
+			try:
+				self.write()
+			except OSError:
+				logger.exception('Could not write metrics file {filepath}'.format(filepath=self.filepath))
@@ -0,0 +1,98 @@
+"""Class for projecting when a collection will finish from its measured throughput, and shedding work that will not fit"""
+import collections
+import datetime
+import time
+
+from collection.facebook_requests import low_value_behavior_ids
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+
+class DeadlinePlanner:
+	"""
+	Projects the finish time of a collection from the rate requests have been finished at over the last window
+	seconds, and logs it as an ETA every report_interval seconds.
+	While the projection overshoots the deadline by more than margin seconds, requests for the behaviours in
+	shed_behavior_ids are shed: they are deferred to the end of the collection and only sent if time remains, so the
+	core age and gender cells are collected first. Once the collection reaches its deferred requests, end_shedding stops
+	any more being shed until the next run starts with reset.
+	"""
+	def __init__(self, deadline, shed_behavior_ids=low_value_behavior_ids, window=15*60, margin=10*60, report_interval=5*60):
+		self.deadline = deadline
+		self.shed_behavior_ids = set(shed_behavior_ids)
+		self.window = window
+		self.margin = margin
+		self.report_interval = report_interval
+		self.reset()
+
+	def reset(self):
+		"""Start planning a new run of the collection, forgetting the requests planned and finished by any earlier run"""
+		self.planned = 0
+		self.done = 0
+		self.finished_times = collections.deque()
+		self.start_time = time.time()
+		self.report_time = self.start_time
+		self.shedding = False
+		self.sending_deferred = False
+
+	def end_shedding(self):
+		"""Stop shedding requests for the rest of this run, once only the deferred requests are left to send"""
+		self.sending_deferred = True
+
+	def plan(self, requests):
+		"""Add requests to the number the collection is expected to finish"""
+		self.planned += requests
+
+	def finish(self, requests=1, measured=True):
+		"""
+		Count requests as finished, completed or given up on.
+		Requests that were finished without being sent, e.g. skipped on resume, are not measured towards the throughput
+		"""
+		self.done += requests
+		if measured:
+			now = time.time()
+			self.finished_times.extend([now] * requests)
+
+	def remaining(self):
+		"""Number of planned requests not yet finished"""
+		return max(0, self.planned - self.done)
+
+	def throughput(self):
+		"""Requests finished per second over the last window, None until the first request is finished"""
+		now = time.time()
+		while self.finished_times and self.finished_times[0] < now - self.window:
+			self.finished_times.popleft()
+		if not self.finished_times:
+			return None
+		return len(self.finished_times) / max(min(self.window, now - self.start_time), 1)
+
+	def eta(self):
+		"""Projected finish time of the remaining requests, None if there is no throughput to project from"""
+		throughput = self.throughput()
+		if not throughput:
+			return None
+		return datetime.datetime.now() + datetime.timedelta(seconds=self.remaining() / throughput)
+
+	def update(self):
+		"""Re-project the finish time, deciding whether to shed low value requests, and log the ETA when it is due"""
+		eta = self.eta()
+		if eta is None:
+			return
+		shedding = eta > self.deadline + datetime.timedelta(seconds=self.margin)
+		if shedding != self.shedding:
+			self.shedding = shedding
+			if shedding:
+				logger.warning('Projected finish {eta:%H:%M} is after the {deadline:%H:%M} deadline, deferring low value behaviours'.format(eta=eta, deadline=self.deadline))
+			else:
+				logger.info('Projected finish {eta:%H:%M} is within the deadline again, no longer deferring low value behaviours'.format(eta=eta))
+		now = time.time()
+		if now - self.report_time >= self.report_interval:
+			self.report_time = now
+			logger.info('{x}/{n} requests finished at {r:.2f}/s, ETA {eta:%H:%M}, deadline {deadline:%H:%M}'.format(
+				x=self.done, n=self.planned, r=self.throughput(), eta=eta, deadline=self.deadline
+			))
+
+	def shed(self, request):
+		"""Check whether the request should be deferred while the collection is running behind"""
+		return self.shedding and not self.sending_deferred and request.behavior is not None and request.behavior.get('id') in self.shed_behavior_ids
@@ -0,0 +1,138 @@
+"""
+Class for running a collection on several machines coordinated through a shared work queue.
+One coordinator fills the queue with the units of work for the day, any number of workers, each with its own app
+token, lease units from it until it is empty, and the coordinator merges the workers' results into the day's store.
+"""
+import argparse
+import datetime
+import os
+import socket
+import threading
+import time
+
+from storage.dgg_file_structure import data_path
+from storage.dgg_file_structure import log_path
+from dgg_log import logging_setup
+from collection.account_pool import AdAccountPool
+from collection.facebook_collector import FacebookCollection
+from collection.facebook_collector import default_deadline
+from collection.facebook_collector import fetch_countries
+from collection.facebook_requests import priorities
+from collection.targeting_cache import TargetingCache
+from storage.S3_bucket import shared_bucket
+from storage.estimate_store import FacebookEstimateJsonStore
+from storage.work_queue import DirectoryWorkQueue
+from storage.work_queue import S3WorkQueue
+from storage.work_queue import SQLiteWorkQueue
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+
+def open_work_queue(location):
+	"""Open a work queue from a location, 'sqlite:<file>', 'dir:<folder>' or 's3:<prefix>' in our usual bucket"""
+	backend, _, address = location.partition(':')
+	if backend == 'sqlite':
+		return SQLiteWorkQueue(address)
+	elif backend == 'dir':
+		return DirectoryWorkQueue(address)
+	elif backend == 's3':
+		return S3WorkQueue(shared_bucket(), address)
+	raise ValueError('Unknown work queue backend {backend}'.format(backend=backend))
+
+
+class DistributedCollection:
+	"""
+	Represents one machine's part in a collection shared through a work queue.
+	Workers lease lease_size (country code, priority) units at a time for lease_timeout seconds, renewing the leases
+	while they collect so only the units of a worker that has died go back on the queue. After each lease a worker
+	puts its partial store in the queue, the coordinator merges them once the queue is empty or the deadline passes.
+	Any other kwargs are passed on to the FacebookCollection.
+	"""
+	def __init__(self, batch_string, queue, worker=None, lease_size=5, lease_timeout=30*60, poll_interval=60, path=data_path, upload=True, **collection_kwargs):
+		self.batch_string = batch_string
+		self.queue = queue
+		self.worker = worker or '{host}-{pid}'.format(host=socket.gethostname(), pid=os.getpid())
+		self.lease_size = lease_size
+		self.lease_timeout = lease_timeout
+		self.poll_interval = poll_interval
+		self.path = path
+		self.upload = upload
+		self.collection_kwargs = collection_kwargs
+
+	def coordinate(self):
+		"""Fill the queue with every unit of the collection, units already in the queue are kept as they are"""
+		# only the countries are needed, a collection would open a journal and store for the batch in path
+		pool = self.collection_kwargs.get('account_pool') or AdAccountPool.from_auth_folder()
+		targeting_cache = self.collection_kwargs.get('targeting_cache') or TargetingCache()
+		countries = fetch_countries(pool, targeting_cache)
+		# in collection order, as FacebookCollection.units gives them
+		units = [(country['country_code'], priority) for priority in priorities for country in countries]
+		self.queue.add(units)
+		logger.info('Queued {n} units of work for {batch}'.format(n=len(units), batch=self.batch_string))
+
+	def work(self):
+		"""Lease and collect units until the queue is empty or the deadline has passed"""
+		folder = os.path.join(self.path, 'workers_{batch}'.format(batch=self.batch_string), self.worker)
+		os.makedirs(folder, exist_ok=True)
+		collection = FacebookCollection(self.batch_string, resume=True, path=folder, upload=False, **self.collection_kwargs)
+		while datetime.datetime.now() < collection.deadline:
+			units = self.queue.lease(self.worker, self.lease_size, self.lease_timeout)
+			if not units:
+				remaining = self.queue.remaining()
+				if not remaining:
+					break
+				logger.info('{n} units leased to other workers, waiting {x} s'.format(n=remaining, x=self.poll_interval))
+				time.sleep(self.poll_interval)
+				continue
+			logger.info('Worker {worker} leased {units}'.format(worker=self.worker, units=units))
+			stop = threading.Event()
+			heartbeat = threading.Thread(target=self.renew, args=(units, stop), name='lease-heartbeat', daemon=True)
+			heartbeat.start()
+			try:
+				collection.collect(units)
+			finally:
+				stop.set()
+				heartbeat.join()
+			self.queue.put_result(self.worker, collection.store.dictionary)
+			self.queue.complete(self.worker, units)
+		logger.info('Worker {worker} finished'.format(worker=self.worker))
+
+	def renew(self, units, stop):
+		"""Renew the leases on the units until stopped, run in a background thread"""
+		while not stop.wait(self.lease_timeout / 3):
+			try:
+				self.queue.renew(self.worker, units, self.lease_timeout)
+			except Exception:
+				logger.exception('Could not renew leases on {units}'.format(units=units))
+
+	def merge(self, deadline=None):
+		"""Wait for the queue to empty, or the deadline to pass, then merge every worker's results into the day's store"""
+		deadline = deadline or datetime.datetime.combine(datetime.date.today(), default_deadline)
+		while self.queue.remaining() and datetime.datetime.now() < deadline:
+			time.sleep(min(self.poll_interval, max(0, (deadline - datetime.datetime.now()).total_seconds())))
+		if self.queue.remaining():
+			logger.warning('{n} units not done by the deadline'.format(n=self.queue.remaining()))
+		store = FacebookEstimateJsonStore(os.path.join(self.path, 'store_{batch}.json'.format(batch=self.batch_string)))
+		workers = 0
+		for dictionary in self.queue.results():
+			store.merge(dictionary)
+			workers += 1
+		logger.info('Merged the results of {n} workers into {filepath}'.format(n=workers, filepath=store.filepath))
+		if self.upload:
+			store.upload(shared_bucket(), self.batch_string)
+		else:
+			store.write()
+		return store
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('role', choices=['coordinate', 'work', 'merge'])
+	parser.add_argument('queue', help="'sqlite:<file>', 'dir:<folder>' or 's3:<prefix>'")
+	parser.add_argument('--batch', default=str(datetime.date.today().isoformat()))
+	parser.add_argument('--worker', help='name of this worker, host and process id by default')
+	arguments = parser.parse_args()
+	logging_setup(log_path)
+	distributed = DistributedCollection(arguments.batch, open_work_queue(arguments.queue), worker=arguments.worker)
+	getattr(distributed, arguments.role)()
@@ -1,266 +1,716 @@
 """Class for collecting reach estimates from the Facebook Marketing API. Run to collect a dataset for today."""
-from collections import deque
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import csv
 import datetime
+import itertools
 import json
 import os
 import time
 
-from facebook_business.adobjects.adaccount import AdAccount
 from facebook_business.adobjects.targetingsearch import TargetingSearch
-from facebook_business.api import FacebookAdsApi
-from facebook_business.api import FacebookSession
 from facebook_business.exceptions import FacebookRequestError
 
-from storage.dgg_file_structure import auth_path
 from storage.dgg_file_structure import data_path
 from dgg_log import logging_setup
+from collection.account_pool import AdAccountPool
+from collection.collection_metrics import CollectionMetrics
+from collection.deadline_planner import DeadlinePlanner
+from collection.facebook_requests import country_target_queue_size
+from collection.facebook_requests import behaviors_default
 from collection.facebook_requests import create_country_target_queue
-from storage.S3_bucket import S3Bucket
+from collection.facebook_requests import priorities
+from collection.facebook_requests import validate_behaviors
+from collection.request_scheduler import RetryQueue
+from collection.request_scheduler import schedule_retry
+from collection.targeting_cache import TargetingCache
+from collection.throttle import UsageThrottle
+from collection.zero_policy import EstimateHistory
+from collection.zero_policy import ZeroPopulationPolicy
+from collection.throttle import parse_usage_headers
+from storage.S3_bucket import shared_bucket
 from storage import estimate_store
+from storage.estimate_journal import EstimateJournal
+from storage.spec_index import SpecIndex
 from dgg_log import root_logger
 
 logger = root_logger.getChild(__name__)
 
-facebook_app_auth = os.path.join(auth_path, 'app.json')
-facebook_main_auth = os.path.join(auth_path, 'main_token.json')
-facebook_backup_auth = os.path.join(auth_path, 'backup_token.json')
+# Graph API limit on the number of requests in a batch call
+max_batch_size = 50
+# Longest backoff that collection of a priority tier waits for before leaving a request to the final retries
+priority_retry_wait = 60
+# Time of day after which failed requests are no longer retried, leaving time for the analysis
+default_deadline = datetime.time(hour=23)
+
+
+def fetch_countries(pool, targeting_cache):
+	"""
+	Fetch the current list of countries with an ad account from the pool.
+	In practice this will rarely change but any change to the list will be handled without requiring code changes.
+	The list comes from the targeting cache when possible, if it cannot be searched for and nothing is cached the
+	ISO 3166 list in the data folder is used instead.
+	"""
+	try:
+		return targeting_cache.search({
+			'q': '',
+			'type': TargetingSearch.TargetingSearchTypes.country,
+			'limit': 1000,
+		}, pool.api())
+	except FacebookRequestError as e:
+		if e.api_error_code() == 190:
+			logger.error('(API Error 190) Ad account credentials expired while fetching countries list')
+		else:
+			logger.exception('Unknown Marketing API error while fetching countries list')
+	except Exception:
+		logger.exception('Unknown error while fetching countries list')
+	# TODO email error email
+	try:
+		with open(os.path.join(data_path, 'countries.json'), 'r') as file:
+			countries = [{'country_code': alpha2, 'name': country[0]} for alpha2, country in json.load(file).items()]
+		logger.warning('Using the {n} countries in countries.json instead'.format(n=len(countries)))
+		return countries
+	except (OSError, ValueError):
+		logger.exception('Could not read countries.json, cannot continue')
+		raise SystemExit
 
 
 class FacebookCollection:
-	"""Represents a collection session"""
-	def __init__(self, batch_string, access_token=None):
+	"""
+	Represents a collection session.
+	requests_per_account sets how many requests may be in flight on each ad account in the pool at once,
+	throttle paces the requests using the usage headers of each response,
+	resume skips any requests already satisfied by the spec index, store or journal for the batch when the queue is
+	created, requests for a targeting spec already in the index are answered from it without an API call either way,
+	batch_size packs up to that many requests into each Graph API batch call, 1 sends each request on its own,
+	priority_attempts limits how many times a request is tried before collection moves on to the next priority,
+	max_attempts limits how many times a request is tried in total before it is given up on,
+	zero_policy decides when a zero sized population is accepted as the estimate,
+	targeting_cache holds the results of targeting searches such as the countries list between runs,
+	behaviors is the list of behaviours to collect, checked against the behaviours available before collection starts,
+	deadline is the datetime after which failed requests are no longer retried, by default 23:00 today,
+	planner projects the finish time against the deadline and defers low value behaviours when it will overshoot,
+	store is the estimate store to collect into, by default a JSON store in path written once at the end, the journal
+	keeps every estimate durable as it arrives and is replayed into the store on a restart,
+	path is the folder holding the store, journal and metrics file for the batch, upload sends the
+	finished store to the S3 bucket
+	"""
+	def __init__(self, batch_string, access_token=None, requests_per_account=1, account_pool=None, throttle=None, resume=False, batch_size=1, priority_attempts=3, max_attempts=100, zero_policy=None, targeting_cache=None, behaviors=behaviors_default, deadline=None, planner=None, store=None, path=data_path, upload=True):
 		# if access_token:
 			# self.access_token = access_token
 		# else:
-		with open(facebook_app_auth, 'r') as app_file, open(facebook_main_auth, 'r') as main_token_file, open(facebook_backup_auth, 'r') as backup_token_file:
-			app_dict = json.load(app_file)
-			main_dict = json.load(main_token_file)
-			backup_dict = json.load(backup_token_file)
-
-			main_session = FacebookSession(**app_dict, access_token=main_dict['token'])
-			backup_session = FacebookSession(**app_dict, access_token=backup_dict['token'])
-
-			self.main_api = FacebookAdsApi(main_session)
-			self.backup_api = FacebookAdsApi(backup_session)
-
-			self.main_account = AdAccount(main_dict['account'], api=self.main_api)
-			self.backup_account = AdAccount(backup_dict['account'], api=self.backup_api)
+		if account_pool:
+			self.pool = account_pool
+		else:
+			self.pool = AdAccountPool.from_auth_folder()
 		# if not self.access_token:
 			# raise ValueError('No access token')
 
 		self.sleep = 0
-		self.usemain = True
-		self.account = self.main_account
-		self.main_last_error = time.time()
+		self.resume_time = 0
+		self.requests_per_account = requests_per_account
+		self.account_released = None
+		if not 1 <= batch_size <= max_batch_size:
+			raise ValueError('Batch size must be between 1 and {n}'.format(n=max_batch_size))
+		self.batch_size = batch_size
+		self.priority_attempts = priority_attempts
+		self.max_attempts = max_attempts
+		if zero_policy:
+			self.zero_policy = zero_policy
+		else:
+			self.zero_policy = ZeroPopulationPolicy(history=EstimateHistory(batch_string))
+		if targeting_cache:
+			self.targeting_cache = targeting_cache
+		else:
+			self.targeting_cache = TargetingCache()
+		self.behaviors = behaviors
+		self.behaviors_validated = False
+		if throttle:
+			self.throttle = throttle
+		else:
+			self.throttle = UsageThrottle()
+		if deadline:
+			self.deadline = deadline
+		else:
+			self.deadline = datetime.datetime.combine(datetime.date.today(), default_deadline)
+		if planner:
+			self.planner = planner
+		else:
+			self.planner = DeadlinePlanner(self.deadline)
+		self.deferred = []
+		self.upload = upload
 		self.queues = []
 		self.countries = []
 		self.batch_string = batch_string
-		store_path = os.path.join(data_path, 'store_{timestamp}.json'.format(timestamp=batch_string))
-		self.store = estimate_store.FacebookEstimateJsonStore(store_path)
-
-	def handle_request_limit(self):
-		"""Switch ad accounts to another available account or sleep if we have none left"""
-		if self.usemain:
-			self.usemain = False
-			self.account = self.backup_account
-			self.main_last_error = time.time()
-			logger.info('Switching to backup account')
-		elif time.time() - self.main_last_error > ((5*60) + 1):
-			self.usemain = True
-			self.account = self.main_account
-			logger.info('Returning to main account')
+		if store is not None:
+			self.store = store
 		else:
-			self.sleep = ((5*60) + 1)
-			logger.warning('Both ad accounts over use limit')
-			logger.info('sleeping {x} s'.format(x=self.sleep))
-			time.sleep(self.sleep)
+			store_path = os.path.join(path, 'store_{timestamp}.json'.format(timestamp=batch_string))
+			self.store = estimate_store.FacebookEstimateJsonStore(store_path)
+		self.resume = resume
+		self.failed = set()
+		self.skipped = 0
+		journal_path = os.path.join(path, 'journal_{timestamp}.jsonl'.format(timestamp=batch_string))
+		self.journal = EstimateJournal(journal_path)
+		metrics_path = os.path.join(path, 'metrics_{timestamp}.json'.format(timestamp=batch_string))
+		self.metrics = CollectionMetrics(metrics_path)
+		index_path = os.path.join(path, 'spec_index_{timestamp}.json'.format(timestamp=batch_string))
+		self.index = SpecIndex(index_path)
+		if self.resume:
+			self.index.read()
+		self.replay_journal()
+
+	def replay_journal(self):
+		"""Restore any progress recorded in the journal for this batch into the store"""
+		replayed = 0
+		for entry in self.journal.entries():
+			dimensions = (entry['country'], entry['gender'], entry['age_min'], entry['age_max'], entry['behaviour'])
+			if entry.get('failed'):
+				self.failed.add(dimensions)
+			else:
+				zero_accepted = entry.get('zero_accepted', False)
+				# a store with a log of its own has already recovered its estimates, adding them again would log them again
+				if not self.store.has_entry(*dimensions):
+					self.store.add_entry(*dimensions, entry['estimate_dau'], entry['estimate_mau'], timestamp=entry['timestamp'], zero_accepted=zero_accepted)
+				# estimates from an earlier run only answer requests when resuming
+				if self.resume and 'spec_hash' in entry:
+					self.index.add(entry['spec_hash'], entry['estimate_dau'], entry['estimate_mau'], entry['timestamp'], zero_accepted)
+			replayed += 1
+		if replayed:
+			logger.info('Replayed {x} entries from journal {filepath}'.format(x=replayed, filepath=self.journal.filepath))
+
+	def record_estimate(self, request, dau, mau, zero_accepted=False):
+		"""
+		Store the estimate for a completed request, index it by its targeting spec and append it to the journal.
+		zero_accepted flags a zero sized population accepted by the zero policy
+		"""
+		country, gender, age_min, age_max, behaviour = request.dimensions()
+		spec_hash = request.spec_hash
+		self.store.add_entry(country, gender, age_min, age_max, behaviour, dau, mau, timestamp=request.timestamp, zero_accepted=zero_accepted)
+		self.index.add(spec_hash, dau, mau, request.timestamp, zero_accepted)
+		self.metrics.record_estimate(request)
+		self.planner.finish()
+		entry = {
+			'country': country, 'gender': gender, 'age_min': age_min, 'age_max': age_max, 'behaviour': behaviour,
+			'estimate_dau': dau, 'estimate_mau': mau, 'timestamp': request.timestamp, 'spec_hash': spec_hash
+		}
+		if zero_accepted:
+			entry['zero_accepted'] = True
+		self.journal.append(entry)
+
+	def answer_from_index(self, request):
+		"""
+		Complete the request from the spec index if an estimate for the same targeting spec has already been collected,
+		filing it under the request's own dimensions. Returns whether the request was answered
+		"""
+		estimate = self.index.get(request.spec_hash)
+		if estimate is None:
+			return False
+		request.timestamp = estimate['timestamp']
+		request.completed = True
+		request.valid = True
+		dimensions = request.dimensions()
+		if not self.store.has_entry(*dimensions):
+			country, gender, age_min, age_max, behaviour = dimensions
+			zero_accepted = estimate.get('zero_accepted', False)
+			self.store.add_entry(*dimensions, estimate['estimate_dau'], estimate['estimate_mau'], timestamp=request.timestamp, zero_accepted=zero_accepted)
+			entry = {
+				'country': country, 'gender': gender, 'age_min': age_min, 'age_max': age_max, 'behaviour': behaviour,
+				'estimate_dau': estimate['estimate_dau'], 'estimate_mau': estimate['estimate_mau'],
+				'timestamp': request.timestamp, 'spec_hash': request.spec_hash
+			}
+			if zero_accepted:
+				entry['zero_accepted'] = True
+			self.journal.append(entry)
+		self.metrics.record_duplicate()
+		self.planner.finish(measured=False)
+		return True
+
+	def record_failure(self, request):
+		"""Journal a request that has been given up on so that a resumed collection does not send it again"""
+		dimensions = request.dimensions()
+		country, gender, age_min, age_max, behaviour = dimensions
+		self.failed.add(dimensions)
+		self.planner.finish()
+		self.journal.append({
+			'country': country, 'gender': gender, 'age_min': age_min, 'age_max': age_max, 'behaviour': behaviour,
+			'failed': True, 'timestamp': request.timestamp
+		})
+
+	def satisfied(self, request):
+		"""Check whether the request has already been answered, or given up on, earlier in this batch"""
+		return request.spec_hash in self.index or self.store.has_entry(*request.dimensions()) or request.dimensions() in self.failed
+
+	def pause(self, seconds):
+		"""Hold back any new requests for the given number of seconds"""
+		self.sleep = seconds
+		self.resume_time = max(self.resume_time, time.time() + seconds)
+		self.metrics.record_sleep('scheduled app pause', seconds)
+		logger.info('sleeping {x} s'.format(x=seconds))
+
+	def record_usage(self, account, headers):
+		"""Pace the account, and every account for app level usage, according to the usage headers of a response"""
+		report = parse_usage_headers(headers)
+		account.usage = report
+		self.pool.pace(account, self.throttle.account_delay(report))
+		self.resume_time = max(self.resume_time, time.time() + self.throttle.app_delay(report))
+		logger.debug('Ad account {name} usage {report}'.format(name=account.name, report=report))
+		return report
 
-	def get_estimate(self, request):
-		"""Send the given request to the server and validate the response. Store the response if valid."""
+	def handle_request_limit(self, account, report):
+		"""Rest the throttled ad account, requests move to the other accounts or wait until the soonest one frees up"""
+		if report.regain_seconds:
+			self.pool.cooldown(account, report.regain_seconds)
+		else:
+			self.pool.cooldown(account)
+		self.metrics.record_sleep('scheduled account cooldown', account.available_time - time.time())
+		wait = self.pool.wait_time()
+		if wait > 0:
+			logger.warning('All ad accounts over use limit')
+			logger.info('sleeping {x} s until the next account is available'.format(x=round(wait)))
+
+	def send_request(self, request, account):
+		"""Send the given request to the server with the given ad account, blocking until the response arrives"""
+		# response = my_account.get_reach_estimate(params=params)
+		request.attempts += 1
+		start = time.time()
 		try:
-			# response = my_account.get_reach_estimate(params=params)
+			request.response = account.get_delivery_estimate(params=request.params)
+		finally:
+			self.metrics.record_call(account, [request], time.time() - start)
+
+	def send_batch(self, requests, account):
+		"""
+		Send the given requests to the server with the given ad account as a single Graph API batch call.
+		Returns the response to each request in order, None where the batch gave no response for a request.
+		"""
+		batch = account.api.new_batch()
+		responses = [None] * len(requests)
+		for index, request in enumerate(requests):
+			def store_response(response, index=index):
+				responses[index] = response
 			request.attempts += 1
-			request.response = self.account.get_delivery_estimate(params=request.params)
-		except FacebookRequestError as e:
-			# print(response)
-			# https://developers.facebook.com/docs/marketing-api/error-reference/
-			# https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling/
-			if e.api_error_code() == 1:
-				logger.warning('(API Error 1) Unknown server error, continuing')
-			elif e.api_error_code() == 2:
-				logger.warning('(API Error 2) Marketing API service unavailable, retrying')
-			elif e.api_error_code() == 4:
-				# TODO application call limit, how long do we need to wait?
-				sleeptime = 600
-				logger.warning('(API Error 4) Application call limit reached, sleeping for {n} s'.format(n=sleeptime))
-				time.sleep(sleeptime)
-			elif e.api_error_code() == 10:
-				logger.exception('(API Error 10) ??? Unhandled exception')
-				raise e
-			elif e.api_error_code() == 17:
-				logger.warning('(API Error 17) Account call limit reached')
-				self.handle_request_limit()
-			elif e.api_error_code() == 100:
-				logger.exception('(API Error 100) Invalid parameter, inputs need updating')
-				# TODO error stats
-				# self.store.record_error(request['code'])
-				request.complete()
-			elif e.api_error_code() == 102:
-				logger.exception('(API Error 102) ??? Unhandled exception')
-				raise e
-			elif e.api_error_code() == 104:
-				logger.exception('(API Error 104) ??? Unhandled exception')
-				raise e
-			elif e.api_error_code() == 190:
-				if self.usemain:
-					self.usemain = False
-					logger.warning('(API Error 190) Main account credentials expired, switching to backup account')
-					self.account = self.backup_account
+			account.account.get_delivery_estimate(params=request.params, batch=batch, success=store_response, failure=store_response)
+		start = time.time()
+		try:
+			batch.execute()
+		finally:
+			self.metrics.record_call(account, requests, time.time() - start)
+		return responses
+
+	def handle_batch_responses(self, requests, responses, account):
+		"""Handle the response to each request in a batch call as if it had been sent individually"""
+		for request, response in zip(requests, responses):
+			if response is None:
+				logger.warning('No response to request in batch call, retrying')
+				request.fail('no_response')
+				self.metrics.record_failure(request.error, account)
+			elif response.is_success():
+				request.response = response.json()['data']
+				self.record_usage(account, response.headers())
+				self.validate_response(request)
+			else:
+				try:
+					raise response.error()
+				except Exception as e:
+					self.handle_request_exception(request, e, account)
+
+	async def acquire_account(self):
+		"""Wait for the ad account that is soonest available to have a free slot, and claim the slot"""
+		while True:
+			account = self.pool.next_account(capacity=self.requests_per_account)
+			if account is None:
+				async with self.account_released:
+					await self.account_released.wait()
+				continue
+			wait = max(self.resume_time, account.available_time) - time.time()
+			if wait > 0:
+				self.metrics.record_sleep(self.wait_cause(account), wait)
+				await asyncio.sleep(wait)
+				continue
+			account.in_flight += 1
+			return account
+
+	def wait_cause(self, account):
+		"""Name the reason for waiting before sending on the account, for the metrics"""
+		if self.resume_time > account.available_time:
+			return 'app pause'
+		return 'account wait'
+
+	async def release_account(self, account):
+		"""Free the slot claimed on an ad account"""
+		account.in_flight -= 1
+		async with self.account_released:
+			self.account_released.notify()
+
+	async def get_estimates_async(self, requests, executor):
+		"""
+		Send the given requests to the server from the executor and validate the responses. Store any valid responses.
+		Requests go to the ad account that is soonest available, with at most requests_per_account in flight on each.
+		More than one request is sent as a batch call.
+		"""
+		loop = asyncio.get_running_loop()
+		account = await self.acquire_account()
+		try:
+			if len(requests) == 1:
+				request = requests[0]
+				try:
+					await loop.run_in_executor(executor, self.send_request, request, account)
+				except Exception as e:
+					self.handle_request_exception(request, e, account)
 				else:
-					raise e
-			elif e.api_error_code() == 200:
-				logger.exception('(API Error 200) ??? Unhandled exception')
-				raise e
-			elif e.api_error_code() == 294:
-				logger.exception('(API Error 294) ??? Unhandled exception')
-				raise e
+					self.record_usage(account, request.response.headers())
+					self.validate_response(request)
 			else:
-				logger.exception('Unknown Facebook API error code')
-				raise e
-		except TypeError as e:
-			logger.warning('Internal Facebook Python API error, probable response format error. {e}'.format(e=e))
-		except Exception:
+				try:
+					responses = await loop.run_in_executor(executor, self.send_batch, requests, account)
+				except Exception as e:
+					self.handle_call_exception(requests, e, account)
+				else:
+					self.handle_batch_responses(requests, responses, account)
+		finally:
+			await self.release_account(account)
+			self.metrics.update()
+			self.planner.update()
+
+	def batches(self, requests):
+		"""Split the requests into lists of at most batch_size requests"""
+		return [requests[i:i + self.batch_size] for i in range(0, len(requests), self.batch_size)]
+
+	def handle_request_exception(self, request, exception, account):
+		"""Handle an exception raised while sending the given request with the given ad account"""
+		if isinstance(exception, FacebookRequestError):
+			request.fail(exception.api_error_code())
+			self.handle_request_error(request, exception, account)
+		elif isinstance(exception, TypeError):
+			request.fail('format')
+			logger.warning('Internal Facebook Python API error, probable response format error. {e}'.format(e=exception))
+		else:
+			request.fail('exception')
 			logger.exception('Unhandled Facebook Python API error')
+		self.metrics.record_failure(request.error, account)
+
+	def handle_call_exception(self, requests, exception, account):
+		"""
+		Handle an exception raised by a batch call as a whole, which failed each request in it.
+		The account and app level consequences, e.g. a cooldown or pause and the error count, are applied once for the
+		call through its first request, the other requests are only failed with the same error to be retried
+		"""
+		self.handle_request_exception(requests[0], exception, account)
+		for request in requests[1:]:
+			request.fail(requests[0].error)
+
+	def handle_request_error(self, request, e, account):
+		"""Handle an error response from the Marketing API to the given request sent with the given ad account"""
+		report = self.record_usage(account, e.http_headers())
+		# https://developers.facebook.com/docs/marketing-api/error-reference/
+		# https://developers.facebook.com/docs/graph-api/using-graph-api/error-handling/
+		if e.api_error_code() == 1:
+			logger.warning('(API Error 1) Unknown server error, continuing')
+		elif e.api_error_code() == 2:
+			logger.warning('(API Error 2) Marketing API service unavailable, retrying')
+		elif e.api_error_code() == 4:
+			# the usage headers give the wait when the limit is tied to a business use case, otherwise fall back to 10 minutes
+			sleeptime = report.regain_seconds or 600
+			logger.warning('(API Error 4) Application call limit reached, sleeping for {n} s'.format(n=sleeptime))
+			self.pause(sleeptime)
+		elif e.api_error_code() == 10:
+			logger.exception('(API Error 10) ??? Unhandled exception')
+			raise e
+		elif e.api_error_code() == 17:
+			logger.warning('(API Error 17) Account call limit reached')
+			self.handle_request_limit(account, report)
+		elif e.api_error_code() == 100:
+			logger.exception('(API Error 100) Invalid parameter, inputs need updating')
+			# TODO error stats
+			# self.store.record_error(request['code'])
+			request.complete()
+			self.record_failure(request)
+		elif e.api_error_code() == 102:
+			logger.exception('(API Error 102) ??? Unhandled exception')
+			raise e
+		elif e.api_error_code() == 104:
+			logger.exception('(API Error 104) ??? Unhandled exception')
+			raise e
+		elif e.api_error_code() == 190:
+			if not account.expired:
+				logger.warning('(API Error 190) Ad account {name} credentials expired, switching to another account'.format(name=account.name))
+				self.pool.expire(account)
+			if not self.pool.active_accounts():
+				raise e
+		elif e.api_error_code() == 200:
+			logger.exception('(API Error 200) ??? Unhandled exception')
+			raise e
+		elif e.api_error_code() == 294:
+			logger.exception('(API Error 294) ??? Unhandled exception')
+			raise e
 		else:
-			# print(response)
-			if 'estimate_ready' in request.response[0]:
-				if request.response[0]['estimate_ready']:
-					request.valid = True
-					if (request.response[0]['estimate_dau'] > 0) and (request.response[0]['estimate_mau'] > 0):
-						# TODO check delta from previous collection is within reasonable range
-						request.complete()
-						behavior = None
-						if 'behaviors' in request.params['targeting_spec']:
-							behavior = request.params['targeting_spec']['behaviors'][0].get('name')
-						gender = None
-						if 'genders' in request.params['targeting_spec']:
-							if request.params['targeting_spec']['genders'][0] == 1:
-								gender = 'men'
-							elif request.params['targeting_spec']['genders'][0] == 2:
-								gender = 'women'
-						else:
-							gender = 'all'
-						self.store.add_entry(request.params['targeting_spec']['geo_locations']['countries'][0], gender, request.params['targeting_spec'].get('age_min'), request.params['targeting_spec'].get('age_max'), behavior, request.response[0]['estimate_dau'], request.response[0]['estimate_mau'])
-			elif request.retries > 100:
-				alpha2 = request.params['targeting_spec']['geo_locations']['countries'][0]
-				logger.error('Giving up on fetching response for {a2}'.format(a2=alpha2))
-				logger.error(request)
+			logger.exception('Unknown Facebook API error code')
+			raise e
+
+	def validate_response(self, request):
+		"""Validate the response to the given request, storing the estimate if it is complete"""
+		# print(response)
+		if 'estimate_ready' in request.response[0] and request.response[0]['estimate_ready']:
+			request.valid = True
+			if (request.response[0]['estimate_dau'] > 0) and (request.response[0]['estimate_mau'] > 0):
+				# TODO check delta from previous collection is within reasonable range
 				request.complete()
-				# store.record_error(alpha3)
+				self.record_estimate(request, request.response[0]['estimate_dau'], request.response[0]['estimate_mau'])
+			else:
+				request.fail('zero')
+				self.metrics.record_failure(request.error)
+				if self.zero_policy.accept(request):
+					logger.info('Accepting zero sized population for {request}'.format(request=request))
+					request.complete()
+					self.record_estimate(request, request.response[0]['estimate_dau'], request.response[0]['estimate_mau'], zero_accepted=True)
+		else:
+			request.fail('not_ready')
+			self.metrics.record_failure(request.error)
+
+	def retry_later(self, request, repeats, overflow=None):
+		"""
+		Queue an incomplete request to be retried after the backoff for its failure, or give up on it.
+		When an overflow queue is given, requests that have used up their priority_attempts, or will not be eligible
+		again within priority_retry_wait, are queued there instead. Requests the planner sheds are deferred.
+		"""
+		if schedule_retry(request, self.max_attempts):
+			if self.planner.shed(request):
+				self.deferred += [request]
+			elif overflow is not None and (request.attempts >= self.priority_attempts or request.eligible_time - time.time() > priority_retry_wait):
+				overflow.push(request)
+			else:
+				repeats.push(request)
+		else:
+			alpha2 = request.country
+			logger.error('Giving up on fetching response for {a2} after {n} attempts'.format(a2=alpha2, n=request.attempts))
+			logger.error(request)
+			request.complete()
+			self.record_failure(request)
+			# store.record_error(alpha3)
 
 	def fetch_countries_list(self):
+		"""Fetch the current list of countries, see fetch_countries"""
+		self.countries = fetch_countries(self.pool, self.targeting_cache)
+
+	def validate_behaviors(self):
 		"""
-		Fetch the current list of countries.
-		In practice this will rarely change but any change to the list will be handled without requiring code changes.
+		Check the behaviour ids against the behaviours available for targeting in one cached search, before any requests
+		are sent. Retired ids are remapped to a behaviour of the same name where possible, otherwise removed, rather
+		than failing with error 100 for every country. If the search fails the behaviours are collected unchecked
 		"""
-		# TODO should retry this a few times if it fails
 		try:
-			self.countries = TargetingSearch.search(params={
-				'q': '',
-				'type': TargetingSearch.TargetingSearchTypes.country,
+			available = self.targeting_cache.search({
+				'type': TargetingSearch.TargetingSearchTypes.targeting_category,
+				'class': 'behaviors',
 				'limit': 1000,
-			}, api=self.backup_api)
-		except FacebookRequestError as e:
-			if e.api_error_code() == 190:
-				logger.error('(API Error 190) Backup account credentials expired, cannot continue')
-				# TODO email error email
-				raise SystemExit
-			else:
-				logger.exception('Unknown Marketing API error while fetching countries list, cannot continue')
-				# TODO email error email
-				raise SystemExit
+			}, self.pool.api())
 		except Exception:
-			# TODO try to enumerate some possible errors but we may want to retry in all circumstances
-			logger.exception('Unknown Marketing API error while fetching countries list, cannot continue')
+			logger.exception('Could not search for the available behaviours, collecting {n} behaviours unchecked'.format(n=len(self.behaviors)))
+			return
+		finally:
+			self.behaviors_validated = True
+		if not available:
+			logger.warning('Behaviour search returned nothing, collecting {n} behaviours unchecked'.format(n=len(self.behaviors)))
+			return
+		self.behaviors, changes = validate_behaviors(self.behaviors, available)
+		for behavior, replacement in changes:
+			if replacement:
+				logger.warning('Behaviour {name} id {old} is no longer available, using id {new}'.format(name=behavior['name'], old=behavior['id'], new=replacement['id']))
+			else:
+				logger.warning('Behaviour {name} id {old} is no longer available, not collecting it'.format(name=behavior['name'], old=behavior['id']))
+		logger.info('{n} behaviours validated'.format(n=len(self.behaviors)))
 
-	def create_target_queue(self):
-		"""Fetch the current list of countries and use it to prepare a queue of collection requests"""
-		self.fetch_countries_list()
+	def create_target_queue(self, countries=None):
+		"""
+		Fetch the current list of countries and use it to prepare a queue of collection requests.
+		A list of countries can be given instead, e.g. the share of the countries list for one shard of a collection
+		"""
+		if countries is None:
+			self.fetch_countries_list()
+		else:
+			self.countries = countries
 		print(self.countries)
 		self.queues = []
 		for count, country in enumerate(self.countries, start=1):
 			self.queues += [{
 				'code': country['country_code'],
-				'queue': create_country_target_queue(country['country_code']),
 				'count': count
 			}]
 
-	def collect(self):
+	def country_queue(self, alpha2, priority):
+		"""Generate the requests of the given priority for a country"""
+		queue = (request for request in create_country_target_queue(alpha2, self.behaviors) if request.priority == priority)
+		return self.unsatisfied(queue)
+
+	def unsatisfied(self, queue):
+		"""
+		Generate the requests from the queue that have not already been satisfied earlier in this batch.
+		Requests for a targeting spec in the index are answered from it, when resuming anything else already in the
+		store or given up on is skipped
+		"""
+		for request in queue:
+			if self.answer_from_index(request):
+				continue
+			elif self.resume and self.satisfied(request):
+				self.skipped += 1
+				self.planner.finish(measured=False)
+			else:
+				yield request
+
+	def defer_shed(self, requests):
+		"""Defer the requests the planner sheds to the end of the collection, returning the rest"""
+		kept = []
+		for request in requests:
+			if self.planner.shed(request):
+				self.deferred += [request]
+			else:
+				kept += [request]
+		return kept
+
+	def units(self):
+		"""
+		List the (country code, priority) units of work in the collection, in the order they are collected.
+		Every country's critical 18+ totals come before any age bands, and age bands before behaviours
+		"""
+		return [(queue['code'], priority) for priority in priorities for queue in self.queues]
+
+	def collect(self, units=None):
 		"""
 		Run the main collection task.
 		Initialises the request queues then repeatedly sends requests to the server until we have valid responses.
-		Stops at 23:00 to allow for analysis and avoid overlap with tomorrow's collection
+		Stops at the deadline, 23:00 by default, to allow for analysis and avoid overlap with tomorrow's collection.
+		A list of (country code, priority) units can be given to collect only part of the queues
 		"""
+		asyncio.run(self.collect_async(units))
+
+	async def collect_async(self, units=None):
+		"""Run the main collection task, sending up to requests_per_account concurrent requests to each ad account"""
+		if units is None:
+			units = self.units()
 		logger.info('Beginning collection for {datestamp}'.format(datestamp=self.batch_string))
-		repeats = []
-		# TODO more collection stats, how many requests did we send, how many responses, how many errors?
+		logger.info('Sending up to {n} concurrent requests to each of {a} ad accounts'.format(n=self.requests_per_account, a=len(self.pool)))
+		if self.batch_size > 1:
+			logger.info('Sending requests in batch calls of up to {n}'.format(n=self.batch_size))
+		self.account_released = asyncio.Condition()
+		repeats = RetryQueue()
 		requesttotal = 0
-		for queue in self.queues:
-			requesttotal += len(queue['queue'])
-		logger.info('{x} requests in master queue'.format(x=requesttotal))
-		for queue in self.queues:
-			logger.info('{n}/{t} starting queue for {c}'.format(n=queue['count'], t=len(self.queues), c=queue['code']))
-			logger.info('{x} requests in queue'.format(x=len(queue['queue'])))
-			complete = 0
-			for item in queue['queue']:
-				self.get_estimate(item)
-				if not item.completed:
-					repeats += [item]
-				else:
-					complete += 1
-			logger.info('Finished first pass of {a2} queue, completed {x}/{n} requests'.format(a2=queue['code'], x=complete, n=len(queue['queue'])))
-
-			# TODO consider restoring logfile upload during collection, probably uneccessary now
-			# with open(log_filename, 'rb') as file:
-				# key = '{folder}/{filename}'.format(folder=batch_s3_folder, filename=log_filename)
-				# s3_bucket.put(key, file)
-
-		logger.info('{x} requests to repeat'.format(x=len(repeats)))
-		repeats = deque(repeats)
-		while len(repeats) and (datetime.datetime.now().time() < datetime.time(hour=23, minute=0, second=0, microsecond=0)):
-			item = repeats.pop()
-			self.get_estimate(item)
-			if not item.completed:
-				repeats.appendleft(item)
-			else:
-				if not (len(repeats) % 100):
-					logger.info('{x} requests remaining'.format(x=len(repeats)))
+		if not self.behaviors_validated:
+			self.validate_behaviors()
+		logger.info('Up to {x} requests in master queue'.format(x=len({code for code, _ in units}) * country_target_queue_size(self.behaviors)))
+		# a collection reused for several runs, e.g. a lease each, plans every run afresh
+		self.planner.reset()
+		self.planner.plan(sum(country_target_queue_size(self.behaviors, priority) for _, priority in units))
+		workers = self.requests_per_account * len(self.pool)
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			# each run of units of the same priority is finished, bar the requests left to the final retries, before the next
+			for priority, tier in itertools.groupby(units, key=lambda unit: unit[1]):
+				tier = list(tier)
+				logger.info('Starting priority {p} requests'.format(p=priority))
+				priority_repeats = RetryQueue()
+				for count, (code, _) in enumerate(tier, start=1):
+					# country queues are generated as they are reached so only one is held in memory besides the repeats
+					items = list(self.country_queue(code, priority))
+					requesttotal += len(items)
+					items = self.defer_shed(items)
+					logger.info('{n}/{t} starting priority {p} queue for {c}'.format(n=count, t=len(tier), p=priority, c=code))
+					logger.info('{x} requests in queue'.format(x=len(items)))
+					await asyncio.gather(*[self.get_estimates_async(batch, executor) for batch in self.batches(items)])
+					complete = 0
+					for item in items:
+						if not item.completed:
+							self.retry_later(item, priority_repeats, repeats)
+						else:
+							complete += 1
+					logger.info('Finished first pass of {a2} queue, completed {x}/{n} requests'.format(a2=code, x=complete, n=len(items)))
+
+					# TODO consider restoring logfile upload during collection, probably uneccessary now
+					# with open(log_filename, 'rb') as file:
+						# key = '{folder}/{filename}'.format(folder=batch_s3_folder, filename=log_filename)
+						# s3_bucket.put(key, file)
+
+				logger.info('{x} priority {p} requests to repeat before moving on'.format(x=len(priority_repeats), p=priority))
+				await asyncio.gather(*[self.repeat_requests(priority_repeats, executor, repeats) for _ in range(workers)])
+
+			if self.resume:
+				logger.info('Resumed collection {batch}, skipped {x} requests already satisfied'.format(batch=self.batch_string, x=self.skipped))
+			logger.info('{x} requests to repeat'.format(x=len(repeats)))
+			await asyncio.gather(*[self.repeat_requests(repeats, executor) for _ in range(workers)])
+
+			if self.deferred:
+				# nothing else is left, so the deferred requests are no longer shed and are sent until the deadline
+				logger.info('Collecting {x} deferred low value requests'.format(x=len(self.deferred)))
+				self.planner.end_shedding()
+				for request in self.deferred:
+					repeats.push(request)
+				self.deferred = []
+				await asyncio.gather(*[self.repeat_requests(repeats, executor) for _ in range(workers)])
 
-		self.store.write()
-		s3_bucket = S3Bucket()
-		self.store.upload(s3_bucket, self.batch_string)
+		self.journal.close()
+		self.index.write()
+		if self.upload:
+			self.store.upload(shared_bucket(), self.batch_string)
+		else:
+			self.store.write()
 
 		logger.info('Collection {batch} complete'.format(batch=self.batch_string))
 		logger.info('{x}/{n} requests completed'.format(x=(requesttotal - len(repeats)), n=requesttotal))
 		valid_zeroes = 0
+		unsent = 0
 		for request in repeats:
 			if request.valid:
 				valid_zeroes += 1
-		errors = len(repeats) - valid_zeroes
+			elif not request.attempts:
+				unsent += 1
+		errors = len(repeats) - valid_zeroes - unsent
 		logger.info('{x}/{n} requests incomplete due to server returning zero sized populations'.format(x=valid_zeroes, n=requesttotal))
 		logger.info('{x}/{n} requests incomplete due to errors'.format(x=errors, n=requesttotal))
+		logger.info('{x}/{n} requests deferred and not sent by the deadline'.format(x=unsent, n=requesttotal))
+		self.metrics.write()
+		logger.info('{x} requests sent in {c} calls, {e} estimates received, {d} answered from the spec index'.format(x=self.metrics.requests_sent, c=self.metrics.calls, e=self.metrics.estimates, d=self.metrics.duplicates))
+		logger.info('Failures by error {failures}'.format(failures=dict(self.metrics.failures)))
+		logger.info('Slept for {sleep}'.format(sleep={cause: round(seconds) for cause, seconds in self.metrics.sleep.items()}))
+		logger.info('Metrics written to {filepath}'.format(filepath=self.metrics.filepath))
+
+	async def repeat_requests(self, repeats, executor, overflow=None):
+		"""
+		Resend incomplete requests from the shared repeats queue as they become eligible, highest priority first, until
+		it is empty or the deadline has passed.
+		When an overflow queue is given, requests that cannot be retried soon are moved to it instead.
+		"""
+		while len(repeats) and (datetime.datetime.now() < self.deadline):
+			items = []
+			while len(items) < self.batch_size:
+				item = repeats.pop()
+				if item is None:
+					break
+				# a request for the same targeting spec may have been answered since this one failed
+				if not self.answer_from_index(item):
+					items += [item]
+			if not items:
+				wait = min(repeats.wait_time(), (self.deadline - datetime.datetime.now()).total_seconds())
+				self.metrics.record_sleep('retry wait', wait)
+				await asyncio.sleep(wait)
+				continue
+			await self.get_estimates_async(items, executor)
+			for item in items:
+				if not item.completed:
+					self.retry_later(item, repeats, overflow)
+				else:
+					if not (len(repeats) % 100):
+						logger.info('{x} requests remaining'.format(x=len(repeats)))
 
 	def collect_targeting_specs(self):
 		"""Collect some lists of targeting specs to help choose new targeting parameters."""
-		user_devices = TargetingSearch.search(params={
+		user_devices = self.targeting_cache.search({
 			'q': 'user_device',
 			'type': TargetingSearch.TargetingSearchTypes.targeting_category,
 			'limit': 1000,
-		}, api=self.backup_api)
+		}, self.pool.api())
 		print(user_devices)
 		with open(os.path.join(data_path, 'devices.json'), 'w') as file, open(os.path.join(data_path, 'devices.csv'), 'w', newline='') as csvfile:
-			d = list(filter(lambda x: x['type'] == 'user_device', map(lambda x: x._data, user_devices)))
+			d = list(filter(lambda x: x['type'] == 'user_device', user_devices))
 			# d2 = list(filter(lambda x: x['type'] == 'user_device', d))
 			d3 = {"root": d}
 			json.dump(d3, file)
@@ -268,14 +718,14 @@ class FacebookCollection:
 			csvwriter.writeheader()
 			csvwriter.writerows(d)
 
-		user_os = TargetingSearch.search(params={
+		user_os = self.targeting_cache.search({
 			'q': 'user_os',
 			'type': TargetingSearch.TargetingSearchTypes.targeting_category,
 			'limit': 1000,
-		}, api=self.backup_api)
+		}, self.pool.api())
 		print(user_os)
 		with open(os.path.join(data_path, 'os.json'), 'w') as file, open(os.path.join(data_path, 'os.csv'), 'w', newline='') as csvfile:
-			d = list(filter(lambda x: x['type'] == 'user_os', map(lambda x: x._data, user_os)))
+			d = list(filter(lambda x: x['type'] == 'user_os', user_os))
 			json.dump({"root": d}, file)
 			csvwriter = csv.DictWriter(csvfile, fieldnames=d[0].keys())
 			csvwriter.writeheader()
@@ -284,8 +734,11 @@ class FacebookCollection:
 
 if __name__ == "__main__":
 	from storage.dgg_file_structure import log_path
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--store', choices=estimate_store.store_kinds, default='json', help='kind of estimate store to collect into')
+	arguments = parser.parse_args()
 	logging_setup(log_path)
 	batch = str(datetime.date.today().isoformat())
-	session = FacebookCollection(batch)
+	session = FacebookCollection(batch, resume=True, store=estimate_store.open_store(arguments.store, batch))
 	session.create_target_queue()
 	session.collect()
@@ -1,24 +1,125 @@
 """Classes and functions for representing Facebook Marketing API requests and targeting data"""
-import copy
+import hashlib
+import json
 import time
 import datetime
 
+genders = {None: 'all', 1: 'men', 2: 'women'}
+
+# Collection priorities, lower values are collected first
+# 18+ totals, preprocessing drops any country without them
+critical_priority = 0
+age_priority = 1
+behavior_priority = 2
+priorities = [critical_priority, age_priority, behavior_priority]
+
+
+def canonical_spec(value):
+	"""
+	Put a targeting spec, or any part of one, into a canonical form that does not depend on the order of its keys or
+	list items. Targeting entities such as behaviours are identified by id alone, their names are only labels
+	"""
+	if isinstance(value, dict):
+		if 'id' in value:
+			value = {key: item for key, item in value.items() if key != 'name'}
+		return {key: canonical_spec(item) for key, item in value.items()}
+	elif isinstance(value, (list, tuple)):
+		return sorted((canonical_spec(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True))
+	return value
+
+
+def spec_hash(params):
+	"""Hash the params of a request so requests for the same population, however their targeting spec is written, share a hash"""
+	canonical = json.dumps(canonical_spec(params), sort_keys=True, separators=(',', ':'))
+	return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
 
 class FacebookReachRequest:
-	"""Class representing Facebook Marketing API requests"""
-	def __init__(self, params):
-		self.params = copy.deepcopy(params)
+	"""
+	Class representing Facebook Marketing API requests.
+	Requests only hold references to the shared age range and behaviour targeting data, the params including the
+	targeting spec are built when the request is sent
+	"""
+	__slots__ = (
+		'country', 'gender', 'age_range', 'behavior', 'response', 'completed', 'valid', 'attempts', 'timestamp',
+		'error', 'error_count', 'eligible_time'
+	)
+
+	def __init__(self, country, gender=None, age_range=None, behavior=None):
+		self.country = country
+		self.gender = gender
+		self.age_range = age_range or age_ranges[0]
+		self.behavior = behavior
 		self.response = None
 		self.completed = False
 		self.valid = False
 		self.attempts = 0
 		self.timestamp = None
+		self.error = None
+		self.error_count = 0
+		self.eligible_time = 0
+
+	def __repr__(self):
+		return '<FacebookReachRequest {dimensions} attempts {attempts}>'.format(dimensions=self.dimensions(), attempts=self.attempts)
+
+	@property
+	def params(self):
+		"""Build the request params with the targeting spec for the request"""
+		targeting_spec = {
+			'geo_locations': {
+				'countries': [self.country],
+				'location_types': ['home'],
+			},
+			'publisher_platforms': ["facebook"]
+		}
+		# targeting_spec["facebook_positions"] = ["feed"]
+		# targeting_spec["device_platforms"] = ["mobile","desktop"]
+		if self.gender:
+			targeting_spec['genders'] = [self.gender]
+		targeting_spec.update(self.age_range)
+		if self.behavior:
+			targeting_spec['behaviors'] = [self.behavior]
+		return {
+			'targeting_spec': targeting_spec,
+			# TODO is the opt goal correct?
+			'optimization_goal': "AD_RECALL_LIFT"  # Not none or reach?
+		}
+
+	@property
+	def spec_hash(self):
+		"""Canonical hash of the request params, shared by every request for the same population"""
+		return spec_hash(self.params)
+
+	@property
+	def priority(self):
+		"""Collection priority of the request, the 18+ totals the analysis needs come first, then age bands, then behaviours"""
+		if self.behavior:
+			return behavior_priority
+		elif self.age_range == age_ranges[0]:
+			return critical_priority
+		else:
+			return age_priority
 
 	def complete(self):
 		"""Mark the request as completed and record the timestamp"""
 		self.timestamp = time.time()
 		self.completed = True
 
+	def fail(self, error):
+		"""Record the API error code, or kind of failure, of the latest attempt"""
+		if error == self.error:
+			self.error_count += 1
+		else:
+			self.error = error
+			self.error_count = 1
+
+	def dimensions(self):
+		"""Get the store dimensions of the request, (country, gender, age_min, age_max, behaviour)"""
+		behavior = None
+		if self.behavior:
+			behavior = self.behavior.get('name')
+		return self.country, genders[self.gender], self.age_range.get('age_min'), self.age_range.get('age_max'), behavior
+
 
 age_ranges = [
 	{"age_min": 18},
@@ -72,51 +173,69 @@ behaviors_default = [
 	{"id": 6015593776783, "name": "Facebook access (browser): Internet Explorer"},
 	{"id": 6015593652183, "name": "Facebook access (browser): Opera"},
 ]
+# Behaviours of least value to the analysis, deferred first when a collection is running behind, the deprecated
+# iphone 7 segment and the browsers
+low_value_behavior_ids = {
+	6060616578383, 6015547900583, 6015593608983, 6015547847583, 6055133998183, 6015593776783, 6015593652183
+}
 
 
-def create_country_target_queue(alpha2):
-	"""Creates a queue of FacebookReachRequest for the given country using the standard dgg targeting lists"""
-	targeting_spec = {
-		'geo_locations': {
-			'countries': [alpha2],
-			'location_types': ['home'],
-		},
-		'publisher_platforms': ["facebook"]
-	}
-	# targeting_spec["facebook_positions"] = ["feed"]
-	# targeting_spec["device_platforms"] = ["mobile","desktop"]
-	params = {
-		'targeting_spec': targeting_spec,
-		# TODO is the opt goal correct?
-		'optimization_goal': "AD_RECALL_LIFT"  # Not none or reach?
-	}
-	params['targeting_spec']['age_min'] = 18
-	queue = []
-	queue += [FacebookReachRequest(params)]
+def validate_behaviors(behaviors, available):
+	"""
+	Check behaviours against the behaviours currently available for targeting, e.g. from a targeting category search.
+	A behaviour whose id has been retired is remapped to an available behaviour with the same name where there is one,
+	keeping its own name so its estimates are stored as before, otherwise it is removed.
+	Returns the valid behaviours and a list of (behaviour, replacement) pairs, the replacement None for those removed
+	"""
+	available_ids = {str(behavior['id']) for behavior in available if 'id' in behavior}
+	available_names = {behavior['name'].lower(): behavior['id'] for behavior in available if 'id' in behavior and 'name' in behavior}
+	valid = []
+	changes = []
 	for behavior in behaviors:
-		params['targeting_spec']['behaviors'] = [behavior]
-		queue += [FacebookReachRequest(params)]
+		if str(behavior['id']) in available_ids:
+			valid += [behavior]
+			continue
+		new_id = available_names.get(behavior['name'].lower())
+		if new_id is None:
+			changes += [(behavior, None)]
+			continue
+		replacement = dict(behavior, id=int(new_id) if str(new_id).isdigit() else new_id)
+		valid += [replacement]
+		changes += [(behavior, replacement)]
+	return valid, changes
+
+
+def create_country_target_queue(alpha2, behaviors=None):
+	"""Generates the queue of FacebookReachRequest for the given country using the standard dgg targeting lists"""
+	if behaviors is None:
+		behaviors = behaviors_default
+	yield FacebookReachRequest(alpha2)
+	for behavior in behaviors:
+		yield FacebookReachRequest(alpha2, behavior=behavior)
 
 	for gender in range(1, 3):
-		targeting_spec['genders'] = [gender]
-		targeting_spec.pop('behaviors', None)
 		for age in age_ranges:
-			targeting_spec.pop('age_min', None)
-			targeting_spec.pop('age_max', None)
-			params['targeting_spec'] = {**targeting_spec, **age}
-			queue += [FacebookReachRequest(params)]
-		params['targeting_spec']['age_min'] = 18
-		targeting_spec.pop('age_max', None)
+			yield FacebookReachRequest(alpha2, gender, age)
 		for behavior in behaviors:
-			params['targeting_spec']['behaviors'] = [behavior]
-			queue += [FacebookReachRequest(params)]
-	return queue
+			yield FacebookReachRequest(alpha2, gender, behavior=behavior)
+
+
+def country_target_queue_size(behaviors=None, priority=None):
+	"""Number of requests in the queue for each country using the standard dgg targeting lists, or of one priority"""
+	if behaviors is None:
+		behaviors = behaviors_default
+	if priority == critical_priority:
+		return 3
+	elif priority == age_priority:
+		return 2 * (len(age_ranges) - 1)
+	elif priority == behavior_priority:
+		return 3 * len(behaviors)
+	return 1 + len(behaviors) + 2 * (len(age_ranges) + len(behaviors))
 
 
 if __name__ == "__main__":
 	total_countries = 246
-	queue = create_country_target_queue('US')
-	queue_size = len(queue)
+	queue_size = country_target_queue_size()
 	print('QLen= {queue_size}'.format(queue_size=queue_size))
 	print('Estimated queue run time')
 	time = datetime.timedelta(seconds=(queue_size * total_countries * 0.67))
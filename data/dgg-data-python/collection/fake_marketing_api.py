@@ -0,0 +1,300 @@
+"""
+A local stand-in for the Marketing API endpoints used by a collection, for measuring collection without live tokens.
+Serves delivery estimates, targeting searches and batch calls over HTTP with configurable latency, call limits and
+injected errors. The Facebook Python API is pointed at it through FacebookSession.GRAPH.
+"""
+import collections
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from facebook_business.adobjects.adaccount import AdAccount
+from facebook_business.api import FacebookAdsApi
+from facebook_business.api import FacebookSession
+
+from collection.account_pool import AdAccountPool
+from collection.account_pool import PooledAdAccount
+from collection.facebook_requests import behaviors_default
+from collection.throttle import ad_account_usage_header
+from collection.throttle import app_usage_header
+from collection.throttle import business_use_case_usage_header
+from storage.dgg_file_structure import data_path
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+# Seconds of latency drawn from each distribution given its two parameters
+latency_distributions = {
+	'constant': lambda value, _: value,
+	'uniform': random.uniform,
+	'lognormal': lambda median, sigma: random.lognormvariate(math.log(median), sigma),
+}
+
+# HTTP status and message returned with each error code the stand-in can inject
+injected_errors = {
+	1: (500, 'An unknown error occurred', 'OAuthException'),
+	2: (503, 'Service temporarily unavailable', 'OAuthException'),
+	4: (400, 'Application request limit reached', 'OAuthException'),
+	17: (400, 'User request limit reached', 'OAuthException'),
+	100: (400, 'Invalid parameter', 'OAuthException'),
+	190: (400, 'Invalid OAuth 2.0 Access Token', 'OAuthException'),
+}
+
+api_path_pattern = re.compile(r'^/?v[0-9]+\.[0-9]+/?(?P<path>.*)$')
+
+
+def fake_account_pool(accounts=3, app_id='fake-app', app_secret='fake-secret'):
+	"""Create a pool of ad accounts with made up credentials, for use with the stand-in server"""
+	pool = []
+	for n in range(1, accounts + 1):
+		session = FacebookSession(app_id, app_secret, 'fake-token-{n}'.format(n=n))
+		api = FacebookAdsApi(session)
+		pool += [PooledAdAccount('fake{n}'.format(n=n), AdAccount('act_{n}'.format(n=n), api=api), api)]
+	return AdAccountPool(pool)
+
+
+class FakeMarketingApi:
+	"""
+	Represents the stand-in server.
+	latency is a (distribution, a, b) tuple drawn for every call, see latency_distributions,
+	error_rates maps injected error codes to the fraction of calls that return them, once a token has been given
+	error 190 every later call with it is rejected too,
+	account_limit and app_limit cap the calls each access token and the whole app may make in any window seconds,
+	calls over the cap return error 17 or 4 and the usage headers report usage against the caps, with the seconds
+	until the oldest call leaves the window as reset_time_duration on every response, as the Marketing API sends it,
+	not_ready_rate and zero_rate are the fractions of estimates returned not ready or with a zero sized population,
+	countries limits the countries returned by the country search, by default every country in countries.json,
+	retired_behaviors lists behaviour ids left out of the behaviours search and rejected with error 100 when targeted.
+	Use as a context manager to start the server and point the Facebook Python API at it.
+	"""
+	def __init__(self, latency=('lognormal', 0.3, 0.5), error_rates=None, account_limit=None, app_limit=None, window=60, not_ready_rate=0, zero_rate=0, countries=None, retired_behaviors=(), host='127.0.0.1', port=0):
+		self.latency = latency
+		self.error_rates = error_rates or {}
+		unknown_codes = set(self.error_rates) - set(injected_errors)
+		if unknown_codes:
+			raise ValueError('Cannot inject error codes {codes}'.format(codes=sorted(unknown_codes)))
+		self.account_limit = account_limit
+		self.app_limit = app_limit
+		self.window = window
+		self.not_ready_rate = not_ready_rate
+		self.zero_rate = zero_rate
+		self.countries = countries
+		self.retired_behaviors = {str(behavior_id) for behavior_id in retired_behaviors}
+		self.host = host
+		self.port = port
+		self.lock = threading.Lock()
+		self.account_calls = collections.defaultdict(collections.deque)
+		self.app_calls = collections.deque()
+		self.expired_tokens = set()
+		self.stats = collections.Counter()
+		self.server = None
+		self.thread = None
+		self.graph = None
+
+	@property
+	def url(self):
+		"""Base URL of the running server, in the form of FacebookSession.GRAPH"""
+		return 'http://{host}:{port}'.format(host=self.host, port=self.server.server_address[1])
+
+	def start(self):
+		"""Start serving in a background thread"""
+		fake = self
+
+		class Handler(FakeMarketingApiHandler):
+			api = fake
+
+		self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+		self.server.daemon_threads = True
+		self.thread = threading.Thread(target=self.server.serve_forever, name='fake-marketing-api', daemon=True)
+		self.thread.start()
+		logger.info('Fake Marketing API serving at {url}'.format(url=self.url))
+
+	def stop(self):
+		"""Stop serving"""
+		if self.server:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+
+	def __enter__(self):
+		self.start()
+		self.graph = FacebookSession.GRAPH
+		FacebookSession.GRAPH = self.url
+		return self
+
+	def __exit__(self, *exc_info):
+		FacebookSession.GRAPH = self.graph
+		self.stop()
+
+	def draw_latency(self):
+		"""Seconds of latency for one call"""
+		distribution, a, b = self.latency
+		return max(0, latency_distributions[distribution](a, b))
+
+	def count_call(self, token):
+		"""
+		Record a call against the caps.
+		Returns the error code of the cap it exceeds or None, with the usage headers to send with the response
+		"""
+		now = time.time()
+		with self.lock:
+			account_calls = self.account_calls[token]
+			for calls in (account_calls, self.app_calls):
+				while calls and calls[0] <= now - self.window:
+					calls.popleft()
+				calls.append(now)
+			app_pct = round(100 * len(self.app_calls) / self.app_limit) if self.app_limit else 0
+			account_pct = round(100 * len(account_calls) / self.account_limit) if self.account_limit else 0
+			regain_seconds = max(0, account_calls[0] + self.window - now)
+		headers = {
+			app_usage_header: json.dumps({'call_count': min(app_pct, 100), 'total_cputime': 0, 'total_time': 0}),
+			ad_account_usage_header: json.dumps({'acc_id_util_pct': min(account_pct, 100), 'reset_time_duration': round(regain_seconds)}),
+		}
+		if app_pct > 100:
+			return 4, headers
+		if account_pct > 100:
+			headers[business_use_case_usage_header] = json.dumps({token: [{
+				'type': 'ads_management', 'call_count': 100, 'total_cputime': 0, 'total_time': 0,
+				'estimated_time_to_regain_access': math.ceil(regain_seconds / 60)
+			}]})
+			return 17, headers
+		return None, headers
+
+	def injected_error(self, token):
+		"""Error code to inject into this call, if any"""
+		if token in self.expired_tokens:
+			return 190
+		for code, rate in self.error_rates.items():
+			if random.random() < rate:
+				if code == 190:
+					with self.lock:
+						self.expired_tokens.add(token)
+				return code
+		return None
+
+	def answer(self, method, path, params):
+		"""Answer one call, returning the HTTP status, headers and JSON body"""
+		token = params.get('access_token', '')
+		code, headers = self.count_call(token)
+		code = code or self.injected_error(token)
+		if code:
+			self.stats['error {code}'.format(code=code)] += 1
+			status, message, error_type = injected_errors[code]
+			return status, headers, {'error': {
+				'message': message, 'type': error_type, 'code': code, 'fbtrace_id': 'fake{n}'.format(n=random.getrandbits(32))
+			}}
+		if path.endswith('delivery_estimate'):
+			self.stats['delivery_estimate'] += 1
+			targeting_spec = json.loads(params.get('targeting_spec', '{}'))
+			if any(str(behavior.get('id')) in self.retired_behaviors for behavior in targeting_spec.get('behaviors', [])):
+				self.stats['error 100'] += 1
+				return 400, headers, {'error': {'message': 'Invalid parameter', 'type': 'OAuthException', 'code': 100, 'fbtrace_id': 'fake{n}'.format(n=random.getrandbits(32))}}
+			return 200, headers, {'data': [self.estimate(targeting_spec)]}
+		if path == 'search':
+			self.stats['search'] += 1
+			return 200, headers, {'data': self.search(params)}
+		self.stats['unknown'] += 1
+		return 400, headers, {'error': {'message': 'Unknown path {path}'.format(path=path), 'type': 'GraphMethodException', 'code': 100}}
+
+	def estimate(self, targeting_spec):
+		"""A delivery estimate for the targeting spec, the same spec always gives the same population"""
+		if random.random() < self.not_ready_rate:
+			return {'daily_outcomes_curve': [], 'estimate_dau': 0, 'estimate_mau': 0, 'estimate_ready': False}
+		if random.random() < self.zero_rate:
+			return {'daily_outcomes_curve': [], 'estimate_dau': 0, 'estimate_mau': 0, 'estimate_ready': True}
+		country = targeting_spec.get('geo_locations', {}).get('countries', [''])[0]
+		mau = 1000 + zlib.crc32(country.encode('utf-8')) % 50000000
+		if targeting_spec.get('genders'):
+			mau //= 2
+		fraction = zlib.crc32(json.dumps(targeting_spec, sort_keys=True).encode('utf-8')) % 1000 / 1000
+		if targeting_spec.get('age_min', 18) > 18 or targeting_spec.get('age_max'):
+			mau = int(mau * (0.1 + 0.5 * fraction))
+		if targeting_spec.get('behaviors'):
+			mau = int(mau * (0.01 + 0.2 * fraction))
+		mau = max(1000, mau)
+		return {'daily_outcomes_curve': [], 'estimate_dau': mau * 2 // 3, 'estimate_mau': mau, 'estimate_ready': True}
+
+	def search(self, params):
+		"""Targeting search results, only the country search and behaviours search return anything"""
+		if params.get('type') == 'adtargetingcategory' and params.get('class') == 'behaviors':
+			return [
+				{'id': str(behavior['id']), 'name': behavior['name'], 'type': 'behaviors', 'path': ['Behaviors', behavior['name']]}
+				for behavior in behaviors_default if str(behavior['id']) not in self.retired_behaviors
+			]
+		if params.get('type') != 'adcountry':
+			return []
+		countries = self.countries
+		if countries is None:
+			with open(os.path.join(data_path, 'countries.json'), 'r') as file:
+				countries = list(json.load(file))
+		return [{
+			'key': alpha2, 'name': alpha2, 'type': 'country', 'country_code': alpha2,
+			'supports_region': True, 'supports_city': True
+		} for alpha2 in countries]
+
+
+class FakeMarketingApiHandler(BaseHTTPRequestHandler):
+	"""Handles the HTTP requests made to the stand-in, single calls and batch calls"""
+	api = None
+
+	def log_message(self, format, *args):
+		logger.debug(format % args)
+
+	def send_json(self, status, headers, body):
+		"""Send a JSON response"""
+		content = json.dumps(body).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(content)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(content)
+
+	def parse(self):
+		"""Split the request into the Graph API path, without the version, and its parameters"""
+		url = urllib.parse.urlsplit(self.path)
+		params = dict(urllib.parse.parse_qsl(url.query))
+		length = int(self.headers.get('Content-Length') or 0)
+		if length:
+			params.update(urllib.parse.parse_qsl(self.rfile.read(length).decode('utf-8')))
+		match = api_path_pattern.match(url.path)
+		return (match.group('path') if match else url.path.strip('/')), params
+
+	def do_GET(self):
+		path, params = self.parse()
+		time.sleep(self.api.draw_latency())
+		self.send_json(*self.api.answer('GET', path, params))
+
+	def do_POST(self):
+		path, params = self.parse()
+		if path or 'batch' not in params:
+			time.sleep(self.api.draw_latency())
+			self.send_json(*self.api.answer('POST', path, params))
+			return
+		# batch call, the calls within it are answered together after the slowest of them
+		self.api.stats['batch'] += 1
+		responses = []
+		latency = 0
+		for call in json.loads(params['batch']):
+			url = urllib.parse.urlsplit(call['relative_url'])
+			call_params = {'access_token': params.get('access_token', '')}
+			call_params.update(urllib.parse.parse_qsl(url.query))
+			call_params.update(urllib.parse.parse_qsl(call.get('body', '')))
+			status, headers, body = self.api.answer(call['method'], url.path.strip('/'), call_params)
+			latency = max(latency, self.api.draw_latency())
+			responses += [{
+				'code': status,
+				'headers': [{'name': name, 'value': value} for name, value in headers.items()],
+				'body': json.dumps(body),
+			}]
+		time.sleep(latency)
+		self.send_json(200, {}, responses)
@@ -0,0 +1,128 @@
+"""Classes for ordering the requests waiting to be sent during a collection, and for deciding when to retry them"""
+import heapq
+import itertools
+import random
+import time
+
+
+class RetryPolicy:
+	"""
+	Represents how a class of failure is retried.
+	The delay before the nth attempt grows exponentially from base_delay up to max_delay, jittered to between half and
+	all of that value so that failed requests do not come back in lockstep. max_attempts limits how many failures of
+	this class a request may have before it is given up on, None for no limit.
+	"""
+	def __init__(self, base_delay, max_delay, max_attempts=None, factor=2):
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.max_attempts = max_attempts
+		self.factor = factor
+
+	def delay(self, failures):
+		"""Seconds to wait before retrying a request that has failed this many times"""
+		delay = min(self.max_delay, self.base_delay * self.factor ** (failures - 1))
+		return random.uniform(delay / 2, delay)
+
+
+# Retry policies by API error code, or by the kind of failure for failures that are not API errors
+retry_policies = {
+	# Unknown server error and service unavailable, usually transient
+	1: RetryPolicy(5, 300, max_attempts=20),
+	2: RetryPolicy(5, 300, max_attempts=20),
+	# Call limits, the account pool and throttle already hold requests back so retry as soon as a slot is free
+	4: RetryPolicy(0, 0),
+	17: RetryPolicy(0, 0),
+	# Account credentials expired, the request moves to another account in the pool
+	190: RetryPolicy(0, 0),
+	# Response could not be parsed by the Facebook Python API
+	'format': RetryPolicy(30, 600, max_attempts=10),
+	# Any other exception raised while sending the request
+	'exception': RetryPolicy(60, 1800, max_attempts=10),
+	# The estimate was not ready, or the batch call returned no response for the request
+	'not_ready': RetryPolicy(10, 600, max_attempts=20),
+	'no_response': RetryPolicy(5, 300, max_attempts=20),
+	# The estimate was ready but returned a zero sized population
+	'zero': RetryPolicy(300, 3600),
+}
+default_retry_policy = RetryPolicy(30, 1800, max_attempts=10)
+
+
+class PriorityRequestQueue:
+	"""
+	Queue of requests ordered by collection priority, lowest value first.
+	Requests of equal priority are served first in first out, so a request pushed back after failing goes behind
+	the other waiting requests of its priority.
+	"""
+	def __init__(self, requests=()):
+		self.heap = []
+		self.counter = itertools.count()
+		for request in requests:
+			self.push(request)
+
+	def __len__(self):
+		return len(self.heap)
+
+	def __iter__(self):
+		return (entry[-1] for entry in self.heap)
+
+	def push(self, request):
+		"""Add a request to the queue"""
+		heapq.heappush(self.heap, (request.priority, next(self.counter), request))
+
+	def pop(self):
+		"""Remove and return the highest priority request"""
+		return heapq.heappop(self.heap)[-1]
+
+
+class RetryQueue:
+	"""
+	Queue of failed requests waiting to be retried.
+	Requests wait in a heap ordered by the time they next become eligible to be sent, once eligible they are served
+	highest priority first.
+	"""
+	def __init__(self):
+		self.waiting = []
+		self.counter = itertools.count()
+		self.ready = PriorityRequestQueue()
+
+	def __len__(self):
+		return len(self.waiting) + len(self.ready)
+
+	def __iter__(self):
+		return itertools.chain((entry[-1] for entry in self.waiting), self.ready)
+
+	def push(self, request):
+		"""Add a request to the queue, it becomes available once its eligible_time has passed"""
+		heapq.heappush(self.waiting, (request.eligible_time, next(self.counter), request))
+
+	def release(self):
+		"""Move the requests whose eligible time has passed to the ready queue"""
+		now = time.time()
+		while self.waiting and self.waiting[0][0] <= now:
+			self.ready.push(heapq.heappop(self.waiting)[-1])
+
+	def pop(self):
+		"""Remove and return the highest priority eligible request, or None if no request is eligible yet"""
+		self.release()
+		if self.ready:
+			return self.ready.pop()
+		return None
+
+	def wait_time(self):
+		"""Seconds until the next waiting request becomes eligible, 0 if one is already eligible"""
+		self.release()
+		if self.ready or not self.waiting:
+			return 0
+		return max(0, self.waiting[0][0] - time.time())
+
+
+def schedule_retry(request, max_attempts):
+	"""
+	Set when a failed request is next eligible to be sent using the retry policy for its latest failure.
+	Returns False if the request has used up its attempt budget, overall or for consecutive failures of one class.
+	"""
+	policy = retry_policies.get(request.error, default_retry_policy)
+	if request.attempts >= max_attempts or (policy.max_attempts and request.error_count >= policy.max_attempts):
+		return False
+	request.eligible_time = time.time() + policy.delay(request.error_count)
+	return True
@@ -0,0 +1,124 @@
+"""
+Class for running a collection as several worker processes, each collecting a share of the countries with a share of
+the ad accounts, then merging their partial stores into the store for the batch.
+"""
+import datetime
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from storage.dgg_file_structure import data_path
+from storage.dgg_file_structure import log_path
+from dgg_log import logging_setup
+from collection.account_pool import AdAccountPool
+from collection.account_pool import token_files
+from collection.facebook_collector import FacebookCollection
+from collection.facebook_collector import fetch_countries
+from collection.targeting_cache import TargetingCache
+from storage.S3_bucket import shared_bucket
+from storage.estimate_journal import EstimateJournal
+from storage.estimate_store import FacebookEstimateJsonStore
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+# FacebookCollection kwargs every shard sets for itself
+shard_kwargs = ('account_pool', 'resume', 'path', 'upload')
+
+
+def shard(items, shards):
+	"""Deal the items out round robin into the given number of lists, so each shard gets a spread of the list"""
+	return [items[n::shards] for n in range(shards)]
+
+
+def collect_shard(batch_string, shard_number, token_filepaths, countries, folder, cache_path, collection_kwargs):
+	"""Collect one shard of a batch, run in a worker process, with its own account pool and targeting cache"""
+	logging_setup(log_path)
+	logger.info('Shard {n} collecting {c} countries with ad accounts {t}'.format(n=shard_number, c=len(countries), t=[os.path.basename(t) for t in token_filepaths]))
+	os.makedirs(folder, exist_ok=True)
+	pool = AdAccountPool.from_token_files(token_filepaths)
+	targeting_cache = TargetingCache(path=cache_path)
+	collection = FacebookCollection(batch_string, account_pool=pool, resume=True, path=folder, upload=False, targeting_cache=targeting_cache, **collection_kwargs)
+	collection.create_target_queue(countries)
+	collection.collect()
+	return shard_number
+
+
+class ShardedCollection:
+	"""
+	Represents a collection split across worker processes.
+	The token files are dealt out between shards, at most one shard per token, and the countries list is dealt out in
+	the same way. Each shard keeps its partial store, journal and metrics in its own folder under
+	shards_<batch>, so an interrupted shard resumes where it stopped. The partial stores are merged into the usual
+	store_<batch>.json once every worker has finished, progress in the journal of a worker that crashed is merged too.
+	Resuming with a different number of shards moves countries between shards, which then collect them again.
+	Any other kwargs are passed on to the FacebookCollection of each shard, so they must be picklable to reach the
+	worker processes. A targeting_cache is used by the coordinator and each shard opens its own on the same folder.
+	"""
+	def __init__(self, batch_string, shards=None, token_filepaths=None, path=data_path, upload=True, **collection_kwargs):
+		self.batch_string = batch_string
+		self.token_filepaths = token_filepaths or token_files()
+		if not self.token_filepaths:
+			raise ValueError('No ad account token files to shard')
+		self.shards = min(shards or len(self.token_filepaths), len(self.token_filepaths))
+		self.path = path
+		self.upload = upload
+		# the coordinator collects nothing itself, so it has no journal or spec index, only the store the shards merge into
+		self.pool = AdAccountPool.from_token_files(self.token_filepaths)
+		self.targeting_cache = collection_kwargs.pop('targeting_cache', None) or TargetingCache()
+		reserved = [name for name in shard_kwargs if name in collection_kwargs]
+		if reserved:
+			raise ValueError('Each shard sets {names} for itself, they cannot be given to a sharded collection'.format(names=reserved))
+		try:
+			pickle.dumps(collection_kwargs)
+		except (pickle.PicklingError, TypeError, AttributeError) as e:
+			raise ValueError('The collection kwargs are sent to the shard processes and must be picklable: {e}'.format(e=e))
+		self.collection_kwargs = collection_kwargs
+		self.store = FacebookEstimateJsonStore(os.path.join(path, 'store_{batch}.json'.format(batch=batch_string)))
+
+	def shard_folder(self, shard_number):
+		"""Folder holding the partial store, journal and metrics of a shard"""
+		return os.path.join(self.path, 'shards_{batch}'.format(batch=self.batch_string), 'shard_{n}'.format(n=shard_number))
+
+	def collect(self):
+		"""Run every shard in its own process, then merge the partial stores"""
+		countries = fetch_countries(self.pool, self.targeting_cache)
+		logger.info('Collecting {c} countries in {n} shards'.format(c=len(countries), n=self.shards))
+		context = multiprocessing.get_context('spawn')
+		with ProcessPoolExecutor(max_workers=self.shards, mp_context=context) as executor:
+			futures = [
+				executor.submit(collect_shard, self.batch_string, n, tokens, shard_countries, self.shard_folder(n), self.targeting_cache.path, self.collection_kwargs)
+				for n, (tokens, shard_countries) in enumerate(zip(shard(self.token_filepaths, self.shards), shard(countries, self.shards)))
+			]
+			for n, future in enumerate(futures):
+				try:
+					future.result()
+					logger.info('Shard {n} complete'.format(n=n))
+				except Exception:
+					logger.exception('Shard {n} failed, merging the progress in its journal'.format(n=n))
+		self.merge()
+
+	def merge(self):
+		"""Merge the partial store and journal of every shard into the store for the batch, and upload it"""
+		store = self.store
+		for n in range(self.shards):
+			folder = self.shard_folder(n)
+			partial = FacebookEstimateJsonStore(os.path.join(folder, 'store_{batch}.json'.format(batch=self.batch_string)))
+			journal = EstimateJournal(os.path.join(folder, 'journal_{batch}.jsonl'.format(batch=self.batch_string)))
+			for entry in journal.entries():
+				if not entry.get('failed'):
+					partial.add_entry(entry['country'], entry['gender'], entry['age_min'], entry['age_max'], entry['behaviour'], entry['estimate_dau'], entry['estimate_mau'], timestamp=entry['timestamp'], zero_accepted=entry.get('zero_accepted', False))
+			store.merge(partial.dictionary)
+			logger.info('Merged shard {n} holding {c} countries'.format(n=n, c=len(partial.dictionary)))
+		if self.upload:
+			store.upload(shared_bucket(), self.batch_string)
+		else:
+			store.write()
+		logger.info('Sharded collection {batch} merged into {filepath}'.format(batch=self.batch_string, filepath=store.filepath))
+
+
+if __name__ == "__main__":
+	logging_setup(log_path)
+	batch = str(datetime.date.today().isoformat())
+	ShardedCollection(batch).collect()
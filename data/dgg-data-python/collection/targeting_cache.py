@@ -0,0 +1,108 @@
+"""Class for caching Marketing API targeting search results on disk, so collection does not wait on them at startup"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from facebook_business.adobjects.targetingsearch import TargetingSearch
+
+from storage.dgg_file_structure import data_path
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+targeting_cache_path = os.path.join(data_path, 'targeting_cache')
+
+# Targeting search results rarely change, a day old list of countries is still good for a collection
+default_ttl = 24*60*60
+
+
+class TargetingCache:
+	"""
+	Represents a folder of cached targeting search results, one JSON file per distinct set of search parameters.
+	Results younger than ttl seconds are returned without contacting the API. Older results are still returned
+	straight away but are refreshed in a background thread for the next caller, a failed refresh keeps the stale
+	results. The caller only waits on the API when nothing is cached for the search.
+	"""
+	def __init__(self, path=targeting_cache_path, ttl=default_ttl, attempts=3, retry_wait=10):
+		self.path = path
+		self.ttl = ttl
+		self.attempts = attempts
+		self.retry_wait = retry_wait
+		self.refreshing = {}
+		self.lock = threading.Lock()
+
+	def filepath(self, params):
+		"""Path of the cache file for a set of search parameters"""
+		key = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+		return os.path.join(self.path, 'search_{key}.json'.format(key=key))
+
+	def read(self, params):
+		"""Read the cached entry for the search parameters, None if there is no readable entry"""
+		filepath = self.filepath(params)
+		if not os.path.isfile(filepath):
+			return None
+		try:
+			with open(filepath, 'r') as file:
+				return json.load(file)
+		except (OSError, ValueError):
+			logger.warning('Could not read targeting cache file {filepath}'.format(filepath=filepath))
+			return None
+
+	def write(self, params, results):
+		"""Replace the cached entry for the search parameters, written to a temporary file first so readers never see half an entry"""
+		os.makedirs(self.path, exist_ok=True)
+		filepath = self.filepath(params)
+		temp_filepath = '{filepath}.{thread}.tmp'.format(filepath=filepath, thread=threading.get_ident())
+		with open(temp_filepath, 'w') as file:
+			json.dump({'timestamp': time.time(), 'params': params, 'results': results}, file)
+		os.replace(temp_filepath, filepath)
+
+	def fetch(self, params, api):
+		"""Run the search against the API and cache the results, retrying a few times before giving up"""
+		for attempt in range(1, self.attempts + 1):
+			try:
+				results = TargetingSearch.search(params=params, api=api)
+				results = [dict(result._data) if hasattr(result, '_data') else dict(result) for result in results]
+				self.write(params, results)
+				return results
+			except Exception:
+				if attempt == self.attempts:
+					raise
+				logger.exception('Targeting search attempt {n} failed, retrying in {x} s'.format(n=attempt, x=self.retry_wait))
+				time.sleep(self.retry_wait)
+
+	def refresh(self, params, api):
+		"""Refresh the cached entry for the search parameters in a background thread, unless a refresh is already running"""
+		filepath = self.filepath(params)
+		with self.lock:
+			if filepath in self.refreshing and self.refreshing[filepath].is_alive():
+				return
+
+			def run():
+				try:
+					self.fetch(params, api)
+					logger.info('Refreshed targeting cache file {filepath}'.format(filepath=filepath))
+				except Exception:
+					logger.exception('Could not refresh targeting cache file {filepath}, keeping stale results'.format(filepath=filepath))
+
+			thread = threading.Thread(target=run, name='targeting-refresh', daemon=True)
+			self.refreshing[filepath] = thread
+			thread.start()
+
+	def wait(self):
+		"""Wait for any background refreshes to finish"""
+		for thread in list(self.refreshing.values()):
+			thread.join()
+
+	def search(self, params, api):
+		"""Get the results of a targeting search, from the cache where possible"""
+		entry = self.read(params)
+		if entry:
+			age = time.time() - entry['timestamp']
+			if age >= self.ttl:
+				logger.info('Cached targeting search is {x} h old, refreshing in the background'.format(x=round(age / 3600, 1)))
+				self.refresh(params, api)
+			return entry['results']
+		return self.fetch(params, api)
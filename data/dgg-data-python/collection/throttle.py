@@ -0,0 +1,92 @@
+"""
+Classes for pacing requests using the rate limit usage headers returned with every Marketing API response.
+https://developers.facebook.com/docs/graph-api/overview/rate-limiting/
+"""
+import json
+
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+app_usage_header = 'x-app-usage'
+ad_account_usage_header = 'x-ad-account-usage'
+business_use_case_usage_header = 'x-business-use-case-usage'
+
+
+class UsageReport:
+	"""Represents the usage reported by one response, as percentages of the limits and seconds until access is regained"""
+	def __init__(self, app_usage=0, account_usage=0, regain_seconds=0):
+		self.app_usage = app_usage
+		self.account_usage = account_usage
+		self.regain_seconds = regain_seconds
+
+	def __repr__(self):
+		return '<UsageReport app {app_usage}% account {account_usage}% regain {regain_seconds} s>'.format(**vars(self))
+
+
+def load_header(headers, name):
+	"""
+	Decode a JSON usage header, header names are matched case insensitively and missing headers decode as {}.
+	Headers can be a mapping or, as in the responses within a batch call, a list of {'name': ..., 'value': ...}
+	"""
+	if isinstance(headers, list):
+		headers = {header['name']: header['value'] for header in headers}
+	for key, value in (headers or {}).items():
+		if key.lower() == name:
+			try:
+				return json.loads(value)
+			except ValueError:
+				logger.warning('Could not decode usage header {name}: {value}'.format(name=name, value=value))
+	return {}
+
+
+def parse_usage_headers(headers):
+	"""Read the app, ad account and business use case usage headers of a response into a UsageReport"""
+	report = UsageReport()
+
+	app_usage = load_header(headers, app_usage_header)
+	report.app_usage = max([app_usage.get('call_count', 0), app_usage.get('total_time', 0), app_usage.get('total_cputime', 0)])
+
+	account_usage = load_header(headers, ad_account_usage_header)
+	report.account_usage = account_usage.get('acc_id_util_pct', 0)
+	report.regain_seconds = account_usage.get('reset_time_duration', 0)
+
+	for business_usages in load_header(headers, business_use_case_usage_header).values():
+		for usage in business_usages:
+			report.account_usage = max([report.account_usage, usage.get('call_count', 0), usage.get('total_time', 0), usage.get('total_cputime', 0)])
+			# reported in minutes
+			report.regain_seconds = max(report.regain_seconds, usage.get('estimated_time_to_regain_access', 0) * 60)
+	return report
+
+
+class UsageThrottle:
+	"""
+	Paces requests so that usage approaches but does not cross the limits.
+	Below pace_usage percent requests are sent as fast as they are answered, between pace_usage and target_usage the
+	interval between requests grows quadratically towards max_interval, so the request rate eases off smoothly
+	instead of stopping dead when the limit is hit.
+	The time to regain access is sent with every response, however low the usage, so an account is only held back for
+	it once its usage reaches target_usage.
+	"""
+	def __init__(self, pace_usage=50, target_usage=90, max_interval=10):
+		self.pace_usage = pace_usage
+		self.target_usage = target_usage
+		self.max_interval = max_interval
+
+	def interval(self, usage):
+		"""Seconds to leave between requests at the given usage percentage"""
+		if usage >= self.target_usage:
+			return self.max_interval
+		if usage <= self.pace_usage:
+			return 0
+		return self.max_interval * ((usage - self.pace_usage) / (self.target_usage - self.pace_usage)) ** 2
+
+	def account_delay(self, report):
+		"""Seconds until the ad account that received the report should send its next request"""
+		if report.account_usage >= self.target_usage:
+			return max(report.regain_seconds, self.interval(report.account_usage))
+		return self.interval(report.account_usage)
+
+	def app_delay(self, report):
+		"""Seconds until any account should send its next request, the app limit is shared by every account"""
+		return self.interval(report.app_usage)
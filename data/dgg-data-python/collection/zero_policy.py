@@ -0,0 +1,57 @@
+"""Classes for deciding when a zero sized population returned by the Marketing API is the real estimate"""
+import datetime
+import os
+
+from storage.dgg_file_structure import data_path
+from storage.estimate_store import FacebookEstimateJsonStore
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+
+class EstimateHistory:
+	"""Represents the estimate stores of the days before a collection, read from the local data folder"""
+	def __init__(self, batch_string, days=7, path=data_path):
+		self.stores = []
+		try:
+			batch_date = datetime.date.fromisoformat(batch_string)
+		except ValueError:
+			logger.warning('Batch {batch} is not a date, no previous estimates loaded'.format(batch=batch_string))
+			return
+		for day in range(1, days + 1):
+			date_string = (batch_date - datetime.timedelta(days=day)).isoformat()
+			store_path = os.path.join(path, 'store_{timestamp}.json'.format(timestamp=date_string))
+			if os.path.isfile(store_path):
+				self.stores += [FacebookEstimateJsonStore(store_path)]
+		logger.info('Loaded {n} previous estimate stores from the last {d} days'.format(n=len(self.stores), d=days))
+
+	def previously_zero(self, country, gender, age_min, age_max, behaviour):
+		"""
+		Check whether the previous days collected these dimensions and every estimate they collected was zero.
+		Dimensions with no history, e.g. a new behaviour or country, are not previously zero
+		"""
+		entries = [store.get_entry(country, gender, age_min, age_max, behaviour) for store in self.stores]
+		entries = [entry for entry in entries if entry]
+		if not entries:
+			return False
+		return not any(entry.get('estimate_mau') for entry in entries)
+
+
+class ZeroPopulationPolicy:
+	"""
+	Decides when a zero sized population is accepted instead of being requested again until the deadline.
+	A zero is accepted once the same request has returned consistent_zeros zeros in a row, or straight away if the
+	request was collected on previous days and every estimate collected for it was zero.
+	Accepted zeros are stored flagged zero_accepted, so the analysis can tell them from estimates of zero.
+	"""
+	def __init__(self, consistent_zeros=3, history=None):
+		self.consistent_zeros = consistent_zeros
+		self.history = history
+
+	def accept(self, request):
+		"""Check whether the zero population the request has just returned should be accepted"""
+		if request.error_count >= self.consistent_zeros:
+			return True
+		if self.history and self.history.previously_zero(*request.dimensions()):
+			return True
+		return False
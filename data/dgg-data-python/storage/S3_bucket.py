@@ -1,44 +1,190 @@
 """Convenience classes representing an S3 bucket and wrapping some boto3 functions"""
+import io
 import json
 import os
+import shutil
+import threading
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
 
+from storage.bucket_cache import BucketCache
+from storage.bucket_cache import chunk_bytes
 from storage.dgg_file_structure import auth_path
 from dgg_log import root_logger
 
 logger = root_logger.getChild(__name__)
 
 s3_auth = os.path.join(auth_path, 'S3_keys.json')
+default_bucket = 'www.digitalgendergaps.org'
+
+# Connections are kept open and reused between calls, enough for a pool of transfer threads
+client_config = Config(max_pool_connections=32, tcp_keepalive=True, retries={'max_attempts': 5, 'mode': 'standard'})
+
+# Bodies over the threshold are sent and fetched as multipart transfers of chunksize parts
+transfer_config = TransferConfig(multipart_threshold=16*1024*1024, multipart_chunksize=16*1024*1024, max_concurrency=4)
+# Objects transferred at once by put_many and get_many, and attempts at each object before it is given up on
+transfer_workers = 8
+transfer_attempts = 3
+transfer_retry_wait = 2
+
+# Local cache of the objects read from every bucket in the process
+bucket_cache = BucketCache()
+
+# Process wide registry of clients by key file and buckets by (name, key file), boto3 clients are thread safe
+clients = {}
+buckets = {}
+registry_lock = threading.Lock()
+
+
+def shared_client(key_filepath=s3_auth):
+	"""Get the S3 client for a key file, the keys are loaded and the client built on first use only"""
+	with registry_lock:
+		if key_filepath not in clients:
+			with open(key_filepath) as key_file:
+				s3_keys = json.load(key_file)
+			clients[key_filepath] = boto3.client('s3', config=client_config, **s3_keys)
+		return clients[key_filepath]
+
+
+def shared_bucket(bucket=default_bucket, key_filepath=s3_auth):
+	"""Get the S3Bucket for a bucket and key file, shared by every module in the process so its connections stay warm"""
+	with registry_lock:
+		if (bucket, key_filepath) in buckets:
+			return buckets[(bucket, key_filepath)]
+	s3_bucket = S3Bucket(bucket, key_filepath)
+	if hasattr(s3_bucket, 'client'):
+		with registry_lock:
+			s3_bucket = buckets.setdefault((bucket, key_filepath), s3_bucket)
+	return s3_bucket
 
 
 class S3Bucket:
-	"""Represents an S3 bucket, defaults to our usual bucket and loads the auth keys from a file in the auth folder"""
-	def __init__(self, bucket='www.digitalgendergaps.org', key_filepath=s3_auth):
+	"""
+	Represents an S3 bucket, defaults to our usual bucket and loads the auth keys from a file in the auth folder.
+	Use shared_bucket rather than constructing one, buckets with the same key file share a pooled client either way.
+	Objects read with get go through the local cache, validated by ETag, unless cache is given as None
+	"""
+	def __init__(self, bucket=default_bucket, key_filepath=s3_auth, cache=bucket_cache):
 		self.bucket = bucket
+		self.cache = cache
 		try:
-			with open(key_filepath) as key_file:
-				s3_keys = json.load(key_file)
-				self.client = boto3.client('s3', **s3_keys)
+			self.client = shared_client(key_filepath)
 		except EnvironmentError:
 			logger.error(f'S3 credentials failed to load from {key_filepath}')
 
-	def put(self, file_key, file_body):
-		"""Put a binary file stream into the bucket with the given remote filepath"""
+	def put(self, file_key, file_body, **conditions):
+		"""
+		Put a binary file stream, or bytes, into the bucket with the given remote filepath, returning its ETag.
+		conditions are passed on to put_object, e.g. IfMatch to only replace the version of the object with that ETag
+		"""
 		# TODO exception handling
 		logger.info(f"Saving file '{file_key}' to {self.bucket}")
-		self.client.put_object(Bucket=self.bucket, Key=file_key, Body=file_body)
+		response = self.client.put_object(Bucket=self.bucket, Key=file_key, Body=file_body, **conditions)
+		return response['ETag']
 
-	def get(self, file_key):
-		"""Get an object from the given remote filepath"""
+	def get(self, file_key, bypass_cache=False):
+		"""
+		Get an object from the given remote filepath, served from the local cache if it is unchanged in the bucket.
+		The Body of the response must be closed once read, e.g. with contextlib.closing, a large cached body holds its
+		file open until then
+		"""
 		logger.info(f"Getting file '{file_key}' from {self.bucket}")
-		return self.client.get_object(Bucket=self.bucket, Key=file_key)
+		if self.cache is None or bypass_cache:
+			return self.client.get_object(Bucket=self.bucket, Key=file_key)
+		return self.cache.get(self.client, self.bucket, file_key)
 
 	def get_folder(self, path):
 		"""Create a folder object representing a remote filepath in the bucket"""
 		return S3Folder(self, path)
 
+	def transfer(self, description, function, attempts):
+		"""
+		Run one object transfer, retrying failures with a growing wait.
+		Returns True if it succeeded, None if the object is missing, which is not retried, and False if it failed
+		"""
+		for attempt in range(1, attempts + 1):
+			try:
+				function()
+				return True
+			except ClientError as e:
+				if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+					logger.info(f'{description} not found in {self.bucket}')
+					return None
+				error = e
+			except (BotoCoreError, OSError) as e:
+				error = e
+			if attempt < attempts:
+				logger.warning(f'{description} attempt {attempt} failed, retrying: {error}')
+				time.sleep(transfer_retry_wait * attempt)
+		logger.error(f'{description} failed after {attempts} attempts: {error}')
+		return False
+
+	def upload(self, file_key, source, attempts=transfer_attempts):
+		"""Upload a local filepath or bytes to the bucket, as a multipart upload when large, returns whether it succeeded"""
+		def run():
+			if isinstance(source, (bytes, bytearray)):
+				self.client.upload_fileobj(io.BytesIO(source), self.bucket, file_key, Config=transfer_config)
+			else:
+				self.client.upload_file(source, self.bucket, file_key, Config=transfer_config)
+		logger.info(f"Saving file '{file_key}' to {self.bucket}")
+		return self.transfer(f"Saving file '{file_key}'", run, attempts)
+
+	def download(self, file_key, filepath, attempts=transfer_attempts, bypass_cache=False):
+		"""
+		Download an object to a local filepath, returns whether it succeeded, None if the object is missing.
+		Goes through the local cache unless it is bypassed, otherwise as a multipart download when large.
+		The file is only replaced once the whole object has arrived, a missing object is not retried
+		"""
+		temp_filepath = f'{filepath}.tmp'
+
+		def run():
+			if self.cache is None or bypass_cache:
+				self.client.download_file(self.bucket, file_key, temp_filepath, Config=transfer_config)
+			else:
+				body = self.cache.get(self.client, self.bucket, file_key)['Body']
+				try:
+					with open(temp_filepath, 'wb') as file:
+						shutil.copyfileobj(body, file, chunk_bytes)
+				finally:
+					body.close()
+			os.replace(temp_filepath, filepath)
+		logger.info(f"Getting file '{file_key}' from {self.bucket}")
+		downloaded = self.transfer(f"Getting file '{file_key}'", run, attempts)
+		if not downloaded and os.path.isfile(temp_filepath):
+			os.remove(temp_filepath)
+		return downloaded
+
+	def put_many(self, items, workers=transfer_workers, attempts=transfer_attempts):
+		"""
+		Upload many (key, local filepath or bytes) items at once with a pool of worker threads.
+		Returns the keys that could not be uploaded
+		"""
+		items = list(items)
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			results = list(executor.map(lambda item: self.upload(*item, attempts=attempts), items))
+		return [key for (key, _), uploaded in zip(items, results) if not uploaded]
+
+	def get_many(self, items, workers=transfer_workers, attempts=transfer_attempts, bypass_cache=False):
+		"""
+		Download many (key, local filepath) items at once with a pool of worker threads.
+		Returns the keys that were downloaded, missing objects are left out. Any other failure is logged as it happens
+		and a RuntimeError listing the failed keys is raised once every item has been tried
+		"""
+		items = list(items)
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			results = list(executor.map(lambda item: self.download(*item, attempts=attempts, bypass_cache=bypass_cache), items))
+		failed = [key for (key, _), downloaded in zip(items, results) if downloaded is False]
+		if failed:
+			raise RuntimeError(f'Could not download {failed}')
+		return [key for (key, _), downloaded in zip(items, results) if downloaded]
+
 
 # TODO use folder
 class S3Folder:
@@ -52,10 +198,18 @@ class S3Folder:
 		"""Puts a binary file stream into the bucket folder"""
 		self.bucket.put(urllib.parse.urljoin(self.path, filename), file_body)
 
-	def get(self, file_key):
+	def get(self, file_key, bypass_cache=False):
 		"""Get an object from the given remote filepath"""
 		logger.info(f"Getting file '{file_key}' from {self.bucket}")
-		return self.bucket.get(urllib.parse.urljoin(self.path, file_key))
+		return self.bucket.get(urllib.parse.urljoin(self.path, file_key), bypass_cache)
+
+	def put_many(self, items, **kwargs):
+		"""Upload many (filename, local filepath or bytes) items into the bucket folder at once"""
+		return self.bucket.put_many([(urllib.parse.urljoin(self.path, filename), source) for filename, source in items], **kwargs)
+
+	def get_many(self, items, **kwargs):
+		"""Download many (filename, local filepath) items from the bucket folder at once"""
+		return self.bucket.get_many([(urllib.parse.urljoin(self.path, filename), filepath) for filename, filepath in items], **kwargs)
 
 	def get_folder(self, path):
 		"""Create a folder object representing a remote filepath in the bucket"""
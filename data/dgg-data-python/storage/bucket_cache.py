@@ -0,0 +1,167 @@
+"""Class for a local disk cache of bucket objects, validated against the bucket by ETag on every read"""
+import hashlib
+import io
+import json
+import os
+import threading
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+from storage.dgg_file_structure import data_path
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+bucket_cache_path = os.path.join(data_path, 'bucket_cache')
+# Total size of the cached bodies, the least recently used are evicted beyond it
+default_max_bytes = 1024*1024*1024
+# Bodies are streamed to and from disk in chunks of this size, never held in memory whole
+chunk_bytes = 1024*1024
+# Cached bodies up to this size are served from memory, larger ones from the open cached file
+default_memory_max_bytes = 16*1024*1024
+
+
+class BucketCache:
+	"""
+	Represents a folder of cached bucket objects, each a body file with a JSON file of its ETag beside it.
+	A read of a cached object sends a conditional GET with If-None-Match, an unchanged object comes back as a
+	304 with no body and is served from disk, a changed one replaces the cached copy. The modification time of a body
+	file is its last use, once the bodies pass max_bytes the least recently used are removed.
+	Bodies are streamed to disk in chunks. Bodies up to memory_max_bytes are served from memory with the cached file
+	already closed, larger ones are served from the open cached file, so the Body of a response must be closed once read.
+	enabled False bypasses the cache, every read fetches the whole object and nothing is written to disk.
+	"""
+	def __init__(self, path=bucket_cache_path, max_bytes=default_max_bytes, enabled=True, memory_max_bytes=default_memory_max_bytes):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.memory_max_bytes = memory_max_bytes
+		self.enabled = enabled
+		self.lock = threading.Lock()
+
+	def filepath(self, bucket, file_key):
+		"""Path of the cached body of an object, the metadata file has the same path with .json added"""
+		key = hashlib.sha1('{bucket}/{key}'.format(bucket=bucket, key=file_key).encode('utf-8')).hexdigest()
+		return os.path.join(self.path, key)
+
+	def read_metadata(self, filepath):
+		"""Read the metadata of a cached object, None if it is not cached"""
+		if not os.path.isfile(filepath):
+			return None
+		try:
+			with open(filepath + '.json', 'r') as file:
+				return json.load(file)
+		except (OSError, ValueError):
+			return None
+
+	def response(self, filepath, metadata):
+		"""
+		Build a get_object style response around a cached body. A body up to memory_max_bytes is read into memory and
+		the file closed, a larger one is read from the open file and is only closed with the Body
+		"""
+		file = open(filepath, 'rb')
+		size = os.fstat(file.fileno()).st_size
+		if size <= self.memory_max_bytes:
+			with file:
+				body = io.BytesIO(file.read())
+		else:
+			body = file
+		return {
+			'Body': StreamingBody(body, size),
+			'ETag': metadata['ETag'],
+			'ContentLength': size,
+			'ContentType': metadata.get('ContentType'),
+		}
+
+	def get(self, client, bucket, file_key):
+		"""Get an object through the cache, a missing object raises NoSuchKey as get_object does"""
+		if not self.enabled:
+			return client.get_object(Bucket=bucket, Key=file_key)
+		filepath = self.filepath(bucket, file_key)
+		metadata = self.read_metadata(filepath)
+		try:
+			if metadata:
+				response = client.get_object(Bucket=bucket, Key=file_key, IfNoneMatch=metadata['ETag'])
+			else:
+				response = client.get_object(Bucket=bucket, Key=file_key)
+		except ClientError as e:
+			if metadata and e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+				try:
+					response = self.response(filepath, metadata)
+					os.utime(filepath)
+					logger.debug(f"Serving unchanged '{file_key}' from the bucket cache")
+					return response
+				except OSError:
+					# evicted since the metadata was read
+					response = client.get_object(Bucket=bucket, Key=file_key)
+			else:
+				raise
+		metadata = {'Bucket': bucket, 'Key': file_key, 'ETag': response['ETag'], 'ContentType': response.get('ContentType')}
+		try:
+			self.write(filepath, response['Body'], metadata)
+			# opened before eviction, so the body is still readable if it is evicted straight away
+			cached = self.response(filepath, metadata)
+		except OSError:
+			logger.exception(f"Could not cache '{file_key}'")
+			return client.get_object(Bucket=bucket, Key=file_key)
+		self.evict()
+		return cached
+
+	def write(self, filepath, body, metadata):
+		"""Cache an object's body, streamed in chunks, and its metadata, each written to a temporary file first"""
+		os.makedirs(self.path, exist_ok=True)
+		suffix = '.{thread}.tmp'.format(thread=threading.get_ident())
+		try:
+			with open(filepath + suffix, 'wb') as file:
+				for chunk in body.iter_chunks(chunk_bytes):
+					file.write(chunk)
+			with open(filepath + '.json' + suffix, 'w') as file:
+				json.dump(metadata, file)
+		except BaseException:
+			for path in (filepath + suffix, filepath + '.json' + suffix):
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+			raise
+		finally:
+			body.close()
+		# the old metadata goes first so a reader never validates the new body with the old ETag
+		try:
+			os.remove(filepath + '.json')
+		except OSError:
+			pass
+		os.replace(filepath + suffix, filepath)
+		os.replace(filepath + '.json' + suffix, filepath + '.json')
+
+	def evict(self):
+		"""Remove the least recently used objects until the cached bodies fit in max_bytes"""
+		with self.lock:
+			entries = []
+			with os.scandir(self.path) as scan:
+				for entry in scan:
+					if entry.is_file() and '.' not in entry.name:
+						stat = entry.stat()
+						entries.append((stat.st_mtime, stat.st_size, entry.path))
+			total = sum(size for _, size, _ in entries)
+			for _, size, filepath in sorted(entries):
+				if total <= self.max_bytes:
+					break
+				for path in (filepath + '.json', filepath):
+					try:
+						os.remove(path)
+					except OSError:
+						pass
+				total -= size
+				logger.debug(f'Evicted {filepath} from the bucket cache')
+
+	def clear(self):
+		"""Remove every cached object"""
+		with self.lock:
+			if not os.path.isdir(self.path):
+				return
+			for name in os.listdir(self.path):
+				try:
+					os.remove(os.path.join(self.path, name))
+				except OSError:
+					pass
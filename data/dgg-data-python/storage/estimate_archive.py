@@ -0,0 +1,242 @@
+"""
+Class for a columnar archive of the estimates of every collection day, a Parquet dataset partitioned by date.
+Run to ingest any collection days in the bucket, or local store files, that are not in the archive yet.
+"""
+import argparse
+import contextlib
+import datetime
+import glob
+import json
+import os
+import re
+
+import pyarrow
+import pyarrow.dataset
+import pyarrow.parquet
+
+from storage.S3_bucket import shared_bucket
+from storage.dgg_file_structure import data_path
+from storage.dgg_file_structure import log_path
+from storage.estimate_store import store_entries
+from dgg_log import logging_setup
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+archive_path = os.path.join(data_path, 'archive')
+
+# One row per estimate, the date is the partition key and is not stored in the files
+archive_schema = pyarrow.schema([
+	('country', pyarrow.string()),
+	('gender', pyarrow.string()),
+	('age_group', pyarrow.string()),
+	('behaviour', pyarrow.string()),
+	('estimate', pyarrow.string()),
+	('value', pyarrow.int64()),
+	('timestamp', pyarrow.float64()),
+	('zero_accepted', pyarrow.bool_()),
+])
+partitioning = pyarrow.dataset.partitioning(pyarrow.schema([('date', pyarrow.string())]), flavor='hive')
+
+# Store files of a collection day in the bucket, newest naming first
+store_keys = ['data/{date}/store_{date}.json', 'data/{date}/reach_{date}.json', 'data/{date}/reach.json']
+
+
+def store_table(dictionary):
+	"""Flatten a nested store dictionary into a table of the archive schema, one row per dau or mau estimate"""
+	columns = {name: [] for name in archive_schema.names}
+	for country, gender, key, behaviour, record in store_entries(dictionary):
+		for estimate in ['dau', 'mau']:
+			value = record.get('estimate_{estimate}'.format(estimate=estimate))
+			if value is None:
+				continue
+			columns['country'] += [country]
+			columns['gender'] += [gender]
+			columns['age_group'] += [key]
+			columns['behaviour'] += [behaviour]
+			columns['estimate'] += [estimate]
+			columns['value'] += [int(value)]
+			columns['timestamp'] += [record.get('timestamp')]
+			columns['zero_accepted'] += [record.get('zero_accepted', False)]
+	return pyarrow.Table.from_pydict(columns, schema=archive_schema)
+
+
+class EstimateArchive:
+	"""
+	Represents the archive, a folder holding one date=<YYYY-MM-DD> partition per collection day.
+	Reads only open the partitions in the date range asked for and only decode the columns asked for, so a question
+	over months of collections does not parse every day's store.
+	"""
+	def __init__(self, path=archive_path):
+		self.path = path
+
+	def partition_path(self, date):
+		"""Folder holding the estimates of one collection day"""
+		return os.path.join(self.path, 'date={date}'.format(date=date))
+
+	def dates(self):
+		"""Sorted list of the collection days in the archive"""
+		filepaths = glob.glob(os.path.join(self.path, 'date=*', 'estimates.parquet'))
+		return sorted(os.path.basename(os.path.dirname(filepath))[len('date='):] for filepath in filepaths)
+
+	def has_date(self, date):
+		"""Check whether a collection day is in the archive"""
+		return os.path.isfile(os.path.join(self.partition_path(date), 'estimates.parquet'))
+
+	def add(self, date, dictionary):
+		"""Add a collection day's store dictionary to the archive, replacing the day if it is already there"""
+		table = store_table(dictionary)
+		folder = self.partition_path(date)
+		os.makedirs(folder, exist_ok=True)
+		filepath = os.path.join(folder, 'estimates.parquet')
+		# dot files are left out of the dataset, so a reader never sees the day half written
+		temp_filepath = os.path.join(folder, '.estimates.parquet.tmp')
+		pyarrow.parquet.write_table(table, temp_filepath)
+		os.replace(temp_filepath, filepath)
+		logger.info('Archived {n} estimates for {date}'.format(n=table.num_rows, date=date))
+		return table.num_rows
+
+	def dataset(self):
+		"""The archive as a pyarrow dataset, for queries beyond read, columns missing from older days read as null"""
+		schema = archive_schema.append(pyarrow.field('date', pyarrow.string()))
+		return pyarrow.dataset.dataset(self.path, format='parquet', partitioning=partitioning, schema=schema)
+
+	def read(self, columns=None, start=None, end=None, estimate=None, countries=None):
+		"""
+		Read estimates from the archive as a pyarrow Table.
+		columns limits the columns read, the date column included, start and end limit the collection days read
+		inclusively, estimate limits the rows to 'dau' or 'mau' and countries to a list of country codes
+		"""
+		expression = None
+		conditions = []
+		if start:
+			conditions += [pyarrow.dataset.field('date') >= str(start)]
+		if end:
+			conditions += [pyarrow.dataset.field('date') <= str(end)]
+		if estimate:
+			conditions += [pyarrow.dataset.field('estimate') == estimate]
+		if countries:
+			conditions += [pyarrow.dataset.field('country').isin(list(countries))]
+		for condition in conditions:
+			expression = condition if expression is None else expression & condition
+		return self.dataset().to_table(columns=columns, filter=expression)
+
+	def estimates(self, date, estimate='mau'):
+		"""
+		Get a collection day's estimate_<estimate> values in the nested store layout, as preprocess_counts takes them,
+		reading only that day's partition and the columns needed
+		"""
+		estimate_key = 'estimate_{estimate}'.format(estimate=estimate)
+		dictionary = {}
+		for country, gender, key, behaviour, value in self.rows(start=date, end=date, estimate=estimate):
+			estimates = dictionary.setdefault(country, {'errors': 0}).setdefault(gender, {}).setdefault(key, {})
+			if behaviour:
+				estimates.setdefault(behaviour, {})[estimate_key] = value
+			else:
+				estimates[estimate_key] = value
+		return dictionary
+
+	def daily_values(self, start, end, estimate='mau'):
+		"""
+		Get every day's estimates between the start and end dates inclusive, nested by country, gender, age key and
+		behaviour with a list of the daily values under estimate_<estimate>, as MonthlyAnalysis averages them
+		"""
+		estimate_key = 'estimate_{estimate}'.format(estimate=estimate)
+		values = {}
+		for country, gender, key, behaviour, value in self.rows(start=start, end=end, estimate=estimate):
+			estimates = values.setdefault(country, {}).setdefault(gender, {}).setdefault(key, {})
+			if behaviour:
+				estimates = estimates.setdefault(behaviour, {})
+			estimates.setdefault(estimate_key, []).append(value)
+		return values
+
+	def rows(self, start, end, estimate):
+		"""Generate (country, gender, age key, behaviour, value) for the estimates of one type in a date range"""
+		columns = ['country', 'gender', 'age_group', 'behaviour', 'value']
+		table = self.read(columns=columns, start=start, end=end, estimate=estimate)
+		return zip(*(table.column(name).to_pylist() for name in columns))
+
+	def ingest_file(self, date, filepath):
+		"""Add a collection day to the archive from a local store file"""
+		with open(filepath, 'r') as file:
+			return self.add(date, json.load(file))
+
+	def ingest_bucket(self, bucket, date):
+		"""Add a collection day to the archive from its store file in the bucket, False if the day has no store file"""
+		for key in store_keys:
+			try:
+				response = bucket.get(key.format(date=date))
+			except bucket.client.exceptions.NoSuchKey:
+				continue
+			with contextlib.closing(response['Body']) as body:
+				self.add(date, json.loads(body.read()))
+			return True
+		logger.warning('Cannot find data store for {date}'.format(date=date))
+		return False
+
+
+def bucket_dates(bucket):
+	"""List the collection days in the bucket"""
+	paginator = bucket.client.get_paginator('list_objects_v2')
+	dates = []
+	for prefix in paginator.paginate(Bucket=bucket.bucket, Prefix='data/', Delimiter='/').search('CommonPrefixes'):
+		if prefix:
+			date = prefix['Prefix'].split('/')[1]
+			if re.fullmatch(r'\d{4}-\d{2}-\d{2}', date):
+				dates += [date]
+	return sorted(dates)
+
+
+def local_dates(path=data_path):
+	"""List the collection days with a store file in a local folder"""
+	dates = []
+	for filepath in glob.glob(os.path.join(path, 'store_*.json')):
+		date = os.path.basename(filepath)[len('store_'):-len('.json')]
+		if re.fullmatch(r'\d{4}-\d{2}-\d{2}', date):
+			dates += [date]
+	return sorted(dates)
+
+
+def ingest(archive, dates=None, local=False, replace=False):
+	"""
+	Add the collection days to the archive, by default every day not yet in it, from the bucket or local store files.
+	Days with no store file are warned about and skipped. Returns the days that could not be archived
+	"""
+	bucket = None
+	if local:
+		available = local_dates()
+	else:
+		bucket = shared_bucket()
+		available = bucket_dates(bucket)
+	failed = []
+	for date in dates or available:
+		if archive.has_date(date) and not replace:
+			continue
+		if date not in available:
+			logger.warning('Cannot find data store for {date}'.format(date=date))
+			continue
+		try:
+			if local:
+				archive.ingest_file(date, os.path.join(data_path, 'store_{date}.json'.format(date=date)))
+			else:
+				archive.ingest_bucket(bucket, date)
+		except Exception:
+			logger.exception('Could not archive {date}'.format(date=date))
+			failed += [date]
+	return failed
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('dates', nargs='*', help='collection days to ingest, every day not yet archived by default')
+	parser.add_argument('--local', action='store_true', help='ingest the store files in the data folder rather than the bucket')
+	parser.add_argument('--replace', action='store_true', help='ingest days that are already archived again')
+	parser.add_argument('--yesterday', action='store_true', help="ingest yesterday's collection")
+	arguments = parser.parse_args()
+	logging_setup(log_path)
+	dates = arguments.dates
+	if arguments.yesterday:
+		dates += [(datetime.date.today() - datetime.timedelta(days=1)).isoformat()]
+	failed = ingest(EstimateArchive(), dates, local=arguments.local, replace=arguments.replace)
+	if failed:
+		raise RuntimeError('Could not archive {failed}'.format(failed=failed))
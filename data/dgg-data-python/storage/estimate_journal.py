@@ -0,0 +1,92 @@
+"""Class for an append-only progress journal, recording each estimate durably as soon as it is collected"""
+import json
+import os
+import threading
+
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+
+class EstimateJournal:
+	"""
+	Represents a JSON Lines journal file, one line per completed request.
+	Each line is flushed to the operating system as it is appended, so it survives the process crashing. A background
+	thread fsyncs the file whenever lines are waiting, so lines appended while one fsync runs share the next, and
+	appending never waits on the disk.
+	"""
+	def __init__(self, filepath):
+		self.filepath = filepath
+		self.file = None
+		self.lock = threading.Lock()
+		self.unsynced = threading.Event()
+		self.closing = False
+		self.syncer = None
+
+	def open(self):
+		"""Open the journal for appending, ending a truncated final line left by a crash so the next line stands alone"""
+		partial = False
+		if os.path.isfile(self.filepath) and os.path.getsize(self.filepath):
+			with open(self.filepath, 'rb') as file:
+				file.seek(-1, os.SEEK_END)
+				partial = file.read(1) != b'\n'
+		self.file = open(self.filepath, 'a')
+		if partial:
+			self.file.write('\n')
+		self.closing = False
+		self.syncer = threading.Thread(target=self.sync_loop, name='journal-sync', daemon=True)
+		self.syncer.start()
+
+	def append(self, entry):
+		"""Append an entry to the journal, it is fsynced by the background thread shortly after"""
+		line = json.dumps(entry) + '\n'
+		with self.lock:
+			if not self.file:
+				self.open()
+			self.file.write(line)
+			self.file.flush()
+		self.unsynced.set()
+
+	def sync_loop(self):
+		"""fsync the journal whenever lines have been appended since the last fsync, until it is closed"""
+		while True:
+			self.unsynced.wait()
+			self.unsynced.clear()
+			if self.closing:
+				return
+			self.sync()
+
+	def sync(self):
+		"""fsync the lines appended so far"""
+		file = self.file
+		if file:
+			try:
+				os.fsync(file.fileno())
+			except (OSError, ValueError):
+				# closed while syncing, close fsyncs it
+				pass
+
+	def entries(self):
+		"""Read the entries in the journal, a truncated final line left by a crash is skipped"""
+		if not os.path.isfile(self.filepath):
+			return
+		with open(self.filepath, 'r') as file:
+			for line_number, line in enumerate(file, start=1):
+				try:
+					yield json.loads(line)
+				except json.decoder.JSONDecodeError:
+					logger.warning('Skipping unreadable line {n} of journal {filepath}'.format(n=line_number, filepath=self.filepath))
+
+	def close(self):
+		"""Stop the background thread, fsync anything left and close the journal file"""
+		if self.syncer:
+			self.closing = True
+			self.unsynced.set()
+			self.syncer.join()
+			self.syncer = None
+		with self.lock:
+			if self.file:
+				self.file.flush()
+				os.fsync(self.file.fileno())
+				self.file.close()
+				self.file = None
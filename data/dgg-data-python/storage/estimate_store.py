@@ -2,21 +2,88 @@
 Classes for data storage, different implementations for different underlying storage, JSON files, databases etc
 via a common interface
 """
+import array
+import math
 import time
 import json
 import os
 import pathlib
+import sqlite3
 
+from storage.dgg_file_structure import data_path
+from storage.estimate_journal import EstimateJournal
 from dgg_log import root_logger
 
 logger = root_logger.getChild(__name__)
 
+# SQLite database holding the estimates of every collection day
+estimates_database_path = os.path.join(data_path, 'estimates.db')
+insert_estimate = (
+	'INSERT OR REPLACE INTO estimates (date, country, gender, age_key, behaviour, age_min, age_max, estimate_dau, estimate_mau, timestamp, zero_accepted) '
+	'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+)
+# kinds of store a collection can be run into, see open_store
+store_kinds = ('json', 'sqlite', 'array')
+
+
+def age_key(age_min, age_max):
+	"""Get the key used for an age range in the store, e.g. '18+' or '20-24'"""
+	if age_max and age_max > age_min:
+		return '{min}-{max}'.format(min=age_min, max=age_max)
+	else:
+		return '{min}+'.format(min=age_min)
+
+
+def parse_age_key(key):
+	"""Get the (age_min, age_max) of an age key, age_max None for an open range such as '18+'"""
+	if key.endswith('+'):
+		return int(key[:-1]), None
+	age_min, age_max = key.split('-')
+	return int(age_min), int(age_max)
+
+
+def open_store(kind, batch_string, path=data_path):
+	"""
+	Open the estimate store of the given kind for a batch, 'json' for the JSON file in path, 'sqlite' for the day in
+	the estimates database in path or 'array' for the array store of the JSON file in path.
+	The collection's journal keeps the estimates durable, so the JSON stores do not log them a second time
+	"""
+	filepath = os.path.join(path, 'store_{timestamp}.json'.format(timestamp=batch_string))
+	if kind == 'json':
+		return FacebookEstimateJsonStore(filepath)
+	elif kind == 'array':
+		return FacebookEstimateArrayStore(filepath)
+	elif kind == 'sqlite':
+		return FacebookEstimateSQLiteStore(batch_string, os.path.join(path, os.path.basename(estimates_database_path)))
+	raise ValueError('Unknown estimate store kind {kind}, expected one of {kinds}'.format(kind=kind, kinds=store_kinds))
+
+
+def store_entries(dictionary):
+	"""
+	Generate (country, gender, age key, behaviour, record) for every estimate in a nested store dictionary, the
+	behaviour None for the estimate of an age range itself. Works with the older reach files, which share the layout
+	"""
+	for country, genders in dictionary.items():
+		if not isinstance(genders, dict):
+			continue
+		for gender, age_ranges in genders.items():
+			if not isinstance(age_ranges, dict):
+				continue
+			for key, estimates in age_ranges.items():
+				if 'estimate_mau' in estimates or 'estimate_dau' in estimates:
+					yield country, gender, key, None, estimates
+				for behaviour, record in estimates.items():
+					if isinstance(record, dict):
+						yield country, gender, key, behaviour, record
+
 
 class FacebookEstimateJsonStore:
 	"""Represents a store using a JSON file"""
 	def __init__(self, filepath):
 		self.filepath = filepath
 		self.dictionary = {}
+		# whether the store holds anything not yet in its file
+		self.changed = False
 		# TODO use pathlib more generally
 		if pathlib.Path(self.filepath).is_file():
 			try:
@@ -25,53 +92,89 @@ class FacebookEstimateJsonStore:
 				logger.info('Decoding error while loading estimate store from file "{filepath}" store object created empty'.format(**vars(self)))
 				self.dictionary = {}
 
-	def add_entry(self, country, gender, age_min, age_max, behaviour, dau, mau):
-		"""Record a reach estimate into the store"""
+	def add_entry(self, country, gender, age_min, age_max, behaviour, dau, mau, timestamp=None, zero_accepted=False):
+		"""Record a reach estimate into the store, zero_accepted flags a zero sized population accepted by the zero policy"""
 		# TODO change to take a request object
-		record = {'timestamp': time.time()} #, 'estimate_dau': dau, 'estimate_mau': mau}
+		record = {'timestamp': timestamp or time.time()} #, 'estimate_dau': dau, 'estimate_mau': mau}
 		# estimate['age_min'] = age_min
 		# estimate['age_max'] = age_max
 
-		if age_max and age_max > age_min:
-			age_key = '{min}-{max}'.format(min=age_min, max=age_max)
-		else:
-			age_key = '{min}+'.format(min=age_min)
+		self.changed = True
+		key = age_key(age_min, age_max)
 		if country not in self.dictionary:
 			self.dictionary[country] = {'errors': 0}
 		if gender not in self.dictionary[country]:
 			self.dictionary[country][gender] = {}
-		if age_key not in self.dictionary[country][gender]:
-			self.dictionary[country][gender][age_key] = {}
+		if key not in self.dictionary[country][gender]:
+			self.dictionary[country][gender][key] = {}
 		if behaviour:
 			record['estimate_dau'] = dau
 			record['estimate_mau'] = mau
-			self.dictionary[country][gender][age_key][behaviour] = record
+			if zero_accepted:
+				record['zero_accepted'] = True
+			self.dictionary[country][gender][key][behaviour] = record
 		else:
 			record['age_min'] = age_min
 			if age_max:
 				record['age_max'] = age_max
 			record['estimate_dau'] = dau
 			record['estimate_mau'] = mau
-			self.dictionary[country][gender][age_key] = record
+			if zero_accepted:
+				record['zero_accepted'] = True
+			else:
+				self.dictionary[country][gender][key].pop('zero_accepted', None)
+			# behaviours for this age range may already have been stored alongside the estimate
+			self.dictionary[country][gender][key].update(record)
+
+	def get_entry(self, country, gender, age_min, age_max, behaviour):
+		"""Get a recorded reach estimate from the store, None if the store does not hold it"""
+		estimates = self.dictionary.get(country, {}).get(gender, {}).get(age_key(age_min, age_max), {})
+		if behaviour:
+			return estimates.get(behaviour)
+		elif 'estimate_mau' in estimates:
+			return estimates
+		else:
+			return None
+
+	def has_entry(self, country, gender, age_min, age_max, behaviour):
+		"""Check whether the store already holds the given reach estimate"""
+		return self.get_entry(country, gender, age_min, age_max, behaviour) is not None
+
+	def merge(self, dictionary):
+		"""Add every estimate in another store's dictionary to this store, estimates in both are taken from the other store"""
+		self.changed = True
+		for country, genders in dictionary.items():
+			if country not in self.dictionary:
+				self.dictionary[country] = {'errors': 0}
+			for gender, age_ranges in genders.items():
+				if gender == 'errors':
+					# stores written before errors were counted, and partial shard stores, may have no count yet
+					self.dictionary[country]['errors'] = self.dictionary[country].get('errors', 0) + age_ranges
+					continue
+				for key, estimates in age_ranges.items():
+					self.dictionary[country].setdefault(gender, {}).setdefault(key, {}).update(estimates)
 
 	def read(self):
 		"""Load a store from a local JSON file"""
 		with open(self.filepath, 'r') as file:
 			logger.info('Loading estimate store from file {filepath}'.format(**vars(self)))
 			self.dictionary = json.load(file)
+		self.changed = False
 
 	def write(self):
 		"""Write the store to the local filesystem as a JSON file"""
 		with open(self.filepath, 'w') as file:
 			logger.info('Saving estimate store to file {filepath}'.format(**vars(self)))
 			json.dump(self.dictionary, file)
+		self.changed = False
 
 	def upload(self, bucket, batch_string):
 		"""Upload the store to our S3 bucket"""
 		# TODO not a responsibility of this class rewrite
 		# TODO could upload without a write
 		# TODO take S3 folder, pass to folder
-		self.write()
+		if self.changed or not os.path.isfile(self.filepath):
+			self.write()
 
 		batch_s3_folder = 'data/{timestamp}'.format(timestamp=batch_string)
 		key = '{folder}/{filename}'.format(folder=batch_s3_folder, filename=os.path.basename(self.filepath))
@@ -82,3 +185,425 @@ class FacebookEstimateJsonStore:
 		# TODO implementation
 		# TODO write a csv implementation of the store class and call its constructor here
 		raise NotImplementedError
+
+
+class FacebookEstimateJsonLinesStore(FacebookEstimateJsonStore):
+	"""
+	Represents a store using a JSON file with an append-only JSON Lines log beside it, for use without a collection,
+	whose journal already logs each estimate.
+	Each estimate is appended to the log as it is added, an EstimateJournal that fsyncs in the background, so keeping
+	the store durable costs one line per estimate rather than rewriting the whole file. The log is replayed on top of the JSON file when the store
+	is loaded, and compacted into the JSON file, in the usual nested layout, when the store is written at the end.
+	"""
+	def __init__(self, filepath, log_filepath=None):
+		self.log_filepath = log_filepath or '{root}.log.jsonl'.format(root=os.path.splitext(filepath)[0])
+		self.log = EstimateJournal(self.log_filepath)
+		super().__init__(filepath)
+		self.replay()
+
+	def add_entry(self, country, gender, age_min, age_max, behaviour, dau, mau, timestamp=None, zero_accepted=False):
+		"""Record a reach estimate into the store and append it to the log"""
+		timestamp = timestamp or time.time()
+		super().add_entry(country, gender, age_min, age_max, behaviour, dau, mau, timestamp=timestamp, zero_accepted=zero_accepted)
+		line = {
+			'country': country, 'gender': gender, 'age_min': age_min, 'age_max': age_max, 'behaviour': behaviour,
+			'estimate_dau': dau, 'estimate_mau': mau, 'timestamp': timestamp
+		}
+		if zero_accepted:
+			line['zero_accepted'] = True
+		self.append(line)
+
+	def merge(self, dictionary):
+		"""Add every estimate in another store's dictionary to this store, logging the dictionary as one line"""
+		super().merge(dictionary)
+		self.append({'merge': dictionary})
+
+	def append(self, line):
+		"""Append a line to the log"""
+		self.log.append(line)
+
+	def replay(self):
+		"""Apply the lines in the log to the store, a truncated final line left by a crash is skipped"""
+		if not os.path.isfile(self.log_filepath):
+			return
+		replayed = 0
+		for entry in self.log.entries():
+			if 'merge' in entry:
+				super().merge(entry['merge'])
+			else:
+				super().add_entry(entry['country'], entry['gender'], entry['age_min'], entry['age_max'], entry['behaviour'], entry['estimate_dau'], entry['estimate_mau'], timestamp=entry['timestamp'], zero_accepted=entry.get('zero_accepted', False))
+			replayed += 1
+		logger.info('Replayed {x} lines from store log {filepath}'.format(x=replayed, filepath=self.log_filepath))
+
+	def write(self):
+		"""
+		Compact the log into the JSON file, then remove the log.
+		The JSON file is replaced in one step so a crash leaves either the old file and the full log, or the new file
+		"""
+		temp_filepath = self.filepath + '.tmp'
+		with open(temp_filepath, 'w') as file:
+			logger.info('Compacting estimate store into file {filepath}'.format(**vars(self)))
+			json.dump(self.dictionary, file)
+		os.replace(temp_filepath, self.filepath)
+		self.changed = False
+		self.close()
+		if os.path.isfile(self.log_filepath):
+			os.remove(self.log_filepath)
+
+	def close(self):
+		"""Close the log file"""
+		self.log.close()
+
+
+class FacebookEstimateSQLiteStore:
+	"""
+	Represents the store for one collection day in a SQLite database that can hold every day, with an index on
+	(date, country, gender, age key, behaviour) for lookups.
+	Estimates added are buffered and inserted batch_size at a time in one transaction, and when the store is written.
+	Lookups are answered from the buffer or the table without flushing it. upload exports the day in the usual nested JSON layout beside the database,
+	so the bucket holds the same store files as before.
+	The query helpers read straight from the database for the analysis, without parsing a JSON or CSV file per day.
+	"""
+	def __init__(self, date, filepath=estimates_database_path, batch_size=500):
+		self.filepath = filepath
+		self.date = date
+		self.batch_size = batch_size
+		# buffered rows by (country, gender, age key, behaviour), the latest estimate for each replacing any earlier one
+		self.pending = {}
+		self.connection = sqlite3.connect(filepath)
+		with self.connection:
+			self.connection.execute(
+				'CREATE TABLE IF NOT EXISTS estimates (date TEXT, country TEXT, gender TEXT, age_key TEXT, behaviour TEXT, '
+				'age_min INTEGER, age_max INTEGER, estimate_dau INTEGER, estimate_mau INTEGER, timestamp REAL, '
+				'zero_accepted INTEGER DEFAULT 0, PRIMARY KEY (date, country, gender, age_key, behaviour))'
+			)
+			# databases created before zero_accepted was recorded
+			columns = [row[1] for row in self.connection.execute('PRAGMA table_info(estimates)')]
+			if 'zero_accepted' not in columns:
+				self.connection.execute('ALTER TABLE estimates ADD COLUMN zero_accepted INTEGER DEFAULT 0')
+			self.connection.execute('CREATE TABLE IF NOT EXISTS countries (date TEXT, country TEXT, errors INTEGER DEFAULT 0, PRIMARY KEY (date, country))')
+
+	def add_entry(self, country, gender, age_min, age_max, behaviour, dau, mau, timestamp=None, zero_accepted=False):
+		"""Record a reach estimate into the store, inserted with the next batch"""
+		key = age_key(age_min, age_max)
+		self.pending[(country, gender, key, behaviour or '')] = (
+			self.date, country, gender, key, behaviour or '', age_min, age_max if age_max and age_max > age_min else None,
+			dau, mau, timestamp or time.time(), int(zero_accepted)
+		)
+		if len(self.pending) >= self.batch_size:
+			self.flush()
+
+	def flush(self):
+		"""Insert the buffered estimates in one transaction"""
+		if not self.pending:
+			return
+		with self.connection:
+			self.connection.executemany('INSERT OR IGNORE INTO countries (date, country) VALUES (?, ?)', {(row[0], row[1]) for row in self.pending.values()})
+			self.connection.executemany(insert_estimate, self.pending.values())
+		self.pending = {}
+
+	def get_entry(self, country, gender, age_min, age_max, behaviour):
+		"""Get a recorded reach estimate from the store, in the nested store layout, None if the store does not hold it"""
+		key = age_key(age_min, age_max)
+		pending = self.pending.get((country, gender, key, behaviour or ''))
+		if pending is not None:
+			return self.record(behaviour, *pending[5:])
+		row = self.connection.execute(
+			'SELECT age_min, age_max, estimate_dau, estimate_mau, timestamp, zero_accepted FROM estimates WHERE date = ? AND country = ? AND gender = ? AND age_key = ? AND behaviour = ?',
+			(self.date, country, gender, key, behaviour or '')
+		).fetchone()
+		if row is None:
+			return None
+		return self.record(behaviour, *row)
+
+	def has_entry(self, country, gender, age_min, age_max, behaviour):
+		"""Check whether the store already holds the given reach estimate"""
+		return self.get_entry(country, gender, age_min, age_max, behaviour) is not None
+
+	@staticmethod
+	def record(behaviour, age_min, age_max, dau, mau, timestamp, zero_accepted=0):
+		"""Build the record of an estimate as the JSON store holds it"""
+		if behaviour:
+			record = {'timestamp': timestamp, 'estimate_dau': dau, 'estimate_mau': mau}
+		else:
+			record = {'timestamp': timestamp, 'age_min': age_min}
+			if age_max:
+				record['age_max'] = age_max
+			record['estimate_dau'] = dau
+			record['estimate_mau'] = mau
+		if zero_accepted:
+			record['zero_accepted'] = True
+		return record
+
+	def merge(self, dictionary):
+		"""Add every estimate in another store's dictionary to this store, estimates in both are taken from the other store"""
+		self.flush()
+		rows = []
+		for country, gender, key, behaviour, record in store_entries(dictionary):
+			age_min, age_max = parse_age_key(key)
+			rows += [(
+				self.date, country, gender, key, behaviour or '', age_min, age_max,
+				record.get('estimate_dau'), record.get('estimate_mau'), record.get('timestamp'), int(record.get('zero_accepted', False))
+			)]
+		with self.connection:
+			for country, genders in dictionary.items():
+				self.connection.execute('INSERT OR IGNORE INTO countries (date, country) VALUES (?, ?)', (self.date, country))
+				self.connection.execute('UPDATE countries SET errors = errors + ? WHERE date = ? AND country = ?', (genders.get('errors', 0), self.date, country))
+			self.connection.executemany(insert_estimate, rows)
+
+	@property
+	def dictionary(self):
+		"""The day's estimates in the nested store layout"""
+		return self.estimates(self.date)
+
+	def estimates(self, date):
+		"""Get a collection day's estimates in the nested store layout, as preprocess_counts takes them"""
+		self.flush()
+		dictionary = {}
+		for country, errors in self.connection.execute('SELECT country, errors FROM countries WHERE date = ? ORDER BY rowid', (date,)):
+			dictionary[country] = {'errors': errors}
+		rows = self.connection.execute(
+			'SELECT country, gender, age_key, behaviour, age_min, age_max, estimate_dau, estimate_mau, timestamp, zero_accepted FROM estimates WHERE date = ? ORDER BY rowid', (date,)
+		)
+		for country, gender, key, behaviour, *values in rows:
+			estimates = dictionary.setdefault(country, {'errors': 0}).setdefault(gender, {}).setdefault(key, {})
+			if behaviour:
+				estimates[behaviour] = self.record(behaviour, *values)
+			else:
+				estimates.update(self.record(behaviour, *values))
+		return dictionary
+
+	def daily_values(self, start, end, estimate='mau'):
+		"""
+		Get every day's estimates between the start and end dates inclusive, nested by country, gender, age key and
+		behaviour with a list of the daily values under estimate_<estimate>, as MonthlyAnalysis averages them
+		"""
+		self.flush()
+		estimate_key = 'estimate_{estimate}'.format(estimate=estimate)
+		values = {}
+		rows = self.connection.execute(
+			'SELECT country, gender, age_key, behaviour, {column} FROM estimates WHERE date BETWEEN ? AND ? AND {column} IS NOT NULL ORDER BY date'.format(column=estimate_key),
+			(str(start), str(end))
+		)
+		for country, gender, key, behaviour, value in rows:
+			estimates = values.setdefault(country, {}).setdefault(gender, {}).setdefault(key, {})
+			if behaviour:
+				estimates = estimates.setdefault(behaviour, {})
+			estimates.setdefault(estimate_key, []).append(value)
+		return values
+
+	def dates(self):
+		"""Sorted list of the collection days in the database"""
+		self.flush()
+		return [row[0] for row in self.connection.execute('SELECT DISTINCT date FROM countries ORDER BY date')]
+
+	def read(self):
+		"""Nothing to load, the database is queried as needed"""
+		pass
+
+	def write(self):
+		"""Insert any buffered estimates"""
+		self.flush()
+
+	def export(self, filepath):
+		"""Write the day's estimates to a JSON file in the nested store layout"""
+		with open(filepath, 'w') as file:
+			logger.info('Exporting estimate store for {date} to file {filepath}'.format(date=self.date, filepath=filepath))
+			json.dump(self.dictionary, file)
+
+	def upload(self, bucket, batch_string):
+		"""Upload the day's estimates to our S3 bucket as the usual JSON store file"""
+		self.write()
+		filename = 'store_{timestamp}.json'.format(timestamp=batch_string)
+		filepath = os.path.join(os.path.dirname(self.filepath), filename)
+		self.export(filepath)
+		key = 'data/{timestamp}/{filename}'.format(timestamp=batch_string, filename=filename)
+		with open(filepath, 'rb') as file:
+			bucket.put(key, file)
+
+	def close(self):
+		"""Insert any buffered estimates and close the database"""
+		self.flush()
+		self.connection.close()
+
+
+class InternTable:
+	"""Represents a dimension of the array store, each distinct value held once and referred to by its index"""
+	def __init__(self):
+		self.values = []
+		self.indices = {}
+
+	def __len__(self):
+		return len(self.values)
+
+	def intern(self, value):
+		"""Get the index of a value, adding it to the table if it is new"""
+		index = self.indices.get(value)
+		if index is None:
+			index = len(self.values)
+			self.indices[value] = index
+			self.values.append(value)
+		return index
+
+
+class FacebookEstimateArrayStore:
+	"""
+	Represents a store using a JSON file, held in memory as interned dimension tables and parallel arrays.
+	Each estimate is a row of the arrays, its country, gender, age key and behaviour stored as indices into the
+	dimension tables and its dau, mau and timestamp as machine numbers, so the many repeated behaviour names and the
+	dict per estimate of the JSON store are not held in memory. A missing dau or mau is stored as -1 and a missing
+	timestamp as NaN, zero_accepted is a column of flags. The store is read from and written to the usual nested JSON
+	layout
+	"""
+	def __init__(self, filepath):
+		self.filepath = filepath
+		self.changed = False
+		self.clear()
+		if pathlib.Path(self.filepath).is_file():
+			try:
+				self.read()
+			except json.decoder.JSONDecodeError:
+				logger.info('Decoding error while loading estimate store from file "{filepath}" store object created empty'.format(**vars(self)))
+				self.clear()
+
+	def __len__(self):
+		return len(self.dau)
+
+	def clear(self):
+		"""Remove every estimate from the store"""
+		self.countries = InternTable()
+		self.genders = InternTable()
+		self.age_keys = InternTable()
+		# behaviour 0 is the estimate of the age range itself
+		self.behaviours = InternTable()
+		self.behaviours.intern(None)
+		self.country = array.array('I')
+		self.gender = array.array('B')
+		self.age_key = array.array('H')
+		self.behaviour = array.array('I')
+		self.dau = array.array('q')
+		self.mau = array.array('q')
+		self.timestamp = array.array('d')
+		self.zero_accepted = array.array('B')
+		self.errors = array.array('q')
+		self.rows = {}
+
+	def intern_country(self, country):
+		"""Get the index of a country, adding it with no errors if it is new"""
+		index = self.countries.intern(country)
+		if index == len(self.errors):
+			self.errors.append(0)
+		return index
+
+	def row_key(self, country, gender, key, behaviour):
+		"""Interned dimensions of the row for an estimate"""
+		return self.intern_country(country), self.genders.intern(gender), self.age_keys.intern(key), self.behaviours.intern(behaviour)
+
+	@staticmethod
+	def pack(country, gender, key, behaviour):
+		"""Pack the interned dimensions of a row into one int, the key of the row in the lookup"""
+		return ((country << 32 | behaviour) << 16 | key) << 8 | gender
+
+	def set_row(self, country, gender, key, behaviour, dau, mau, timestamp, zero_accepted=False):
+		"""Add the estimate as a new row, or replace the row already holding its dimensions"""
+		dimensions = self.row_key(country, gender, key, behaviour)
+		values = (
+			-1 if dau is None else dau, -1 if mau is None else mau, math.nan if timestamp is None else timestamp,
+			int(bool(zero_accepted))
+		)
+		self.changed = True
+		row = self.rows.get(self.pack(*dimensions))
+		if row is None:
+			self.rows[self.pack(*dimensions)] = len(self.dau)
+			for column, value in zip((self.country, self.gender, self.age_key, self.behaviour), dimensions):
+				column.append(value)
+			self.dau.append(values[0])
+			self.mau.append(values[1])
+			self.timestamp.append(values[2])
+			self.zero_accepted.append(values[3])
+		else:
+			self.dau[row], self.mau[row], self.timestamp[row], self.zero_accepted[row] = values
+
+	def add_entry(self, country, gender, age_min, age_max, behaviour, dau, mau, timestamp=None, zero_accepted=False):
+		"""Record a reach estimate into the store"""
+		self.set_row(country, gender, age_key(age_min, age_max), behaviour or None, dau, mau, timestamp or time.time(), zero_accepted)
+
+	def record(self, row):
+		"""Build the record of the estimate in a row as the JSON store holds it"""
+		record = {}
+		if not math.isnan(self.timestamp[row]):
+			record['timestamp'] = self.timestamp[row]
+		if not self.behaviour[row]:
+			age_min, age_max = parse_age_key(self.age_keys.values[self.age_key[row]])
+			record['age_min'] = age_min
+			if age_max:
+				record['age_max'] = age_max
+		if self.dau[row] >= 0:
+			record['estimate_dau'] = self.dau[row]
+		if self.mau[row] >= 0:
+			record['estimate_mau'] = self.mau[row]
+		if self.zero_accepted[row]:
+			record['zero_accepted'] = True
+		return record
+
+	def get_entry(self, country, gender, age_min, age_max, behaviour):
+		"""Get a recorded reach estimate from the store, None if the store does not hold it"""
+		try:
+			dimensions = (
+				self.countries.indices[country], self.genders.indices[gender],
+				self.age_keys.indices[age_key(age_min, age_max)], self.behaviours.indices[behaviour or None]
+			)
+		except KeyError:
+			return None
+		row = self.rows.get(self.pack(*dimensions))
+		if row is None:
+			return None
+		return self.record(row)
+
+	def has_entry(self, country, gender, age_min, age_max, behaviour):
+		"""Check whether the store already holds the given reach estimate"""
+		return self.get_entry(country, gender, age_min, age_max, behaviour) is not None
+
+	def merge(self, dictionary):
+		"""Add every estimate in another store's dictionary to this store, estimates in both are taken from the other store"""
+		for country, genders in dictionary.items():
+			self.errors[self.intern_country(country)] += genders.get('errors', 0)
+		for country, gender, key, behaviour, record in store_entries(dictionary):
+			self.set_row(country, gender, key, behaviour, record.get('estimate_dau'), record.get('estimate_mau'), record.get('timestamp'), record.get('zero_accepted', False))
+
+	@property
+	def dictionary(self):
+		"""The estimates in the nested store layout"""
+		dictionary = {country: {'errors': self.errors[index]} for index, country in enumerate(self.countries.values)}
+		for row in range(len(self.dau)):
+			estimates = dictionary[self.countries.values[self.country[row]]]
+			estimates = estimates.setdefault(self.genders.values[self.gender[row]], {}).setdefault(self.age_keys.values[self.age_key[row]], {})
+			if self.behaviour[row]:
+				estimates[self.behaviours.values[self.behaviour[row]]] = self.record(row)
+			else:
+				estimates.update(self.record(row))
+		return dictionary
+
+	def read(self):
+		"""Load a store from a local JSON file"""
+		with open(self.filepath, 'r') as file:
+			logger.info('Loading estimate store from file {filepath}'.format(**vars(self)))
+			dictionary = json.load(file)
+		self.clear()
+		self.merge(dictionary)
+		self.changed = False
+
+	def write(self):
+		"""Write the store to the local filesystem as a JSON file in the nested layout"""
+		with open(self.filepath, 'w') as file:
+			logger.info('Saving estimate store to file {filepath}'.format(**vars(self)))
+			json.dump(self.dictionary, file)
+		self.changed = False
+
+	def upload(self, bucket, batch_string):
+		"""Upload the store to our S3 bucket"""
+		if self.changed or not os.path.isfile(self.filepath):
+			self.write()
+		key = 'data/{timestamp}/{filename}'.format(timestamp=batch_string, filename=os.path.basename(self.filepath))
+		with open(self.filepath, 'rb') as file:
+			bucket.put(key, file)
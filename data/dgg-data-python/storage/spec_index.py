@@ -0,0 +1,53 @@
+"""Class for a per-day index of reach estimates by the canonical hash of their targeting spec"""
+import json
+import os
+import pathlib
+
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+
+class SpecIndex:
+	"""
+	Represents the estimates collected for a batch keyed by targeting spec hash, held in a JSON file beside the store.
+	A request whose spec is already in the index is answered from it without sending another API call, whatever store
+	dimensions it is filed under.
+	"""
+	def __init__(self, filepath):
+		self.filepath = filepath
+		self.dictionary = {}
+
+	def __len__(self):
+		return len(self.dictionary)
+
+	def __contains__(self, spec_hash):
+		return spec_hash in self.dictionary
+
+	def add(self, spec_hash, dau, mau, timestamp, zero_accepted=False):
+		"""Record the estimate for a targeting spec hash"""
+		self.dictionary[spec_hash] = {'estimate_dau': dau, 'estimate_mau': mau, 'timestamp': timestamp}
+		if zero_accepted:
+			self.dictionary[spec_hash]['zero_accepted'] = True
+
+	def get(self, spec_hash):
+		"""Get the estimate recorded for a targeting spec hash, None if the index does not hold it"""
+		return self.dictionary.get(spec_hash)
+
+	def read(self):
+		"""Load the index from its JSON file, if there is one"""
+		if not pathlib.Path(self.filepath).is_file():
+			return
+		try:
+			with open(self.filepath, 'r') as file:
+				self.dictionary.update(json.load(file))
+			logger.info('Loaded {n} targeting specs from index {filepath}'.format(n=len(self.dictionary), filepath=self.filepath))
+		except json.decoder.JSONDecodeError:
+			logger.warning('Could not decode targeting spec index {filepath}, ignoring it'.format(filepath=self.filepath))
+
+	def write(self):
+		"""Write the index to its JSON file, replacing it in one step so it is never read half written"""
+		temp_filepath = self.filepath + '.tmp'
+		with open(temp_filepath, 'w') as file:
+			json.dump(self.dictionary, file)
+		os.replace(temp_filepath, self.filepath)
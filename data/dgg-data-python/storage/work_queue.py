@@ -0,0 +1,360 @@
+"""
+Classes for a shared queue of collection work, leased out to workers on several machines.
+Each backend offers the same interface: the coordinator adds (country code, priority) units, workers lease a few at a
+time and complete them, leases that are not renewed or completed before they expire go back on the queue. Each worker
+also keeps its partial estimate store in the queue so the coordinator can merge the results.
+"""
+import contextlib
+import json
+import os
+import sqlite3
+import time
+
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+
+from dgg_log import root_logger
+
+logger = root_logger.getChild(__name__)
+
+# Error codes of a conditional put that lost to a write by another worker
+conflict_codes = ('PreconditionFailed', 'ConditionalRequestConflict')
+# Attempts at a lease write that fails for any other reason, e.g. the network or throttling, and seconds between them
+lease_attempts = 3
+lease_retry_wait = 2
+
+
+def unit_name(country, priority):
+	"""
+	Name of a unit of work, sorting by priority so the units are collected in priority order. The name depends on
+	nothing but the unit, so adding the same unit again finds it already in the queue
+	"""
+	return '{priority}_{country}'.format(priority=priority, country=country)
+
+
+def parse_unit_name(name):
+	"""Get the (country code, priority) unit from its name"""
+	priority, country = name.split('_', 1)
+	return country, int(priority)
+
+
+class SQLiteWorkQueue:
+	"""Represents a work queue in a SQLite database file, for workers sharing a machine or a reliable network drive"""
+	def __init__(self, filepath):
+		self.filepath = filepath
+		with self.connect() as connection:
+			connection.execute('CREATE TABLE IF NOT EXISTS units (name TEXT PRIMARY KEY, country TEXT, priority INTEGER, worker TEXT, lease_expiry REAL, done INTEGER DEFAULT 0)')
+			connection.execute('CREATE INDEX IF NOT EXISTS units_unit ON units (country, priority)')
+			connection.execute('CREATE TABLE IF NOT EXISTS results (worker TEXT PRIMARY KEY, store TEXT)')
+
+	@contextlib.contextmanager
+	def connect(self):
+		"""Open a connection for the block and close it after, transactions are begun explicitly"""
+		connection = sqlite3.connect(self.filepath, timeout=60, isolation_level=None)
+		try:
+			with connection:
+				yield connection
+		finally:
+			connection.close()
+
+	def add(self, units):
+		"""Add units of work to the queue, units already in the queue are left as they are"""
+		with self.connect() as connection:
+			connection.executemany('INSERT OR IGNORE INTO units (name, country, priority) VALUES (?, ?, ?)', [(unit_name(*unit), *unit) for unit in units])
+
+	def lease(self, worker, count, timeout):
+		"""Lease up to count units to the worker for timeout seconds, the units that come first in collection order first"""
+		now = time.time()
+		with self.connect() as connection:
+			connection.execute('BEGIN IMMEDIATE')
+			units = connection.execute(
+				'SELECT country, priority FROM units WHERE done = 0 AND (lease_expiry IS NULL OR lease_expiry < ?) ORDER BY name LIMIT ?', (now, count)
+			).fetchall()
+			connection.executemany('UPDATE units SET worker = ?, lease_expiry = ? WHERE country = ? AND priority = ?', [(worker, now + timeout, *unit) for unit in units])
+			connection.execute('COMMIT')
+		return [tuple(unit) for unit in units]
+
+	def renew(self, worker, units, timeout):
+		"""Extend the worker's leases on the units"""
+		with self.connect() as connection:
+			connection.executemany(
+				'UPDATE units SET lease_expiry = ? WHERE country = ? AND priority = ? AND worker = ? AND done = 0',
+				[(time.time() + timeout, country, priority, worker) for country, priority in units]
+			)
+
+	def complete(self, worker, units):
+		"""Mark the units as done"""
+		with self.connect() as connection:
+			connection.executemany(
+				'UPDATE units SET done = 1, worker = ? WHERE country = ? AND priority = ?',
+				[(worker, country, priority) for country, priority in units]
+			)
+
+	def remaining(self):
+		"""Number of units not yet done"""
+		with self.connect() as connection:
+			return connection.execute('SELECT COUNT(*) FROM units WHERE done = 0').fetchone()[0]
+
+	def put_result(self, worker, dictionary):
+		"""Keep the worker's partial estimate store"""
+		with self.connect() as connection:
+			connection.execute('INSERT OR REPLACE INTO results (worker, store) VALUES (?, ?)', (worker, json.dumps(dictionary)))
+
+	def results(self):
+		"""Generate the partial estimate store of every worker"""
+		with self.connect() as connection:
+			rows = connection.execute('SELECT store FROM results').fetchall()
+		for row in rows:
+			yield json.loads(row[0])
+
+
+class DirectoryWorkQueue:
+	"""
+	Represents a work queue as files in a directory, for workers sharing a filesystem.
+	A unit is a file that moves between the queued, leased and done folders by atomic renames, the modified time of
+	a leased file is set to its lease expiry.
+	"""
+	def __init__(self, path):
+		self.path = path
+		for folder in ('queued', 'leased', 'done', 'results'):
+			os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+	def folder(self, name):
+		"""Path of one of the queue's folders"""
+		return os.path.join(self.path, name)
+
+	def add(self, units):
+		"""Add units of work to the queue, units already in the queue are left as they are"""
+		existing = set(os.listdir(self.folder('queued'))) | set(os.listdir(self.folder('done')))
+		existing |= {name.split('~')[0] for name in os.listdir(self.folder('leased'))}
+		for unit in units:
+			name = unit_name(*unit)
+			if name not in existing:
+				open(os.path.join(self.folder('queued'), name), 'w').close()
+
+	def requeue_expired(self):
+		"""Put units whose lease has expired back on the queue"""
+		now = time.time()
+		for leased_name in os.listdir(self.folder('leased')):
+			filepath = os.path.join(self.folder('leased'), leased_name)
+			try:
+				if os.path.getmtime(filepath) < now:
+					os.rename(filepath, os.path.join(self.folder('queued'), leased_name.split('~')[0]))
+					logger.info('Lease on {name} expired, requeued'.format(name=leased_name))
+			except FileNotFoundError:
+				pass
+
+	def lease(self, worker, count, timeout):
+		"""Lease up to count units to the worker for timeout seconds, the units that come first in collection order first"""
+		self.requeue_expired()
+		done = set(os.listdir(self.folder('done')))
+		units = []
+		for name in sorted(os.listdir(self.folder('queued'))):
+			if len(units) >= count:
+				break
+			queued_filepath = os.path.join(self.folder('queued'), name)
+			if name in done:
+				self.remove(queued_filepath)
+				continue
+			leased_filepath = os.path.join(self.folder('leased'), '{name}~{worker}'.format(name=name, worker=worker))
+			try:
+				os.rename(queued_filepath, leased_filepath)
+			except FileNotFoundError:
+				# leased by another worker first
+				continue
+			expiry = time.time() + timeout
+			os.utime(leased_filepath, (expiry, expiry))
+			units += [parse_unit_name(name)]
+		return units
+
+	def leased_filepath(self, worker, unit):
+		"""Path of the worker's lease file for the unit, None if the worker does not hold the lease"""
+		pattern = '{p}_'.format(p=unit[1])
+		for leased_name in os.listdir(self.folder('leased')):
+			name, _, owner = leased_name.partition('~')
+			if owner == worker and name.startswith(pattern) and parse_unit_name(name) == unit:
+				return os.path.join(self.folder('leased'), leased_name)
+		return None
+
+	def renew(self, worker, units, timeout):
+		"""Extend the worker's leases on the units"""
+		expiry = time.time() + timeout
+		for unit in units:
+			filepath = self.leased_filepath(worker, unit)
+			if filepath:
+				try:
+					os.utime(filepath, (expiry, expiry))
+				except FileNotFoundError:
+					pass
+
+	def complete(self, worker, units):
+		"""Mark the units as done"""
+		queued = os.listdir(self.folder('queued'))
+		for unit in units:
+			filepath = self.leased_filepath(worker, unit)
+			names = [name for name in queued if parse_unit_name(name) == unit]
+			if filepath:
+				names += [os.path.basename(filepath).split('~')[0]]
+			for name in set(names):
+				open(os.path.join(self.folder('done'), name), 'w').close()
+				self.remove(os.path.join(self.folder('queued'), name))
+			if filepath:
+				self.remove(filepath)
+
+	@staticmethod
+	def remove(filepath):
+		"""Remove a file that another worker may already have moved"""
+		try:
+			os.remove(filepath)
+		except FileNotFoundError:
+			pass
+
+	def remaining(self):
+		"""Number of units not yet done"""
+		done = set(os.listdir(self.folder('done')))
+		names = set(os.listdir(self.folder('queued'))) | {name.split('~')[0] for name in os.listdir(self.folder('leased'))}
+		return len(names - done)
+
+	def put_result(self, worker, dictionary):
+		"""Keep the worker's partial estimate store"""
+		filepath = os.path.join(self.folder('results'), '{worker}.json'.format(worker=worker))
+		with open(filepath + '.tmp', 'w') as file:
+			json.dump(dictionary, file)
+		os.replace(filepath + '.tmp', filepath)
+
+	def results(self):
+		"""Generate the partial estimate store of every worker"""
+		for name in os.listdir(self.folder('results')):
+			if name.endswith('.json'):
+				with open(os.path.join(self.folder('results'), name), 'r') as file:
+					yield json.load(file)
+
+
+class S3WorkQueue:
+	"""
+	Represents a work queue under a prefix in an S3 bucket, for workers on separate machines.
+	Leases are objects written with conditional puts, a worker only takes a lease if no lease object exists or the
+	existing one has expired and is unchanged since it was read, so two workers never hold the same unit.
+	"""
+	def __init__(self, bucket, prefix):
+		self.bucket = bucket
+		self.prefix = prefix.rstrip('/')
+		self.etags = {}
+
+	def key(self, folder, name):
+		"""Key of an object in one of the queue's folders"""
+		return '{prefix}/{folder}/{name}'.format(prefix=self.prefix, folder=folder, name=name)
+
+	def list(self, folder):
+		"""Map the names of the objects in a folder of the queue to their ETags"""
+		objects = {}
+		paginator = self.bucket.client.get_paginator('list_objects_v2')
+		for page in paginator.paginate(Bucket=self.bucket.bucket, Prefix=self.key(folder, '')):
+			for item in page.get('Contents', []):
+				objects[item['Key'].rsplit('/', 1)[-1]] = item['ETag']
+		return objects
+
+	def put(self, folder, name, body, **conditions):
+		"""Put an object in one of the queue's folders, returning its ETag"""
+		response = self.bucket.client.put_object(Bucket=self.bucket.bucket, Key=self.key(folder, name), Body=body, **conditions)
+		return response['ETag']
+
+	def add(self, units):
+		"""Add units of work to the queue, units already in the queue are left as they are"""
+		existing = self.list('queued')
+		for unit in units:
+			name = unit_name(*unit)
+			if name not in existing:
+				self.put('queued', name, b'')
+
+	def lease(self, worker, count, timeout):
+		"""Lease up to count units to the worker for timeout seconds, the units that come first in collection order first"""
+		done = self.list('done')
+		leases = self.list('leases')
+		units = []
+		for name in sorted(self.list('queued')):
+			if len(units) >= count:
+				break
+			if name in done:
+				continue
+			body = json.dumps({'worker': worker, 'expiry': time.time() + timeout}).encode('utf-8')
+			try:
+				if name in leases:
+					response = self.bucket.client.get_object(Bucket=self.bucket.bucket, Key=self.key('leases', name))
+					if json.loads(response['Body'].read())['expiry'] >= time.time():
+						continue
+					etag = self.put('leases', name, body, IfMatch=response['ETag'])
+				else:
+					etag = self.put('leases', name, body, IfNoneMatch='*')
+			except ClientError as e:
+				if e.response['Error']['Code'] in conflict_codes + ('NoSuchKey',):
+					# leased by another worker first
+					continue
+				raise
+			self.etags[name] = etag
+			units += [parse_unit_name(name)]
+		return units
+
+	def held(self, units):
+		"""Names of the leases this worker holds on the units"""
+		return [name for name in self.etags if parse_unit_name(name) in units]
+
+	def put_lease(self, name, body):
+		"""
+		Rewrite a lease the worker holds, conditional on it being unchanged since the worker last wrote it.
+		Returns False if another worker has taken the lease, other errors are retried lease_attempts times and then
+		raised, leaving the lease held
+		"""
+		for attempt in range(1, lease_attempts + 1):
+			try:
+				self.etags[name] = self.put('leases', name, body, IfMatch=self.etags[name])
+				return True
+			except ClientError as e:
+				if e.response['Error']['Code'] in conflict_codes:
+					logger.warning('Lost the lease on {name}'.format(name=name))
+					del self.etags[name]
+					return False
+				if attempt == lease_attempts:
+					raise
+				logger.warning('Could not write the lease on {name}, attempt {n}: {e}'.format(name=name, n=attempt, e=e))
+			except BotoCoreError as e:
+				if attempt == lease_attempts:
+					raise
+				logger.warning('Could not write the lease on {name}, attempt {n}: {e}'.format(name=name, n=attempt, e=e))
+			time.sleep(lease_retry_wait)
+
+	def renew(self, worker, units, timeout):
+		"""Extend the worker's leases on the units, a lease that cannot be written now is tried again at the next renewal"""
+		for name in self.held(units):
+			body = json.dumps({'worker': worker, 'expiry': time.time() + timeout}).encode('utf-8')
+			try:
+				self.put_lease(name, body)
+			except (ClientError, BotoCoreError):
+				logger.exception('Could not renew the lease on {name}'.format(name=name))
+
+	def complete(self, worker, units):
+		"""
+		Mark the units as done. The lease is rewritten on the ETag the worker holds first, so a unit whose lease has
+		been taken by another worker is left for that worker to complete
+		"""
+		for name in self.held(units):
+			body = json.dumps({'worker': worker, 'expiry': time.time(), 'done': True}).encode('utf-8')
+			if not self.put_lease(name, body):
+				continue
+			self.put('done', name, worker.encode('utf-8'))
+			self.bucket.client.delete_object(Bucket=self.bucket.bucket, Key=self.key('leases', name))
+			del self.etags[name]
+
+	def remaining(self):
+		"""Number of units not yet done"""
+		return len(set(self.list('queued')) - set(self.list('done')))
+
+	def put_result(self, worker, dictionary):
+		"""Keep the worker's partial estimate store"""
+		self.put('results', '{worker}.json'.format(worker=worker), json.dumps(dictionary).encode('utf-8'))
+
+	def results(self):
+		"""Generate the partial estimate store of every worker"""
+		for name in self.list('results'):
+			response = self.bucket.client.get_object(Bucket=self.bucket.bucket, Key=self.key('results', name))
+			yield json.loads(response['Body'].read())